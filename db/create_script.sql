@@ -25,6 +25,10 @@ CREATE TABLE invoices (
 
 CREATE TABLE dispute_cases (
     case_id           SERIAL PRIMARY KEY,
+    -- Gmail message the dispute came from; retried resolutions of one email
+    -- write one case. Existing databases:
+    --   ALTER TABLE dispute_cases ADD COLUMN email_id TEXT UNIQUE;
+    email_id          TEXT        UNIQUE,
     supplier_id       INT         NOT NULL REFERENCES suppliers(supplier_id) ON DELETE RESTRICT,
     invoice_id        INT         REFERENCES invoices(invoice_id) ON DELETE SET NULL,
     invoice_number    TEXT,
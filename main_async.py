@@ -1,417 +1,641 @@
 import asyncio
 import json
+import os
+import re
 import time
-from datetime import datetime, timezone
-
-from src.agents.gmail_watcher import (
-    fetch_emails,
-    get_gmail_service,
-    get_or_create_label,
-    mark_labels,
-    DISPUTE_LABEL_NAME,
-    NON_DISPUTE_LABEL_NAME,
-    PROCESSED_LABEL_NAME,
-)
-from src.agents.email_preprocessor import preprocess_email_llm
-from src.agents.dispute_detector import detect_dispute
+from contextlib import asynccontextmanager
+from email.utils import parseaddr
+
+from src.agents.gmail_watcher import body_stats, resolve_label_ids, settle_history, start_watch
 from src.agents.dispute_claim_extractor import extract_dispute_claim
 from src.agents.stm_manager import STMManager
-from src.agents.ambiguity_resolver import resolve_ambiguity
-from src.agents.clarification_drafter import draft_clarification_email
-from src.agents.clarification_mailer import ClarificationMailerAgent
-from src.agents.context_resolution_agent import (
-    ContextResolutionOutcome,
-    resolve_conversational_context,
-)
-from src.services.dispute_resolver import resolve_dispute_case
+from src.agents.clarification_mailer import RecordingMailer, get_clarification_mailer
+from src.agents.mail_sources import get_mail_source
+from src.agents.mailboxes import get_mailbox
+from src.pipeline.email_flow import EmailFlowConfig, build_email_graph, resolve_and_persist_dispute
+from src.pipeline.engine import RESULT_KEY, PipelineEngine, Stage
+from src.services.dispute_executor import DisputeJobExecutor
+from src.services.email_priority import PRIORITY_NORMAL, EmailPrioritizer, SupplierRiskCache
+from src.services.poll_committer import PollCommitter
+from src.services.poll_scheduler import AdaptivePollScheduler
+from src.services.push_ingestion import DEFAULT_PUSH_PORT, PushNotifier
+from src.services.retry_queue import RetryQueue
+from src.services.sharded_pool import ShardedWorkerPool
+from src.services.speculation import Speculation, speculation_stats
+from src.services.stage_checkpoints import StageCheckpoints
+from src.services.work_stream import PollerLease, WorkStream
+from src.services.worker_pool import EmailWorkerPool
+from src.db.redis_client import get_redis_client
+from src.utils.circuit_breaker import CircuitOpen, breaker_metrics, check_breakers
+from src.utils.single_flight import single_flight_metrics
 
 stm_manager = STMManager()
-mailer = ClarificationMailerAgent()
+# Replayed sources (MAIL_SOURCE=file/jsonl) must never mail real suppliers.
+mailer = get_clarification_mailer()
+stage_checkpoints = StageCheckpoints(stm_manager.redis)
 PROCESSED_SET_KEY = "processed:email_ids"
+# Fetch only messages added since the last poll via the Gmail History API.
+INCREMENTAL_SYNC = os.getenv("GMAIL_INCREMENTAL_SYNC", "false").lower() == "true"
+# "poll" sleeps between fetches; "push" waits for Gmail Pub/Sub notifications.
+INGESTION_MODE = os.getenv("INGESTION_MODE", "poll").lower()
+POLL_INTERVAL_SECONDS = 10
+MAX_POLL_INTERVAL_SECONDS = int(os.getenv("MAX_POLL_INTERVAL_SECONDS", "300"))
+MAX_FETCH_BATCH = int(os.getenv("MAX_FETCH_BATCH", "100"))
+# Check headers first and download full bodies only for candidate emails.
+TWO_PHASE_FETCH = os.getenv("GMAIL_TWO_PHASE_FETCH", "false").lower() == "true"
+# Safety-net sync in push mode, in case a notification is lost.
+PUSH_FALLBACK_SECONDS = 300
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "8"))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "100"))
+# More than one spreads the workers over processes, sharded by conversation.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+COMMIT_INTERVAL_SECONDS = 2
+# "local" keeps polling and processing in this process; "redis-streams" splits
+# them around a Redis Stream so any number of processes can consume.
+WORK_QUEUE = os.getenv("WORK_QUEUE", "local").lower()
+# Worker-only nodes set RUN_POLLER=false; otherwise a lease elects one poller.
+RUN_POLLER = os.getenv("RUN_POLLER", "true").lower() == "true"
+LEASE_RETRY_SECONDS = 5
+RECLAIM_INTERVAL_SECONDS = 30
+STALE_ENTRY_MS = int(os.getenv("STALE_ENTRY_MS", str(5 * 60 * 1000)))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "30"))
+RETRY_CHECK_SECONDS = 10
+# Dispute resolution runs beside triage with its own small pool.
+DISPUTE_WORKERS = int(os.getenv("DISPUTE_WORKERS", "2"))
+DISPUTE_DRAIN_SECONDS = 30
+# Start independent LLM stages before we know they are needed: preprocessing
+# alongside context resolution, and claim extraction alongside detection for
+# emails that read like disputes.
+SPECULATIVE_EXECUTION = os.getenv("SPECULATIVE_EXECUTION", "false").lower() == "true"
+DISPUTE_HINTS = re.compile(
+    r"\b(disput\w*|discrepanc\w*|mismatch\w*|overcharg\w*|short[- ]?paid|underpaid|"
+    r"incorrect|wrong (?:amount|price|rate)|credit note|debit note)\b",
+    re.IGNORECASE,
+)
+# Cap on concurrent runs of each LLM stage across all workers (unset = no cap).
+LLM_STAGE_CONCURRENCY = int(os.getenv("LLM_STAGE_CONCURRENCY", "0")) or None
+# Time budget of one email across all its stages, and the cap on any single
+# LLM stage within it. A stage past either is cancelled and the email retried.
+EMAIL_DEADLINE_SECONDS = float(os.getenv("EMAIL_DEADLINE_SECONDS", "300"))
+STAGE_TIMEOUT_SECONDS = float(os.getenv("STAGE_TIMEOUT_SECONDS", "120"))
+DISPUTE_TIMEOUT_SECONDS = float(os.getenv("DISPUTE_TIMEOUT_SECONDS", "180"))
+# Clarification replies first, then risky suppliers and large amounts; waiting
+# mail climbs one priority level per PRIORITY_AGING_SECONDS.
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "60"))
+PRIORITY_RISK_THRESHOLD = float(os.getenv("PRIORITY_RISK_THRESHOLD", "50"))
+PRIORITY_AMOUNT_THRESHOLD = os.getenv("PRIORITY_AMOUNT_THRESHOLD", "100000")
 
 
-def _bootstrap_stm_from_email(
-    processed_email: dict,
-    classification: str,
-    reason: str,
-    state: str,
-    confidence: float | None,
-    thread_id: str | None,
-) -> dict:
-    now = datetime.now(timezone.utc).isoformat()
-    supplier_email = processed_email.get("supplier_email_id")
-    supplier_emails = [supplier_email] if supplier_email else []
-
-    entry = {
-        "email_id": processed_email.get("email_id"),
-        "message_id_header": processed_email.get("message_id_header"),
-        "timestamp": now,
-        "classification": classification,
-        "summary": reason,
-    }
-
-    return {
-        "thread_id": thread_id,
-        "supplier_id": processed_email.get("supplier_id"),
-        "supplier_email_ids": supplier_emails,
-        "state": state,
-        "email_trail": [entry],
-        "original_clean_text": processed_email.get("clean_text"),
-        "pending_question": None,
-        "pending_draft_body": None,
-        "last_classification": classification,
-        "confidence": confidence or 0.0,
-        "created_at": now,
-        "last_updated": now,
-    }
-
-
-def _append_email_trail_entry(stm: dict, processed_email: dict, classification: str, reason: str) -> None:
-    if not stm:
-        return
-    stm.setdefault("email_trail", [])
-    email_id = processed_email.get("email_id")
-    existing_ids = {entry.get("email_id") for entry in stm["email_trail"]}
-    if email_id in existing_ids:
-        return
+async def run_in_thread(func, *args, **kwargs):
+    """Helper to run blocking functions in a thread pool."""
+    return await asyncio.to_thread(func, *args, **kwargs)
 
-    stm["email_trail"].append({
-        "email_id": email_id,
-        "message_id_header": processed_email.get("message_id_header"),
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "classification": classification,
-        "summary": reason,
-    })
 
-    supplier_email = processed_email.get("supplier_email_id")
-    if supplier_email:
-        stm.setdefault("supplier_email_ids", [])
-        if supplier_email not in stm["supplier_email_ids"]:
-            stm["supplier_email_ids"].append(supplier_email)
+async def resolve_and_persist_dispute_async(processed_email: dict, decision: dict, state: dict | None = None) -> None:
+    """
+    DisputeJobExecutor job: extract the claim (or take the one extracted
+    speculatively) and write the dispute case.
+    """
+    state = {} if state is None else state
+    try:
+        if "claim" not in state:
+            speculative = _speculative_claims.pop(processed_email.get("email_id"), None)
+            if speculative:
+                state["claim"] = await speculative.result()
+        await run_in_thread(resolve_and_persist_dispute, processed_email, decision, state)
+    except Exception as exc:
+        print("Failed to resolve dispute (async):", exc)
+        # Let the executor retry it.
+        raise
+
+
+# email_id -> claim extraction started alongside detection, awaiting its job.
+_speculative_claims: dict[str, Speculation] = {}
+# email_id -> claim extraction launched by a run and not yet handed to a job;
+# process_email_async discards whatever is left here when the run ends.
+_launched_claims: dict[str, Speculation] = {}
+
+dispute_executor = DisputeJobExecutor(
+    resolve_and_persist_dispute_async,
+    workers=DISPUTE_WORKERS,
+    store=stm_manager.redis,
+    timeout_seconds=DISPUTE_TIMEOUT_SECONDS,
+    max_attempts=RETRY_MAX_ATTEMPTS,
+    retry_base_seconds=RETRY_BASE_DELAY_SECONDS,
+)
+prioritizer = EmailPrioritizer(
+    risk_lookup=SupplierRiskCache().risk_score,
+    risk_threshold=PRIORITY_RISK_THRESHOLD,
+    amount_threshold=PRIORITY_AMOUNT_THRESHOLD,
+)
 
-    if not stm.get("original_clean_text"):
-        stm["original_clean_text"] = processed_email.get("clean_text")
 
+async def _speculate_claim(processed: dict) -> Speculation:
+    speculation = Speculation("claim", extract_dispute_claim, dict(processed))
+    _launched_claims[processed.get("email_id")] = speculation
+    return speculation
 
-async def run_in_thread(func, *args, **kwargs):
-    """Helper to run blocking functions in a thread pool."""
-    return await asyncio.to_thread(func, *args, **kwargs)
 
+def _hand_off_claim(claim_speculation: Speculation, decision: dict, attachment_text: str | None) -> None:
+    email_id = decision.get("email_id")
+    if decision["classification"] != "DISPUTE":
+        reason = decision["classification"]
+    elif attachment_text:
+        # The claim must be read with the attachment text, which it lacked.
+        reason = "attachments added"
+    else:
+        return
+    if _launched_claims.pop(email_id, None) is claim_speculation:
+        claim_speculation.discard(reason)
+
+
+async def _submit_dispute(processed: dict, decision: dict) -> None:
+    """Queue the dispute job, handing it the speculative claim if this run kept one."""
+    email_id = processed.get("email_id")
+    speculation = _launched_claims.pop(email_id, None)
+    if speculation:
+        # In place before the job can start, so it never misses the claim.
+        _speculative_claims[email_id] = speculation
+    submitted = False
+    try:
+        submitted = await dispute_executor.submit(processed, decision)
+    finally:
+        # Not queued (failed, timed out, or already in hand elsewhere): no job will take it.
+        if not submitted and speculation and _speculative_claims.get(email_id) is speculation:
+            del _speculative_claims[email_id]
+            speculation.discard("dispute not submitted")
+
+
+def _looks_like_dispute(context: dict) -> bool:
+    return bool(DISPUTE_HINTS.search(context["processed"].get("clean_text") or ""))
+
+
+pipeline = PipelineEngine(
+    build_email_graph(
+        EmailFlowConfig(
+            stm_retention="keep",
+            clarification="drafter",
+            context_resolution=True,
+            speculative=SPECULATIVE_EXECUTION,
+            attachments=True,
+            checkpoint=True,
+            llm_concurrency=LLM_STAGE_CONCURRENCY,
+            stage_timeout=STAGE_TIMEOUT_SECONDS,
+        ),
+        stm_manager,
+        mailer,
+        resolve_dispute=_submit_dispute,
+        extra_stages=[
+            Stage(
+                "speculate_claim", _speculate_claim, inputs=("processed",),
+                outputs=("claim_speculation",), when=_looks_like_dispute,
+            ),
+            Stage(
+                "hand_off_claim", _hand_off_claim,
+                inputs=("claim_speculation", "decision", "attachment_text"),
+                when=lambda c: c.get("claim_speculation") is not None, executor="inline",
+            ),
+        ] if SPECULATIVE_EXECUTION else [],
+        name="email-triage-async",
+    ),
+    executor="async",
+    checkpoints=stage_checkpoints,
+    budget_seconds=EMAIL_DEADLINE_SECONDS,
+)
 
-async def resolve_and_persist_dispute_async(processed_email: dict, decision: dict) -> None:
+
+@asynccontextmanager
+async def shard_lifespan():
+    """Per-process setup for ShardedWorkerPool: each shard resolves its own disputes."""
+    dispute_executor.start()
+    # Job leases keep this from taking over jobs other shards still hold;
+    # after a crash it picks up what the dead shard left behind.
+    recovered = await dispute_executor.recover()
+    if recovered:
+        print(f"Recovered {recovered} unfinished dispute resolutions")
     try:
-        claim = await run_in_thread(extract_dispute_claim, processed_email)
-        result = await run_in_thread(
-            resolve_dispute_case,
-            processed_email,
-            claim,
-            decision.get("confidence", 0.0),
-        )
-        printable = {
-            "dispute_valid": result.dispute_valid,
-            "resolution_reason": result.resolution_reason,
-            "supplier_id": result.supplier_id,
-            "invoice_id": result.invoice_id,
-            "invoice_number": result.invoice_number,
-            "claimed_amount": str(result.claimed_amount) if result.claimed_amount is not None else None,
-            "sap_amount": str(result.sap_amount) if result.sap_amount is not None else None,
-            "dispute_case_id": result.dispute_case_row.get("case_id") if result.dispute_case_row else None,
-            "ltm_snapshot": result.supplier_ltm_row,
+        yield lambda: {
+            "pipeline": pipeline.metrics(),
+            "dispute_executor": dispute_executor.metrics(),
+            "speculation": speculation_stats(),
+            "breakers": breaker_metrics(),
+            "single_flight": single_flight_metrics(),
         }
-        print("\nDISPUTE RESOLUTION RESULT (ASYNC)")
-        print(json.dumps(printable, indent=2, default=str))
-    except Exception as exc:
-        print("Failed to resolve dispute (async):", exc)
+    finally:
+        try:
+            await asyncio.wait_for(dispute_executor.drain(), timeout=DISPUTE_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            print("Dispute executor still busy; leaving remaining jobs for recovery.")
+        await dispute_executor.stop()
 
 
 async def process_email_async(email: dict) -> str | None:
+    if email.get("prefiltered"):
+        print(f"[{email.get('email_id')}] Skipped by header filter: {email['prefiltered']}")
+        return "SYSTEM"
+    # Every email needs OpenAI; while it is failing, park the email in the
+    # retry queue instead of running the stages that do not.
+    check_breakers("openai")
+
     print("=" * 80)
     print("RAW EMAIL")
     print(json.dumps(email, indent=2))
+    try:
+        context = await pipeline.run_async(run_id=email.get("email_id"), email=email)
+    finally:
+        # A run that failed or ended before its dispute was queued leaves its claim here.
+        speculation = _launched_claims.pop(email.get("email_id"), None)
+        if speculation:
+            speculation.discard("run ended before dispute")
+    print("=" * 80, "\n")
+    return context.get(RESULT_KEY)
+
+
+def _ordering_key(email: dict) -> tuple[str | None, str | None, dict | None]:
+    """
+    (conversation key, supplier, conversation STM) used to order work. Emails of one
+    conversation must not overlap: a supplier's reply has to see the
+    pending_question its AMBIGUOUS predecessor stored. The conversation is
+    the Gmail thread, or the STM thread the supplier already has open, using
+    the same lookups context resolution starts with.
+    """
+    _, supplier = parseaddr(email.get("from") or "")
+    supplier = supplier.lower() or None
+    thread_id = email.get("thread_id")
+    stm = stm_manager.get(thread_id) if thread_id else None
+    if stm:
+        return thread_id, supplier, stm
+    if supplier:
+        stm = stm_manager.find_active_by_supplier_email(supplier)
+        if stm and stm.get("thread_id"):
+            return stm["thread_id"], supplier, stm
+    return thread_id, supplier, None
 
-    # Resolve conversational context using STM, similarity, and an AI agent before dispute classification.
-    context_outcome: ContextResolutionOutcome = await run_in_thread(
-        resolve_conversational_context,
-        email,
-        stm_manager,
-    )
-    context_log = {
-        "email_id": email.get("email_id"),
-        "stm_found": bool(context_outcome.stm),
-        "similarity_score": context_outcome.similarity_score,
-        "decision": context_outcome.decision,
-    }
-    email["resolved_context"] = {
-        "decision": context_outcome.decision,
-        "similarity_score": context_outcome.similarity_score,
-        "notes": context_outcome.notes,
-        "stm_thread_id": context_outcome.stm.get("thread_id") if context_outcome.stm else None,
-    }
-    conversation_thread_id = (
-        context_outcome.stm.get("thread_id")
-        if context_outcome.stm and context_outcome.stm.get("thread_id")
-        else email.get("thread_id")
-    )
-    email["conversation_thread_id"] = conversation_thread_id
-
-    for key, value in (context_outcome.inherited_fields or {}).items():
-        if value and not email.get(key):
-            email[key] = value
-    print(f"[{context_log['email_id']}] Context resolution -> "
-          f"STM: {context_log['stm_found']}, "
-          f"similarity: {context_log['similarity_score']}, "
-          f"decision: {context_log['decision']}")
-    if context_outcome.skip_classification:
-        print(f"[{context_log['email_id']}] Context agent marked NO_OP; skipping classification.")
-        return "NO_OP"
-
-    processed = await run_in_thread(preprocess_email_llm, email)
-    processed["message_id_header"] = email.get("message_id_header")
-    processed["gmail_thread_id"] = processed.get("thread_id")
-    if conversation_thread_id:
-        processed["thread_id"] = conversation_thread_id
-    processed["resolved_context"] = email.get("resolved_context")
-    for key in ("supplier_email_id", "supplier_id"):
-        inherited_value = context_outcome.inherited_fields.get(key)
-        if inherited_value and not processed.get(key):
-            processed[key] = inherited_value
-    print("\nPREPROCESSED")
-    print(json.dumps(processed, indent=2))
-
-    if processed["sender_type"] == "SYSTEM":
-        print("Skipping SYSTEM email")
-        print("=" * 80, "\n")
-        return "SYSTEM"
 
-    thread_id = processed["thread_id"]
-    if context_outcome.stm and context_outcome.stm.get("thread_id") != thread_id:
-        thread_id = context_outcome.stm.get("thread_id")
-        processed["thread_id"] = thread_id
-    stm = context_outcome.stm or await run_in_thread(stm_manager.get, thread_id)
+async def main():
+    seen_email_ids: set[str] = set()
+    processed_store = stm_manager.backend
+    source = get_mail_source()
+    if not source.labels_supported and not isinstance(mailer, RecordingMailer):
+        raise RuntimeError(f"{source.name} mail source needs the recording mailer; check MAIL_SOURCE")
+    gmail_service = None
+    # Label IDs differ per mailbox: mailbox name -> {"PROCESSED"|"NON_DISPUTE"|"DISPUTE": label ID}
+    mailbox_services: dict[str, object] = {}
+    mailbox_labels: dict[str, dict[str, str]] = {}
+    mailboxes = source.mailboxes or ((get_mailbox(),) if source.labels_supported else ())
+    for mailbox in mailboxes:
+        service = mailbox.service
+        label_ids = resolve_label_ids(
+            service,
+            mailbox.label_names,
+            cache=stm_manager.redis,
+            cache_key=mailbox.label_cache_key,
+        )
+        mailbox_services[mailbox.name] = service
+        mailbox_labels[mailbox.name] = {
+            "PROCESSED": label_ids[mailbox.processed_label],
+            "NON_DISPUTE": label_ids[mailbox.non_dispute_label],
+            "DISPUTE": label_ids[mailbox.dispute_label],
+        }
+    if mailboxes:
+        gmail_service = mailbox_services[mailboxes[0].name]
+        print("Mailboxes:", ", ".join(mailbox.name for mailbox in mailboxes))
+    committer = PollCommitter(
+        gmail_service, processed_store, PROCESSED_SET_KEY, mailbox_services=mailbox_services
+    )
 
-    resolving_ambiguity = (
-        stm
-        and stm.get("state") == "AWAITING_CLARIFICATION"
-        and stm.get("pending_question")
+    notifier = None
+    if INGESTION_MODE == "push" and source.labels_supported:
+        notifier = PushNotifier(
+            port=int(os.getenv("PUSH_PORT", DEFAULT_PUSH_PORT)),
+            verification_token=os.getenv("PUSH_VERIFICATION_TOKEN"),
+        )
+        notifier.start()
+    topic = os.getenv("GMAIL_PUBSUB_TOPIC") if notifier else None
+    # Push notifications only carry a historyId, so push implies incremental sync.
+    incremental = INCREMENTAL_SYNC or notifier is not None
+    scheduler = AdaptivePollScheduler(
+        base_interval=POLL_INTERVAL_SECONDS,
+        max_interval=MAX_POLL_INTERVAL_SECONDS,
+        max_batch=MAX_FETCH_BATCH,
+        fetch_batch=source.fetch_batch,
     )
 
-    if resolving_ambiguity and stm:
-        context_text = (
-            f"Original email:\n{stm.get('original_clean_text', '')}\n\n"
-            f"Clarification question sent:\n{stm.get('pending_question', '')}\n\n"
-            f"Supplier reply:\n{processed['clean_text']}"
+    stream = None
+    lease = None
+    if WORK_QUEUE == "redis-streams":
+        redis_client = get_redis_client()
+        stream = WorkStream(redis_client)
+        stream.ensure_group()
+        lease = PollerLease(redis_client)
+    retry_queue = None
+    if stm_manager.redis is not None:
+        retry_queue = RetryQueue(
+            stm_manager.redis,
+            max_attempts=RETRY_MAX_ATTEMPTS,
+            base_delay=RETRY_BASE_DELAY_SECONDS,
         )
-        contextual_email = dict(processed)
-        contextual_email["clean_text"] = context_text
-
-        decision = await run_in_thread(detect_dispute, contextual_email)
-        print("\nDISPUTE DETECTION RESULT (ASYNC CONTEXTUAL)")
-        print(json.dumps(decision, indent=2))
-
-        now = datetime.now(timezone.utc).isoformat()
-        email_trail = stm.get("email_trail") or []
-        email_trail.append({
-            "email_id": processed["email_id"],
-            "message_id_header": processed.get("message_id_header"),
-            "timestamp": now,
-            "classification": decision["classification"],
-            "summary": decision["reason"]
-        })
-
-        stm["email_trail"] = email_trail
-        stm["last_classification"] = decision["classification"]
-        stm["confidence"] = decision["confidence"]
-        stm["last_updated"] = now
-        stm["pending_question"] = None
-
-        if decision["classification"] == "NON_DISPUTE":
-            stm["state"] = "RESOLVED_NON_DISPUTE"
-            await run_in_thread(stm_manager.create_or_update, stm)
-            print("=" * 80, "\n")
-            return "NON_DISPUTE"
-
-        if decision["classification"] == "DISPUTE":
-            stm["state"] = "RESOLVED_DISPUTE"
-            await run_in_thread(stm_manager.create_or_update, stm)
-            await resolve_and_persist_dispute_async(processed, decision)
-            print("=" * 80, "\n")
-            return "DISPUTE"
-
-        await run_in_thread(stm_manager.create_or_update, stm)
-        print("=" * 80, "\n")
-        return decision["classification"]
-
-    decision = await run_in_thread(detect_dispute, processed)
-    print("\nDISPUTE DETECTION RESULT (ASYNC)")
-    print(json.dumps(decision, indent=2))
-
-    if decision["classification"] == "NON_DISPUTE":
-        reason = decision.get("reason") or "UNSPECIFIED_REASON"
-        if not stm:
-            stm = _bootstrap_stm_from_email(
-                processed,
-                decision["classification"],
-                reason,
-                "RESOLVED_NON_DISPUTE",
-                decision.get("confidence"),
-                thread_id,
-            )
-        else:
-            _append_email_trail_entry(stm, processed, decision["classification"], reason)
-            stm["state"] = "RESOLVED_NON_DISPUTE"
-        stm["last_classification"] = decision["classification"]
-        stm["confidence"] = decision["confidence"]
-        await run_in_thread(stm_manager.create_or_update, stm)
-        print("=" * 80, "\n")
-        return "NON_DISPUTE"
-
-    if decision["classification"] == "DISPUTE":
-        reason = decision.get("reason") or "UNSPECIFIED_REASON"
-        if not stm:
-            stm = _bootstrap_stm_from_email(
-                processed,
-                decision["classification"],
-                reason,
-                "RESOLVED_DISPUTE",
-                decision.get("confidence"),
-                thread_id,
-            )
+    else:
+        print("No Redis STM backend; failed emails will not be retried.")
+    # email_id -> stream entry still being worked on by this process
+    stream_entries: dict[str, str] = {}
+    # (email, stream entry, error) of finished emails, settled by _commit.
+    finished: list[tuple[dict, str | None, Exception | None]] = []
+
+    def _on_email_done(email: dict, result) -> None:
+        email_id = email["email_id"]
+        error = result if isinstance(result, Exception) else None
+        finished.append((email, stream_entries.pop(email_id, None), error))
+        if error:
+            print(f"[{email_id}] Error processing email:", error)
+            return
+        committer.mark_processed(email_id)
+        if not source.labels_supported:
+            return
+        mailbox = email.get("mailbox")
+        label_ids = mailbox_labels.get(mailbox) or mailbox_labels[mailboxes[0].name]
+        labels_to_add = [label_ids["PROCESSED"]]
+        if result in ("NON_DISPUTE", "DISPUTE"):
+            labels_to_add.append(label_ids[result])
+        committer.add_labels(email_id, labels_to_add, mailbox=mailbox)
+
+    if WORKER_PROCESSES > 1:
+        pool = ShardedWorkerPool(
+            process_email_async,
+            _on_email_done,
+            processes=WORKER_PROCESSES,
+            workers=WORKER_COUNT,
+            max_queue=WORKER_QUEUE_SIZE,
+            aging_seconds=PRIORITY_AGING_SECONDS,
+            lifespan=shard_lifespan,
+            # Outlast shard_lifespan's dispute drain so writes are not killed mid-transaction.
+            stop_timeout=DISPUTE_DRAIN_SECONDS + 15,
+        )
+    else:
+        pool = EmailWorkerPool(
+            process_email_async,
+            _on_email_done,
+            workers=WORKER_COUNT,
+            max_queue=WORKER_QUEUE_SIZE,
+            aging_seconds=PRIORITY_AGING_SECONDS,
+        )
+    queue_capacity = WORKER_QUEUE_SIZE * WORKER_PROCESSES
+    scheduler.queue_depth = pool.depth
+
+    async def _route(email: dict) -> tuple[str | None, str | None, int]:
+        thread_key, supplier, stm = await run_in_thread(_ordering_key, email)
+        priority, reason = await run_in_thread(prioritizer.priority, email, stm, supplier)
+        if priority < PRIORITY_NORMAL:
+            print(f"[{email['email_id']}] Prioritised: {reason}")
+        return thread_key, supplier, priority
+
+    async def _submit(email: dict, route: tuple[str | None, str | None, int] | None = None) -> None:
+        thread_key, supplier, priority = route or await _route(email)
+        # Blocks while the queue is full, throttling the caller.
+        await pool.submit(email, key=thread_key, group=supplier, priority=priority)
+
+    async def _schedule_retry(email: dict, error: Exception) -> bool:
+        email_id = email["email_id"]
+        if retry_queue is None:
+            committer.mark_processed(email_id)
+            return True
+        try:
+            if isinstance(error, CircuitOpen):
+                outcome = await run_in_thread(retry_queue.park, email, error, error.retry_after)
+            else:
+                outcome = await run_in_thread(retry_queue.schedule, email, error)
+        except Exception as exc:
+            print(f"[{email_id}] Failed to schedule retry:", exc)
+            return False
+        if outcome == "parked":
+            print(f"[{email_id}] Parked: {error}")
+        elif outcome == "dead":
+            print(f"[{email_id}] Retries exhausted; moved to the dead-letter list")
         else:
-            _append_email_trail_entry(stm, processed, decision["classification"], reason)
-            stm["state"] = "RESOLVED_DISPUTE"
-        stm["last_classification"] = decision["classification"]
-        stm["confidence"] = decision["confidence"]
-        await run_in_thread(stm_manager.create_or_update, stm)
-        await resolve_and_persist_dispute_async(processed, decision)
-        print("=" * 80, "\n")
-        return "DISPUTE"
-
-    if decision["classification"] == "AMBIGUOUS":
-        now = datetime.now(timezone.utc).isoformat()
-        stm = stm or {
-            "thread_id": thread_id,
-            "supplier_id": processed["supplier_id"],
-            "supplier_email_ids": [processed["supplier_email_id"]],
-            "state": "AWAITING_CLARIFICATION",
-            "email_trail": [],
-            "original_clean_text": processed.get("clean_text"),
-            "pending_question": None,
-            "last_classification": decision["classification"],
-            "confidence": decision["confidence"],
-            "created_at": now,
-            "last_updated": now
-        }
+            print(f"[{email_id}] Scheduled retry (attempt {email.get('retry_attempts', 0) + 2})")
+        # The retry queue owns the email now; stop the poller refetching it.
+        committer.mark_processed(email_id)
+        return True
+
+    async def _settle_history(emails: list[dict]) -> None:
+        # Tell incremental sync these no longer need fetching; see sync_history.
+        if not (incremental and source.labels_supported) or not emails:
+            return
+        by_cursor: dict[str, list[str]] = {}
+        for email in emails:
+            cursor_key = get_mailbox(email.get("mailbox")).history_cursor_key
+            by_cursor.setdefault(cursor_key, []).append(email["email_id"])
+        for cursor_key, email_ids in by_cursor.items():
+            await run_in_thread(settle_history, get_redis_client(), email_ids, cursor_key)
+
+    async def _commit() -> None:
+        batch = finished[:]
+        del finished[:len(batch)]
+        committed = []
+        for item in batch:
+            email, _entry_id, error = item
+            if error and not await _schedule_retry(email, error):
+                finished.append(item)
+                continue
+            committed.append(item)
+        try:
+            await run_in_thread(committer.flush)
+        except Exception as exc:
+            finished.extend(committed)
+            print("Failed to commit poll results:", exc)
+            return
+        # Only once the processed mark is durable: a crash in between leaves
+        # the checkpoints and the pending stream entry for the retry. Failed
+        # emails keep their checkpoints so the retry resumes where they stopped.
+        try:
+            succeeded = [email["email_id"] for email, _, error in committed if not error]
+            if succeeded:
+                await run_in_thread(stage_checkpoints.clear, *succeeded)
+            for email, entry_id, error in committed:
+                if retry_queue and not error and "retry_attempts" in email:
+                    await run_in_thread(retry_queue.complete, email["email_id"])
+                if entry_id:
+                    await run_in_thread(stream.ack, entry_id, email["email_id"])
+            await _settle_history([email for email, _, _ in committed])
+        except Exception as exc:
+            print("Failed to settle committed emails:", exc)
+
+    async def _commit_loop() -> None:
+        while True:
+            await asyncio.sleep(COMMIT_INTERVAL_SECONDS)
+            await _commit()
 
-        email_ids = {e["email_id"] for e in stm["email_trail"]}
-        if processed["email_id"] not in email_ids:
-            stm["email_trail"].append({
-                "email_id": processed["email_id"],
-                "message_id_header": processed.get("message_id_header"),
-                "timestamp": now,
-                "classification": decision["classification"],
-                "summary": decision["reason"]
-            })
-
-        if processed["supplier_email_id"] not in stm.get("supplier_email_ids", []):
-            stm["supplier_email_ids"] = stm.get("supplier_email_ids", [])
-            stm["supplier_email_ids"].append(processed["supplier_email_id"])
-
-        stm["last_classification"] = decision["classification"]
-        stm["confidence"] = decision["confidence"]
-        stm["last_updated"] = now
-
-        await run_in_thread(stm_manager.create_or_update, stm)
-
-        if not stm.get("pending_question"):
-            draft = await run_in_thread(
-                draft_clarification_email,
-                processed,
-                decision["reason"],
-                decision["confidence"]
-            )
-            print("\nCLARIFICATION DRAFT OUTPUT (ASYNC)")
-            print(json.dumps(draft, indent=2))
-        else:
-            draft = {
-                "clarification_question": stm["pending_question"],
-                "body_text": stm.get("pending_draft_body")
-            }
-
-        refreshed_stm = await run_in_thread(stm_manager.get, thread_id)
-        if (
-            refreshed_stm
-            and refreshed_stm.get("state") == "AWAITING_CLARIFICATION"
-            and refreshed_stm.get("pending_question")
-            and not refreshed_stm.get("clarification_sent_at")
-        ):
-            email_trail = refreshed_stm.get("email_trail")
-            first_email = email_trail[0]
-            result = await run_in_thread(
-                mailer.send_clarification,
-                thread_id=thread_id,
-                original_email_id=first_email.get("email_id"),
-                supplier_email_id=refreshed_stm["supplier_email_ids"][0],
-                original_subject=processed["clean_text"].split("\n")[0],
-                clarification_question=refreshed_stm["pending_question"],
-                original_message_id_header=first_email.get("message_id_header"),
-                body_text=refreshed_stm.get("pending_draft_body"),
+    async def _poll_loop() -> None:
+        watch_expires_ms = {name: 0 for name in mailbox_services}
+        while True:
+            if lease and not lease.held:
+                await asyncio.sleep(LEASE_RETRY_SECONDS)
+                continue
+            # Gmail drops a watch after 7 days; renew a day ahead of expiry.
+            # Every mailbox publishes to the same topic; any change wakes the poll.
+            for name, service in mailbox_services.items():
+                if topic and time.time() * 1000 > watch_expires_ms[name] - 86_400_000:
+                    watch = start_watch(service, topic)
+                    watch_expires_ms[name] = int(watch.get("expiration", 0))
+                    print(f"Gmail watch for {name} registered until", watch_expires_ms[name])
+            if not stream and pool.depth() >= queue_capacity:
+                # Nothing fetched now could be queued; wait for a free slot.
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                emails = await run_in_thread(
+                    scheduler.fetch_emails, incremental=incremental, two_phase=TWO_PHASE_FETCH
+                )
+            except CircuitOpen as exc:
+                print("Skipping poll:", exc)
+                await asyncio.sleep(exc.retry_after)
+                continue
+            unseen = [e for e in emails if e["email_id"] not in seen_email_ids]
+            already_processed = processed_store.smismember(
+                PROCESSED_SET_KEY, *(e["email_id"] for e in unseen)
             )
-            print("Clarification email result (async):", result)
-
-    print("=" * 80, "\n")
-    return decision["classification"]
-
+            new_emails = [e for e, done in zip(unseen, already_processed) if not done]
+            scheduler.record_new(len(new_emails))
+            try:
+                await _settle_history([e for e, done in zip(unseen, already_processed) if done])
+            except Exception as exc:
+                print("Failed to settle already processed emails:", exc)
+
+            for email in new_emails:
+                seen_email_ids.add(email["email_id"])
+            if stream:
+                for email in new_emails:
+                    await run_in_thread(stream.publish, email)
+            else:
+                # Submit urgent mail first: once the queue is full, later
+                # emails wait in submit and cannot overtake what is queued.
+                routes = [await _route(email) for email in new_emails]
+                ranked = sorted(zip(new_emails, routes), key=lambda item: item[1][2])
+                for email, route in ranked:
+                    await _submit(email, route)
 
-async def main():
-    seen_email_ids: set[str] = set()
-    redis_client = stm_manager.redis
-    gmail_service = get_gmail_service()
-    processed_label_id = get_or_create_label(gmail_service, PROCESSED_LABEL_NAME)
-    non_dispute_label_id = get_or_create_label(gmail_service, NON_DISPUTE_LABEL_NAME)
-    dispute_label_id = get_or_create_label(gmail_service, DISPUTE_LABEL_NAME)
+            if new_emails:
+                print("Poll scheduler:", json.dumps(scheduler.metrics()))
+                print("Worker pool:", json.dumps(pool.metrics()))
+                print("Dispute executor:", json.dumps(dispute_executor.metrics()))
+                print("Priorities:", json.dumps(prioritizer.metrics()))
+                print("Circuit breakers:", json.dumps(breaker_metrics()))
+                # Sharded, these live in each process and arrive with the pool metrics.
+                if WORKER_PROCESSES == 1:
+                    print("Pipeline:", json.dumps(pipeline.metrics()))
+                    print("Single flight:", json.dumps(single_flight_metrics()))
+                    if SPECULATIVE_EXECUTION:
+                        print("Speculation:", json.dumps(speculation_stats()))
+                print("Body cleanup:", json.dumps(body_stats()))
+            if scheduler.more_pending and new_emails:
+                continue
+            if notifier:
+                await notifier.wait(timeout=PUSH_FALLBACK_SECONDS)
+            else:
+                await scheduler.wait()
+
+    async def _retry_loop() -> None:
+        while True:
+            await asyncio.sleep(RETRY_CHECK_SECONDS)
+            try:
+                due = await run_in_thread(retry_queue.claim_due, queue_capacity - pool.depth())
+            except Exception as exc:
+                print("Failed to read the retry queue:", exc)
+                continue
+            for email in due:
+                print(f"[{email['email_id']}] Retrying after {email['retry_attempts']} failed attempt(s)")
+                await _submit(email)
+
+    async def _lease_loop() -> None:
+        while True:
+            was_leader = lease.held
+            try:
+                await run_in_thread(lease.acquire_or_renew)
+            except Exception as exc:
+                lease.held = False
+                print("Poller lease check failed:", exc)
+            if lease.held != was_leader:
+                print("Poller lease", "acquired" if lease.held else "lost")
+            await asyncio.sleep(lease.ttl_ms / 3000)
+
+    async def _accept_entries(entries: list[tuple[str, dict]]) -> None:
+        emails = [email for _entry_id, email in entries]
+        already_processed = processed_store.smismember(
+            PROCESSED_SET_KEY, *(e["email_id"] for e in emails)
+        )
+        for (entry_id, email), done in zip(entries, already_processed):
+            if done:
+                # Finished before its consumer died, just never acknowledged.
+                stream.ack(entry_id, email["email_id"])
+                continue
+            stream_entries[email["email_id"]] = entry_id
+            await _submit(email)
+
+    async def _consume_loop() -> None:
+        while True:
+            capacity = queue_capacity - pool.depth()
+            if capacity <= 0:
+                await asyncio.sleep(0.5)
+                continue
+            entries = await run_in_thread(stream.read, capacity)
+            await _accept_entries(entries)
+
+    async def _reclaim_loop() -> None:
+        while True:
+            await asyncio.sleep(RECLAIM_INTERVAL_SECONDS)
+            # Entries queued in our pool can wait longer than STALE_ENTRY_MS;
+            # keep them fresh so other consumers do not take them over.
+            try:
+                await run_in_thread(stream.touch, list(stream_entries.values()))
+            except Exception as exc:
+                print("Failed to refresh held stream entries:", exc)
+            try:
+                entries = await run_in_thread(stream.reclaim, STALE_ENTRY_MS)
+            except Exception as exc:
+                print("Failed to reclaim stale stream entries:", exc)
+                continue
+            # Our own long-running entries show up too; they are still in flight.
+            entries = [(i, e) for i, e in entries if e["email_id"] not in stream_entries]
+            if entries:
+                print(f"Reclaimed {len(entries)} stale stream entries")
+                await _accept_entries(entries)
+
+    pool.start()
+    dispute_executor.start()
+    recovered = await dispute_executor.recover()
+    if recovered:
+        print(f"Recovered {recovered} unfinished dispute resolutions")
+    tasks = [asyncio.create_task(_commit_loop())]
+    if RUN_POLLER:
+        tasks.append(asyncio.create_task(_poll_loop()))
+    if retry_queue:
+        tasks.append(asyncio.create_task(_retry_loop()))
+    if stream:
+        tasks.append(asyncio.create_task(_lease_loop()))
+        tasks.append(asyncio.create_task(_consume_loop()))
+        tasks.append(asyncio.create_task(_reclaim_loop()))
 
     print("Starting async processor. Press Ctrl+C to stop.")
     try:
-        while True:
-            emails = fetch_emails(limit=10)
-            new_emails = []
-            for e in emails:
-                email_id = e["email_id"]
-                if email_id in seen_email_ids:
-                    continue
-                if redis_client.sismember(PROCESSED_SET_KEY, email_id):
-                    continue
-                new_emails.append(e)
-
-            if new_emails:
-                tasks = []
-                for email in new_emails:
-                    seen_email_ids.add(email["email_id"])
-                    tasks.append(asyncio.create_task(process_email_async(email)))
-
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                for email, result in zip(new_emails, results):
-                    email_id = email["email_id"]
-                    redis_client.sadd(PROCESSED_SET_KEY, email_id)
-                    if isinstance(result, Exception):
-                        print("Error processing email:", result)
-                        continue
-                    labels_to_add = [processed_label_id]
-                    if result == "NON_DISPUTE":
-                        labels_to_add.append(non_dispute_label_id)
-                    if result == "DISPUTE":
-                        labels_to_add.append(dispute_label_id)
-                    try:
-                        mark_labels(
-                            service=gmail_service,
-                            message_id=email_id,
-                            add_label_ids=labels_to_add
-                        )
-                    except Exception as exc:
-                        print("Failed to mark labels:", exc)
-            await asyncio.sleep(10)
-    except KeyboardInterrupt:
+        await asyncio.gather(*tasks)
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print("\nStopping async processor.")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await pool.stop()
+        try:
+            # Unfinished jobs are persisted and recovered on the next start.
+            await asyncio.wait_for(dispute_executor.drain(), timeout=DISPUTE_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            print("Dispute executor still busy; leaving remaining jobs for recovery.")
+        await dispute_executor.stop()
+        await _commit()
+        if lease:
+            lease.release()
+        if notifier:
+            notifier.stop()
 
 
 if __name__ == "__main__":
@@ -3,7 +3,7 @@ from pathlib import Path
 from datetime import datetime, timezone
 from typing import Any
 
-from src.utils.llm_client import get_default_model, get_openai_client
+from src.utils.llm_client import get_default_model, get_openai_client, llm_timeout, openai_breaker, record_usage
 from src.agents.stm_manager import STMManager
 
 DEFAULT_MODEL = get_default_model()
@@ -51,11 +51,14 @@ def resolve_ambiguity(
         .replace("<<<CONFIDENCE>>>", str(confidence))
     )
 
-    response = client.chat.completions.create(
-        model=DEFAULT_MODEL,
-        messages=[{"role": "user", "content": filled_prompt}],
-        temperature=0
-    )
+    with openai_breaker.guard():
+        response = client.chat.completions.create(
+            model=DEFAULT_MODEL,
+            messages=[{"role": "user", "content": filled_prompt}],
+            temperature=0,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
 
     message_content = response.choices[0].message.content
     if message_content is None:
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import base64
+import csv
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from src.agents.gmail_watcher import get_gmail_service
+from src.agents.mailboxes import get_mailbox
+
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(5 * 1024 * 1024)))
+MAX_ATTACHMENT_TEXT_CHARS = int(os.getenv("MAX_ATTACHMENT_TEXT_CHARS", "8000"))
+CACHE_MAX_ENTRIES = 256
+
+PDF_TYPES = {"application/pdf"}
+CSV_TYPES = {"text/csv", "application/csv"}
+XLSX_TYPES = {"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+
+_cache: OrderedDict[str, str] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _kind(attachment: dict) -> str | None:
+    mime_type = (attachment.get("mime_type") or "").lower()
+    filename = (attachment.get("filename") or "").lower()
+    if mime_type in PDF_TYPES or filename.endswith(".pdf"):
+        return "pdf"
+    if mime_type in CSV_TYPES or filename.endswith(".csv"):
+        return "csv"
+    if mime_type in XLSX_TYPES or filename.endswith(".xlsx"):
+        return "xlsx"
+    return None
+
+
+def _pdf_text(data: bytes, limit: int) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        print("pypdf not installed; skipping PDF attachment")
+        return ""
+    chunks: list[str] = []
+    size = 0
+    # Page by page, so a long statement stops parsing once the cap is reached.
+    for page in PdfReader(io.BytesIO(data)).pages:
+        text = page.extract_text() or ""
+        chunks.append(text)
+        size += len(text)
+        if size >= limit:
+            break
+    return "\n".join(chunks)[:limit]
+
+
+def _csv_text(data: bytes, limit: int) -> str:
+    lines: list[str] = []
+    size = 0
+    reader = csv.reader(io.StringIO(data.decode("utf-8-sig", errors="ignore")))
+    for row in reader:
+        line = " | ".join(cell.strip() for cell in row)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= limit:
+            break
+    return "\n".join(lines)[:limit]
+
+
+def _xlsx_text(data: bytes, limit: int) -> str:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        print("openpyxl not installed; skipping XLSX attachment")
+        return ""
+    # read_only streams rows instead of loading the whole sheet tree.
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    lines: list[str] = []
+    size = 0
+    try:
+        for sheet in workbook.worksheets:
+            lines.append(f"[{sheet.title}]")
+            for row in sheet.iter_rows(values_only=True):
+                cells = [str(value) for value in row if value is not None]
+                if not cells:
+                    continue
+                line = " | ".join(cells)
+                lines.append(line)
+                size += len(line) + 1
+                if size >= limit:
+                    return "\n".join(lines)[:limit]
+    finally:
+        workbook.close()
+    return "\n".join(lines)[:limit]
+
+
+_EXTRACTORS = {"pdf": _pdf_text, "csv": _csv_text, "xlsx": _xlsx_text}
+
+
+def _cache_key(email: dict, attachment: dict) -> str:
+    # Gmail reissues attachmentId on every messages.get, so the stable
+    # identity of an attachment is its mailbox, message and MIME part.
+    part = attachment.get("part_id") or attachment.get("attachment_id")
+    return f"{email.get('mailbox') or ''}:{email['email_id']}:{part}"
+
+
+def _service_for(email: dict):
+    """Gmail client of the mailbox the email was fetched from."""
+    if email.get("mailbox"):
+        return get_mailbox(email["mailbox"]).service
+    return get_gmail_service()
+
+
+def _download(service, email_id: str, attachment_id: str) -> bytes:
+    response = service.users().messages().attachments().get(
+        userId="me", messageId=email_id, id=attachment_id
+    ).execute()
+    return base64.urlsafe_b64decode(response.get("data", ""))
+
+
+def extract_attachment_text(email: dict, service=None, limit: int = MAX_ATTACHMENT_TEXT_CHARS) -> str:
+    """
+    Text of the email's PDF/CSV/XLSX attachments, at most `limit` chars in
+    total. Attachments over MAX_ATTACHMENT_BYTES are skipped without being
+    downloaded, and results are cached per attachment so retries are free.
+    Without `service`, attachments are downloaded from the email's mailbox.
+    """
+    attachments = [a for a in email.get("attachments") or [] if _kind(a)]
+    if not attachments:
+        return ""
+
+    sections: list[str] = []
+    remaining = limit
+    for attachment in attachments:
+        if remaining <= 0:
+            break
+        if attachment.get("size", 0) > MAX_ATTACHMENT_BYTES:
+            print(f"Skipping oversized attachment {attachment.get('filename')}")
+            continue
+
+        key = _cache_key(email, attachment)
+        with _cache_lock:
+            text = _cache.get(key)
+            if text is not None:
+                _cache.move_to_end(key)
+
+        if text is None:
+            try:
+                service = service or _service_for(email)
+                data = _download(service, email["email_id"], attachment["attachment_id"])
+                text = _EXTRACTORS[_kind(attachment)](data[:MAX_ATTACHMENT_BYTES], limit)
+            except Exception as exc:
+                print(f"Failed to extract attachment {attachment.get('filename')}:", exc)
+                continue
+            with _cache_lock:
+                _cache[key] = text
+                while len(_cache) > CACHE_MAX_ENTRIES:
+                    _cache.popitem(last=False)
+
+        if text:
+            text = text[:remaining]
+            sections.append(f"--- Attachment: {attachment.get('filename')} ---\n{text}")
+            remaining -= len(text)
+
+    return "\n\n".join(sections)
@@ -5,7 +5,7 @@ from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 
-from src.utils.llm_client import get_default_model, get_openai_client
+from src.utils.llm_client import get_default_model, get_openai_client, llm_timeout, openai_breaker, record_usage
 from src.agents.stm_manager import STMManager
 
 OPENAI_MODEL = get_default_model()
@@ -89,11 +89,14 @@ def draft_clarification_email(
         .replace("<<<THREAD_CONTEXT>>>", thread_context)
     )
 
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[{"role": "user", "content": filled_prompt}],
-        temperature=0,
-    )
+    with openai_breaker.guard():
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": filled_prompt}],
+            temperature=0,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
 
     message_content = response.choices[0].message.content
     if message_content is None:
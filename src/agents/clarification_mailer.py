@@ -1,4 +1,5 @@
 import base64
+import os
 from email.message import EmailMessage
 from datetime import datetime, timezone
 
@@ -13,7 +14,11 @@ class ClarificationMailerAgent:
 
     def __init__(self):
         self.stm_manager = STMManager()
-        self.gmail_service = get_gmail_service()
+
+    @property
+    def gmail_service(self):
+        # Resolved on first send so non-Gmail mail sources can start without credentials.
+        return get_gmail_service()
 
     def send_clarification(
         self,
@@ -24,10 +29,12 @@ class ClarificationMailerAgent:
         clarification_question: str,
         original_message_id_header: str | None = None,
         body_text: str | None = None,
-        sender_display_name: str = "Accounts Payable Team"
+        sender_display_name: str = "Accounts Payable Team",
+        mailbox: str | None = None,
     ) -> dict:
         """
-        Sends the clarification email as a reply.
+        Sends the clarification email as a reply, from `mailbox` (a name in
+        MAILBOXES_FILE) when given, otherwise from the default account.
 
         Returns:
         {
@@ -91,16 +98,7 @@ Thank you,
             msg.as_bytes()
         ).decode("utf-8")
 
-        # -------------------------------
-        # Send via Gmail API
-        # -------------------------------
-        sent_message = self.gmail_service.users().messages().send(
-            userId="me",
-            body={
-                "raw": raw_message,
-                "threadId": thread_id
-            }
-        ).execute()
+        gmail_message_id = self._deliver(msg, raw_message, thread_id, mailbox)
 
         # -------------------------------
         # Update STM (mark sent)
@@ -113,5 +111,45 @@ Thank you,
 
         return {
             "sent": True,
-            "gmail_message_id": sent_message.get("id")
+            "gmail_message_id": gmail_message_id
         }
+
+    def _deliver(self, msg: EmailMessage, raw_message: str, thread_id: str, mailbox: str | None) -> str | None:
+        """Send via the Gmail API; returns the sent message's ID."""
+        if mailbox is not None:
+            from src.agents.mailboxes import get_mailbox
+
+            gmail_service = get_mailbox(mailbox).service
+        else:
+            gmail_service = self.gmail_service
+        sent_message = gmail_service.users().messages().send(
+            userId="me",
+            body={
+                "raw": raw_message,
+                "threadId": thread_id
+            }
+        ).execute()
+        return sent_message.get("id")
+
+
+class RecordingMailer(ClarificationMailerAgent):
+    """
+    Mailer for replayed mail (file, jsonl): goes through the same STM
+    guards and updates, but keeps the message in `sent` instead of mailing
+    a real supplier. Replayed thread IDs are not Gmail threads anyway.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent: list[dict] = []
+
+    def _deliver(self, msg: EmailMessage, raw_message: str, thread_id: str, mailbox: str | None) -> str | None:
+        self.sent.append({"thread_id": thread_id, "to": msg["To"], "subject": msg["Subject"], "body": msg.get_content()})
+        print(f"[{thread_id}] Replay: recorded clarification to {msg['To']} instead of sending it")
+        return None
+
+
+def get_clarification_mailer(spec: str | None = None) -> ClarificationMailerAgent:
+    """The real Gmail mailer for MAIL_SOURCE "gmail" (the default), a RecordingMailer for replayed sources."""
+    spec = spec or os.getenv("MAIL_SOURCE", "gmail")
+    return ClarificationMailerAgent() if spec == "gmail" else RecordingMailer()
@@ -1,21 +1,30 @@
 # Resolve conversational context using STM, similarity, and an AI agent before dispute classification.
 from __future__ import annotations
 
+import hashlib
 import json
 import math
 import os
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from email.utils import parseaddr
 from pathlib import Path
 from typing import Any
 
-from src.utils.llm_client import get_default_model, get_openai_client
+from src.utils.llm_client import get_default_model, get_openai_client, llm_timeout, openai_breaker, record_usage
+from src.utils.single_flight import SingleFlight
 
 client = get_openai_client()
 CONTEXT_MODEL = os.getenv("CONTEXT_RESOLUTION_MODEL", get_default_model())
 EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
 PROMPT_PATH = Path("src/prompts/context_resolution_agent.txt")
+EMBEDDING_CACHE_MAX_ENTRIES = 256
+
+_embedding_cache: OrderedDict[str, list[float]] = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+_embedding_flight = SingleFlight("embedding")
 
 
 @dataclass
@@ -47,14 +56,39 @@ def _extract_sender_email(raw_email: dict) -> str | None:
     return email_addr.lower() if email_addr else None
 
 
+def _request_embedding(text: str) -> list[float]:
+    with openai_breaker.guard():
+        response = client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=text,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
+    return response.data[0].embedding
+
+
 def _generate_embedding(text: str) -> list[float]:
+    """
+    Embedding of `text`. An STM's reference texts are embedded again for
+    every email in its conversation, so results are cached, and concurrent
+    requests for the same text share one API call.
+    """
     if not text or not text.strip():
         return []
-    response = client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text.strip(),
-    )
-    return response.data[0].embedding
+    text = text.strip()
+    key = hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode("utf-8")).hexdigest()
+    with _embedding_cache_lock:
+        embedding = _embedding_cache.get(key)
+        if embedding is not None:
+            _embedding_cache.move_to_end(key)
+            return embedding
+
+    embedding = _embedding_flight.do(key, _request_embedding, text)
+    with _embedding_cache_lock:
+        _embedding_cache[key] = embedding
+        while len(_embedding_cache) > EMBEDDING_CACHE_MAX_ENTRIES:
+            _embedding_cache.popitem(last=False)
+    return embedding
 
 
 def _cosine_similarity(vec_a: list[float], vec_b: list[float]) -> float | None:
@@ -104,11 +138,14 @@ def _calculate_similarity(candidate_text: str, stm: dict[str, Any] | None) -> fl
 def _call_context_agent(payload: dict[str, Any]) -> dict[str, Any]:
     prompt_template = PROMPT_PATH.read_text(encoding="utf-8")
     prompt = prompt_template.replace("<<<INPUT_JSON>>>", json.dumps(payload, ensure_ascii=False, indent=2))
-    response = client.chat.completions.create(
-        model=CONTEXT_MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0,
-    )
+    with openai_breaker.guard():
+        response = client.chat.completions.create(
+            model=CONTEXT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
     content = response.choices[0].message.content
     if content is None:
         raise RuntimeError("Context resolution agent returned empty response")
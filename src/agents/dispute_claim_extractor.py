@@ -4,7 +4,7 @@ import json
 from pathlib import Path
 from typing import Any
 
-from src.utils.llm_client import get_default_model, get_openai_client
+from src.utils.llm_client import get_default_model, get_openai_client, llm_timeout, openai_breaker, record_usage
 
 OPENAI_MODEL = get_default_model()
 client = get_openai_client()
@@ -84,11 +84,14 @@ def extract_dispute_claim(processed_email: dict) -> dict[str, Any]:
         json.dumps(processed_email, indent=2),
     )
 
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[{"role": "user", "content": filled_prompt}],
-        temperature=0,
-    )
+    with openai_breaker.guard():
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": filled_prompt}],
+            temperature=0,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
 
     message_content = response.choices[0].message.content
     if message_content is None:
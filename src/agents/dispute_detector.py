@@ -1,7 +1,7 @@
 import json
 from pathlib import Path
 
-from src.utils.llm_client import get_default_model, get_openai_client
+from src.utils.llm_client import get_default_model, get_openai_client, llm_timeout, openai_breaker, record_usage
 
 DEFAULT_MODEL = get_default_model()
 client = get_openai_client()
@@ -27,11 +27,14 @@ def detect_dispute(preprocessed_email: dict) -> dict:
         json.dumps(preprocessed_email, indent=2)
     )
 
-    response = client.chat.completions.create(
-        model=DEFAULT_MODEL,
-        messages=[{"role": "user", "content": filled_prompt}],
-        temperature=0
-    )
+    with openai_breaker.guard():
+        response = client.chat.completions.create(
+            model=DEFAULT_MODEL,
+            messages=[{"role": "user", "content": filled_prompt}],
+            temperature=0,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
 
     content = response.choices[0].message.content.strip()
 
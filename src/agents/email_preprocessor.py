@@ -3,7 +3,7 @@ import os
 from email.utils import parseaddr
 from pathlib import Path
 
-from src.utils.llm_client import get_default_model, get_openai_client
+from src.utils.llm_client import get_default_model, get_openai_client, llm_timeout, openai_breaker, record_usage
 
 OPENAI_MODEL = get_default_model()
 EMAIL_SYSTEM_ID = os.getenv("SYSTEM_EMAIL_ID")
@@ -43,11 +43,14 @@ def preprocess_email_llm(raw_email: dict) -> dict:
         json.dumps(raw_email, indent=2)
     )
 
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[{"role": "user", "content": filled_prompt}],
-        temperature=0
-    )
+    with openai_breaker.guard():
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": filled_prompt}],
+            temperature=0,
+            timeout=llm_timeout(),
+        )
+    record_usage(response)
 
     content = response.choices[0].message.content
     if content is None:
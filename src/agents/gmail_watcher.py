@@ -1,52 +1,224 @@
+import base64
 import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr
+from functools import lru_cache
+
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-import base64
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+from src.utils.circuit_breaker import CircuitBreaker
+from src.utils.email_text import clean_body
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 PROCESSED_LABEL_NAME = "Processed"
 NON_DISPUTE_LABEL_NAME = "NonDispute"
 DISPUTE_LABEL_NAME = "Dispute"
+HISTORY_CURSOR_KEY = "gmail:history_id"
+LABEL_ID_CACHE_KEY = "gmail:label_ids"
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# Socket timeout per Gmail HTTP request; httplib2 otherwise waits forever.
+GMAIL_TIMEOUT_SECONDS = float(os.getenv("GMAIL_TIMEOUT_SECONDS", "30"))
 
+BODY_STATS = {"emails": 0, "raw_chars": 0, "clean_chars": 0}
+_body_stats_lock = threading.Lock()
 
-def get_gmail_service():
-    creds = None
+LIST_PAGE_SIZE = 500  # messages.list maxResults ceiling
+BATCH_SIZE = 100  # Gmail's hard cap on calls per HTTP batch request
+BATCH_MODIFY_SIZE = 1000  # users.messages.batchModify per-call ID limit
+BATCH_MAX_ATTEMPTS = 4
+BATCH_RETRY_BASE_SECONDS = 1.0
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Syncs a pending history message may fail to download before it is dropped
+# (deleted or trashed messages never come back).
+PENDING_MAX_ATTEMPTS = 5
+# Partial response: only the parts _parse_message/_extract_body read.
+# The fields syntax is not recursive, so multipart nesting is spelled out
+# four levels deep, which covers mixed > alternative > related > leaf.
+_PART_FIELDS = "partId,mimeType,filename,body(data,attachmentId,size)"
+MESSAGE_FIELDS = (
+    "id,threadId,payload("
+    f"headers(name,value),{_PART_FIELDS},parts("
+    f"{_PART_FIELDS},parts("
+    f"{_PART_FIELDS},parts("
+    f"{_PART_FIELDS},parts({_PART_FIELDS})))))"
+)
+# Headers needed to route a message before its body is downloaded.
+ROUTING_HEADERS = [
+    "From",
+    "Subject",
+    "Date",
+    "Message-ID",
+    "In-Reply-To",
+    "List-Id",
+    "List-Unsubscribe",
+    "Precedence",
+    "Auto-Submitted",
+]
+METADATA_FIELDS = "id,threadId,payload/headers(name,value)"
 
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
-            )
-            creds = flow.run_local_server(port=0)
+def _is_gmail_outage(exc: BaseException) -> bool:
+    if isinstance(exc, HttpError):
+        return getattr(exc.resp, "status", None) in RETRYABLE_STATUSES
+    return isinstance(exc, (OSError, httplib2.HttpLib2Error))
+
+
+# Shared by every mailbox: an outage is Gmail-wide far more often than per account.
+gmail_breaker = CircuitBreaker("gmail", is_failure=_is_gmail_outage)
+
+
+class _GuardedRequest(HttpRequest):
+    def execute(self, *args, **kwargs):
+        with gmail_breaker.guard():
+            return super().execute(*args, **kwargs)
+
+
+class GmailSession:
+    """
+    One authorised Gmail client per mailbox, shared by the whole process.
+
+    The discovery document is the static copy bundled with
+    google-api-python-client, so building never touches the network, and it
+    is parsed once. Every request gets its own httplib2.Http (httplib2 is not
+    thread-safe), which lets asyncio.to_thread workers share the service,
+    and runs under `gmail_breaker` (batch requests bypass it).
+    Credentials are refreshed under a lock only when they are within
+    TOKEN_REFRESH_MARGIN of expiry; the token file is rewritten only then.
+    """
+
+    def __init__(self, token_path: str = "token.json", credentials_path: str = "credentials.json"):
+        self.token_path = token_path
+        self.credentials_path = credentials_path
+        self._lock = threading.Lock()
+        self._creds = self._load_credentials()
+        self._service = build(
+            "gmail",
+            "v1",
+            http=AuthorizedHttp(self._creds, http=httplib2.Http(timeout=GMAIL_TIMEOUT_SECONDS)),
+            requestBuilder=self._build_request,
+            static_discovery=True,
+            cache_discovery=False,
+        )
 
-        with open("token.json", "w") as token:
+    def _load_credentials(self) -> Credentials:
+        creds = None
+        if os.path.exists(self.token_path):
+            creds = Credentials.from_authorized_user_file(self.token_path, SCOPES)
+
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.credentials_path, SCOPES
+                )
+                creds = flow.run_local_server(port=0)
+            self._save_credentials(creds)
+        return creds
+
+    def _save_credentials(self, creds: Credentials) -> None:
+        with open(self.token_path, "w") as token:
             token.write(creds.to_json())
 
-    return build("gmail", "v1", credentials=creds)
+    def _build_request(self, _http, *args, **kwargs):
+        http = AuthorizedHttp(self._creds, http=httplib2.Http(timeout=GMAIL_TIMEOUT_SECONDS))
+        return _GuardedRequest(http, *args, **kwargs)
+
+    def _needs_refresh(self) -> bool:
+        expiry = self._creds.expiry  # naive UTC, as google-auth stores it
+        if expiry is None:
+            return not self._creds.valid
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return expiry - now < TOKEN_REFRESH_MARGIN
+
+    @property
+    def service(self):
+        if self._needs_refresh():
+            with self._lock:
+                if self._needs_refresh():
+                    self._creds.refresh(Request())
+                    self._save_credentials(self._creds)
+        return self._service
+
+
+@lru_cache(maxsize=None)
+def get_gmail_session(
+    token_path: str = "token.json",
+    credentials_path: str = "credentials.json",
+) -> GmailSession:
+    return GmailSession(token_path, credentials_path)
+
+
+def get_gmail_service():
+    return get_gmail_session().service
 
 
 def get_or_create_label(service, label_name: str = PROCESSED_LABEL_NAME) -> str:
     """Return label ID for name, creating it if missing."""
+    return resolve_label_ids(service, [label_name])[label_name]
+
+
+def resolve_label_ids(
+    service,
+    label_names: list[str],
+    cache=None,
+    cache_key: str = LABEL_ID_CACHE_KEY,
+) -> dict[str, str]:
+    """
+    Map label names to IDs with at most one labels.list call, creating any
+    that are missing. `cache` is an optional Redis client; resolved IDs are
+    kept in the `cache_key` hash so restarts skip the list entirely. Label
+    IDs differ between mailboxes, so each mailbox needs its own key.
+    Delete that key if labels are renamed or removed in Gmail.
+    """
+    resolved: dict[str, str] = {}
+    if cache is not None:
+        cached = cache.hmget(cache_key, label_names)
+        resolved = {name: label_id for name, label_id in zip(label_names, cached) if label_id}
+    missing = [name for name in label_names if name not in resolved]
+    if not missing:
+        return resolved
+
     labels_response = service.users().labels().list(userId="me").execute()
-    for label in labels_response.get("labels", []):
-        if label.get("name") == label_name:
-            return label.get("id")
-    created = service.users().labels().create(
-        userId="me",
-        body={
-            "name": label_name,
-            "labelListVisibility": "labelShow",
-            "messageListVisibility": "show",
-        },
-    ).execute()
-    return created["id"]
+    existing = {label.get("name"): label.get("id") for label in labels_response.get("labels", [])}
+    for name in missing:
+        label_id = existing.get(name)
+        if not label_id:
+            label_id = service.users().labels().create(
+                userId="me",
+                body={
+                    "name": name,
+                    "labelListVisibility": "labelShow",
+                    "messageListVisibility": "show",
+                },
+            ).execute()["id"]
+        resolved[name] = label_id
+
+    if cache is not None:
+        cache.hset(cache_key, mapping={name: resolved[name] for name in missing})
+    return resolved
+
+
+def start_watch(service, topic_name: str, label_ids: list[str] | None = None) -> dict:
+    """
+    Ask Gmail to publish mailbox changes to a Pub/Sub topic (users.watch).
+    Returns {"historyId", "expiration"}; Gmail drops the watch after 7 days,
+    so callers must renew it before `expiration` (epoch millis).
+    """
+    body: dict = {"topicName": topic_name}
+    if label_ids:
+        body["labelIds"] = label_ids
+        body["labelFilterBehavior"] = "include"
+    return service.users().watch(userId="me", body=body).execute()
 
 
 def mark_as_processed(service, message_id: str, label_id: str):
@@ -75,23 +247,26 @@ def _decode_body(body: dict) -> str:
     return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
 
 
-def _extract_body(payload: dict) -> str:
+def _extract_raw_body(payload: dict) -> tuple[str, bool]:
     """
-    Extract text content from a Gmail message payload.
+    Extract text content from a Gmail message payload as (text, is_html).
     Prefers text/plain; falls back to text/html if plain is absent.
     """
     if not payload:
-        return ""
+        return "", False
 
     # Some messages place content directly in payload.body
     direct_body = _decode_body(payload.get("body", {}))
     if direct_body:
-        return direct_body
+        return direct_body, payload.get("mimeType") == "text/html"
 
     plain_parts = []
     html_parts = []
 
     for part in payload.get("parts", []):
+        if part.get("filename"):
+            # Attachments are read lazily by attachment_extractor.
+            continue
         mime_type = part.get("mimeType", "")
         if mime_type == "text/plain":
             text = _decode_body(part.get("body", {}))
@@ -103,67 +278,492 @@ def _extract_body(payload: dict) -> str:
                 html_parts.append(text)
         else:
             # Nested multipart/alternative; recurse
-            nested = _extract_body(part)
+            nested, nested_is_html = _extract_raw_body(part)
             if nested:
-                plain_parts.append(nested)
+                (html_parts if nested_is_html else plain_parts).append(nested)
 
     if plain_parts:
-        return "\n".join(plain_parts)
+        return "\n".join(plain_parts), False
     if html_parts:
-        return "\n".join(html_parts)
-    return ""
+        return "\n".join(html_parts), True
+    return "", False
 
 
-def fetch_emails(
+def _extract_body(payload: dict) -> str:
+    """
+    Body text ready for the LLM: HTML converted to text, quoted reply chain
+    and signature stripped, capped at MAX_BODY_CHARS. Raw and cleaned sizes
+    accumulate in BODY_STATS.
+    """
+    raw, is_html = _extract_raw_body(payload)
+    if not raw:
+        return ""
+    cleaned = clean_body(raw, is_html=is_html)
+    with _body_stats_lock:
+        BODY_STATS["emails"] += 1
+        BODY_STATS["raw_chars"] += len(raw)
+        BODY_STATS["clean_chars"] += len(cleaned)
+    return cleaned
+
+
+def body_stats() -> dict:
+    """Cumulative raw vs cleaned body sizes, to measure prompt shrinkage."""
+    with _body_stats_lock:
+        stats = dict(BODY_STATS)
+    raw = stats["raw_chars"]
+    stats["shrink_ratio"] = round(1 - stats["clean_chars"] / raw, 3) if raw else 0.0
+    return stats
+
+
+def _collect_attachments(payload: dict) -> list[dict]:
+    """Metadata for every attachment part; contents are not downloaded here."""
+    attachments = []
+    for part in payload.get("parts", []):
+        body = part.get("body", {})
+        if part.get("filename") and body.get("attachmentId"):
+            attachments.append({
+                "attachment_id": body["attachmentId"],
+                "part_id": part.get("partId"),
+                "filename": part["filename"],
+                "mime_type": part.get("mimeType", ""),
+                "size": body.get("size", 0),
+            })
+        attachments.extend(_collect_attachments(part))
+    return attachments
+
+
+def _parse_message(msg_data: dict) -> dict:
+    """Flatten a Gmail `messages.get` resource into the pipeline's email dict."""
+    headers = msg_data["payload"]["headers"]
+    subject = from_ = date = ""
+    message_id_header = None
+
+    for h in headers:
+        name = h["name"]
+        if name == "Subject":
+            subject = h["value"]
+        if name == "From":
+            from_ = h["value"]
+        if name == "Date":
+            date = h["value"]
+        # Gmail returns "Message-ID" header we need for threading
+        if name.lower() == "message-id":
+            message_id_header = h["value"]
+
+    body = _extract_body(msg_data.get("payload", {}))
+    attachments = _collect_attachments(msg_data.get("payload", {}))
+
+    email = {
+        "email_id": msg_data["id"],
+        "thread_id": msg_data["threadId"],
+        "from": from_,
+        "subject": subject,
+        "date": date,
+        "body": body,
+        # The RFC Message-ID header (not the Gmail message resource id)
+        "message_id_header": message_id_header,
+    }
+    if attachments:
+        email["attachments"] = attachments
+    return email
+
+
+def _batch_get(service, message_ids: list[str], **get_kwargs) -> dict[str, dict]:
+    """
+    Run messages.get for many IDs through Gmail HTTP batch requests,
+    BATCH_SIZE per round trip. Items that fail with a retryable status
+    (429/5xx) are re-batched with exponential backoff; anything else is
+    logged and dropped so one bad message never sinks the poll.
+    """
+    fetched: dict[str, dict] = {}
+    pending = list(message_ids)
+
+    for attempt in range(BATCH_MAX_ATTEMPTS):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(BATCH_RETRY_BASE_SECONDS * (2 ** (attempt - 1)))
+
+        retry: list[str] = []
+
+        def _on_response(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+                return
+            status = getattr(getattr(exception, "resp", None), "status", None)
+            if status in RETRYABLE_STATUSES:
+                retry.append(request_id)
+            else:
+                print(f"Failed to fetch message {request_id}:", exception)
+
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=_on_response)
+            for message_id in pending[start:start + BATCH_SIZE]:
+                batch.add(
+                    service.users().messages().get(userId="me", id=message_id, **get_kwargs),
+                    request_id=message_id,
+                )
+            batch.execute()
+        pending = retry
+
+    for message_id in pending:
+        print(f"Giving up on message {message_id} after {BATCH_MAX_ATTEMPTS} attempts")
+
+    return fetched
+
+
+def _fetch_messages(
+    service,
+    message_ids: list[str],
+    fields: str | None = MESSAGE_FIELDS,
+) -> list[dict]:
+    """Fetch and parse full messages in batches. Output keeps the input order."""
+    fetched = _batch_get(service, message_ids, format="full", fields=fields)
+    return [_parse_message(fetched[m]) for m in message_ids if m in fetched]
+
+
+def default_header_filter(headers: dict[str, str]) -> str | None:
+    """
+    Routing check applied to metadata in two-phase fetches. Returns a skip
+    reason, or None to fetch the full body. Drops our own outgoing mail and
+    mail marked bulk (Precedence: bulk/list/junk) or auto-submitted, unless
+    the sender's domain is listed in SUPPLIER_DOMAINS.
+
+    List-Id/List-Unsubscribe alone only count with GMAIL_SKIP_LIST_MAIL=true:
+    supplier billing platforms add them to transactional invoice and
+    remittance mail, which is exactly what disputes arrive as.
+    """
+    sender = parseaddr(headers.get("from", ""))[1].lower()
+    system_email = os.getenv("SYSTEM_EMAIL_ID")
+    if sender and system_email and sender == system_email.lower():
+        return "SYSTEM_SENDER"
+    supplier_domains = {d.strip().lower() for d in os.getenv("SUPPLIER_DOMAINS", "").split(",") if d.strip()}
+    if sender.rpartition("@")[2] in supplier_domains:
+        return None
+    if headers.get("precedence", "").strip().lower() in {"bulk", "list", "junk"}:
+        return "BULK"
+    if headers.get("auto-submitted", "no").strip().lower() != "no":
+        return "AUTO_SUBMITTED"
+    if os.getenv("GMAIL_SKIP_LIST_MAIL", "false").lower() == "true" and (
+        headers.get("list-id") or headers.get("list-unsubscribe")
+    ):
+        return "MAILING_LIST"
+    return None
+
+
+def _fetch_two_phase(service, message_ids: list[str], header_filter) -> list[dict]:
+    """
+    Phase one pulls only ROUTING_HEADERS (format="metadata"); phase two
+    downloads full payloads just for messages `header_filter` keeps.
+    Filtered messages are still returned, with an empty body and a
+    "prefiltered" reason, so callers can mark them processed.
+    """
+    metadata = _batch_get(
+        service,
+        message_ids,
+        format="metadata",
+        metadataHeaders=ROUTING_HEADERS,
+        fields=METADATA_FIELDS,
+    )
+    keep: list[str] = []
+    skipped: dict[str, dict] = {}
+    for message_id in message_ids:
+        msg_data = metadata.get(message_id)
+        if not msg_data:
+            continue
+        headers = {
+            h["name"].lower(): h["value"]
+            for h in msg_data.get("payload", {}).get("headers", [])
+        }
+        reason = header_filter(headers)
+        if reason:
+            email = _parse_message(msg_data)
+            email["prefiltered"] = reason
+            skipped[message_id] = email
+        else:
+            keep.append(message_id)
+
+    full = {email["email_id"]: email for email in _fetch_messages(service, keep)}
+    return [
+        skipped.get(m) or full[m]
+        for m in message_ids
+        if m in skipped or m in full
+    ]
+
+
+def _list_message_ids(
+    service,
+    query: str | None,
+    limit: int | None,
+    page_token: str | None = None,
+) -> tuple[list[str], str | None, int]:
+    """
+    List message IDs matching `query` from `page_token` on, following
+    nextPageToken until `limit` IDs are collected (every page when limit is
+    None). Returns (ids, the token to continue from or None once the listing
+    is exhausted, Gmail's resultSizeEstimate).
+    """
+    message_ids: list[str] = []
+    first_page = True
+    estimate = 0
+    while True:
+        page_size = LIST_PAGE_SIZE if limit is None else min(limit - len(message_ids), LIST_PAGE_SIZE)
+        results = service.users().messages().list(
+            userId="me",
+            maxResults=page_size,
+            q=query,
+            pageToken=page_token,
+        ).execute()
+        if first_page:
+            estimate = results.get("resultSizeEstimate", 0)
+            first_page = False
+        message_ids.extend(m["id"] for m in results.get("messages", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return message_ids, None, estimate
+        if limit is not None and len(message_ids) >= limit:
+            return message_ids, page_token, estimate
+
+
+def _history_message_ids(service, start_history_id: str) -> tuple[list[str], str]:
+    """
+    Return (message IDs added since start_history_id, newest history ID).
+    Raises HttpError 404 when Gmail no longer holds that much history.
+    """
+    message_ids: list[str] = []
+    seen: set[str] = set()
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        response = service.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            pageToken=page_token,
+        ).execute()
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added.get("message", {})
+                message_id = message.get("id")
+                if not message_id or message_id in seen:
+                    continue
+                if "DRAFT" in message.get("labelIds", []):
+                    continue
+                seen.add(message_id)
+                message_ids.append(message_id)
+        latest_history_id = response.get("historyId", latest_history_id)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return message_ids, latest_history_id
+
+
+# message IDs this process has handed out from a history sync and not yet
+# seen settled, per cursor key; they are not re-fetched while in flight here.
+_handed_out: dict[str, set[str]] = {}
+_handed_out_lock = threading.Lock()
+
+
+def _pending_key(cursor_key: str) -> str:
+    return f"{cursor_key}:pending"
+
+
+def _resync_key(cursor_key: str) -> str:
+    return f"{cursor_key}:resync"
+
+
+def _attempts_key(cursor_key: str) -> str:
+    return f"{cursor_key}:pending_attempts"
+
+
+def sync_history(
+    service,
+    redis_client,
+    processed_label: str = PROCESSED_LABEL_NAME,
+    cursor_key: str = HISTORY_CURSOR_KEY,
+    fetch=_fetch_messages,
+    limit: int | None = None,
+) -> tuple[list[dict], bool]:
+    """
+    Incremental fetch driven by the Gmail History API. Returns (emails,
+    more_pending).
+
+    The last seen historyId lives in Redis under `cursor_key`. Without a
+    cursor, or when Gmail answers 404 because the cursor has aged out, this
+    falls back to a full resync of every unprocessed message, `limit` per
+    call: the mailbox's current historyId (read *before* listing, so
+    nothing arriving mid-resync is skipped) and the listing's page token
+    are kept under `{cursor_key}:resync`, and once the last page is
+    fetched the cursor restarts from that historyId. A history delta
+    cannot be partially consumed, so `limit` does not apply to it.
+
+    Every message ID the cursor moves past is first added to a pending set
+    beside it, and stays there until `settle_history` is called for it once
+    the email is processed. Each sync fetches pending IDs again unless this
+    process is still working on them, so a message that failed to download,
+    or that a crashed process never finished, is not lost with the cursor.
+    One that fails to download PENDING_MAX_ATTEMPTS times (a deleted
+    message, say) is settled and logged instead of retried forever.
+    """
+    pending_key = _pending_key(cursor_key)
+    resync_key = _resync_key(cursor_key)
+    resync = redis_client.hgetall(resync_key)
+    start_history_id = None if resync else redis_client.get(cursor_key)
+    message_ids: list[str] | None = None
+    latest_history_id = None
+    page_token = None
+
+    if start_history_id:
+        try:
+            message_ids, latest_history_id = _history_message_ids(service, start_history_id)
+        except HttpError as exc:
+            if exc.resp.status != 404:
+                raise
+            print("Gmail history cursor expired; running full resync.")
+
+    if message_ids is None:
+        if not resync:
+            profile = service.users().getProfile(userId="me").execute()
+            resync = {"history_id": profile["historyId"]}
+        message_ids, page_token, estimate = _list_message_ids(
+            service,
+            f"-label:{processed_label}",
+            limit or LIST_PAGE_SIZE,
+            page_token=resync.get("page_token"),
+        )
+        print(f"Full resync: {len(message_ids)} of ~{estimate} unprocessed messages listed")
+
+    pending = set(redis_client.smembers(pending_key))
+    with _handed_out_lock:
+        in_flight = _handed_out.setdefault(cursor_key, set())
+        # Anything no longer pending was settled, here or by another process.
+        in_flight &= pending
+        retry_ids = sorted(pending - in_flight - set(message_ids))
+    if retry_ids:
+        print(f"Re-fetching {len(retry_ids)} unsettled messages from earlier syncs")
+
+    emails = fetch(service, retry_ids + message_ids)
+    # Record the window before moving past it; IDs that failed to download
+    # simply stay pending for the next sync.
+    pipe = redis_client.pipeline()
+    if message_ids:
+        pipe.sadd(pending_key, *message_ids)
+    if latest_history_id is not None:
+        pipe.set(cursor_key, latest_history_id)
+    elif page_token:
+        pipe.hset(resync_key, mapping={"history_id": resync["history_id"], "page_token": page_token})
+    else:
+        pipe.set(cursor_key, resync["history_id"])
+        pipe.delete(resync_key)
+    pipe.execute()
+    with _handed_out_lock:
+        in_flight.update(email["email_id"] for email in emails)
+
+    fetched_ids = {email["email_id"] for email in emails}
+    missed = [m for m in retry_ids + message_ids if m not in fetched_ids]
+    if missed:
+        pipe = redis_client.pipeline()
+        for message_id in missed:
+            pipe.hincrby(_attempts_key(cursor_key), message_id, 1)
+        exhausted = [m for m, attempts in zip(missed, pipe.execute()) if attempts >= PENDING_MAX_ATTEMPTS]
+        if exhausted:
+            print(f"Giving up on {len(exhausted)} messages that failed to download "
+                  f"{PENDING_MAX_ATTEMPTS} times: {exhausted}")
+            settle_history(redis_client, exhausted, cursor_key)
+    return emails, page_token is not None
+
+
+def settle_history(redis_client, message_ids: list[str], cursor_key: str = HISTORY_CURSOR_KEY) -> None:
+    """Drop processed (or otherwise finally handled) messages from the sync's pending set."""
+    if not message_ids:
+        return
+    pipe = redis_client.pipeline()
+    pipe.srem(_pending_key(cursor_key), *message_ids)
+    pipe.hdel(_attempts_key(cursor_key), *message_ids)
+    pipe.execute()
+    with _handed_out_lock:
+        _handed_out.get(cursor_key, set()).difference_update(message_ids)
+
+
+def fetch_email_batch(
     limit=5,
     exclude_processed: bool = True,
-    processed_label: str = PROCESSED_LABEL_NAME
-):
-    service = get_gmail_service()
+    processed_label: str = PROCESSED_LABEL_NAME,
+    incremental: bool = False,
+    two_phase: bool = False,
+    header_filter=default_header_filter,
+    mailbox=None,
+) -> tuple[list[dict], bool, int]:
+    """
+    `fetch_emails` plus paging state: returns (emails, more_pending,
+    backlog_estimate) so a scheduler can keep draining while a backlog exists.
+    With `incremental=True` only messages added since the previous call are
+    returned (see `sync_history`); `limit` then only pages a full resync,
+    since a history delta cannot be partially consumed. With `two_phase=True`
+    headers are checked before bodies are downloaded (see `_fetch_two_phase`);
+    skipped emails carry a "prefiltered" reason.
+
+    `mailbox` (a `mailboxes.Mailbox`) selects the account, its processed
+    label and its history cursor; its emails are tagged with "mailbox".
+    Without it the default token.json account is used, untagged.
+    """
+    cursor_key = HISTORY_CURSOR_KEY
+    if mailbox is None:
+        service = get_gmail_service()
+    else:
+        service = mailbox.service
+        processed_label = mailbox.processed_label
+        cursor_key = mailbox.history_cursor_key
+
+    def tagged(emails: list[dict]) -> list[dict]:
+        if mailbox is not None:
+            for email in emails:
+                email["mailbox"] = mailbox.name
+        return emails
+
+    def fetch(svc, message_ids):
+        if two_phase:
+            return _fetch_two_phase(svc, message_ids, header_filter)
+        return _fetch_messages(svc, message_ids)
+
+    if incremental:
+        from src.db.redis_client import get_redis_client
+
+        emails, more_pending = sync_history(
+            service,
+            get_redis_client(),
+            processed_label=processed_label,
+            cursor_key=cursor_key,
+            fetch=fetch,
+            limit=limit,
+        )
+        return tagged(emails), more_pending, len(emails)
+
     query = None
     if exclude_processed:
         # Gmail search skips messages with the processed label
         query = f"-label:{processed_label}"
 
-    results = service.users().messages().list(
-        userId="me", maxResults=limit, q=query
-    ).execute()
-
-    messages = results.get("messages", [])
-    emails = []
-
-    for msg in messages:
-        msg_data = service.users().messages().get(
-            userId="me", id=msg["id"], format="full"
-        ).execute()
+    message_ids, next_page_token, estimate = _list_message_ids(service, query, limit)
+    return tagged(fetch(service, message_ids)), next_page_token is not None, estimate
 
-        headers = msg_data["payload"]["headers"]
-        subject = from_ = date = ""
-        message_id_header = None
-
-        for h in headers:
-            name = h["name"]
-            if name == "Subject":
-                subject = h["value"]
-            if name == "From":
-                from_ = h["value"]
-            if name == "Date":
-                date = h["value"]
-            # Gmail returns "Message-ID" header we need for threading
-            if name.lower() == "message-id":
-                message_id_header = h["value"]
-
-        body = _extract_body(msg_data.get("payload", {}))
-
-        emails.append({
-            "email_id": msg["id"],
-            "thread_id": msg["threadId"],
-            "from": from_,
-            "subject": subject,
-            "date": date,
-            "body": body,
-            # The RFC Message-ID header (not the Gmail message resource id)
-            "message_id_header": message_id_header,
-        })
 
+def fetch_emails(
+    limit=5,
+    exclude_processed: bool = True,
+    processed_label: str = PROCESSED_LABEL_NAME,
+    incremental: bool = False,
+    two_phase: bool = False,
+    header_filter=default_header_filter,
+    mailbox=None,
+):
+    """Fetch up to `limit` emails to process; see `fetch_email_batch` for the modes."""
+    emails, _more_pending, _estimate = fetch_email_batch(
+        limit=limit,
+        exclude_processed=exclude_processed,
+        processed_label=processed_label,
+        incremental=incremental,
+        two_phase=two_phase,
+        header_filter=header_filter,
+        mailbox=mailbox,
+    )
     return emails
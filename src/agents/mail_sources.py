@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import email
+import hashlib
+import itertools
+import json
+import mailbox
+import os
+import threading
+import time
+from email import policy
+from email.message import EmailMessage
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from src.utils.email_text import clean_body
+
+
+class MailSource:
+    """
+    Where the pipeline gets email from. Every source yields dicts shaped like
+    `gmail_watcher.fetch_emails` output: email_id, thread_id, from, subject,
+    date, body, message_id_header.
+
+    `fetch_batch` mirrors `gmail_watcher.fetch_email_batch` and returns
+    (emails, more_pending, backlog) so AdaptivePollScheduler can drive any
+    source. Keyword options meant for Gmail are ignored by other sources.
+    """
+
+    name = "base"
+    # Whether results live in Gmail and should be labeled there.
+    labels_supported = False
+    # Gmail mailboxes (mailboxes.Mailbox) behind this source, if any.
+    mailboxes: tuple = ()
+
+    def fetch_batch(self, limit=None, **options) -> tuple[list[dict], bool, int]:
+        raise NotImplementedError
+
+    def fetch_emails(self, limit=None, **options) -> list[dict]:
+        return self.fetch_batch(limit=limit, **options)[0]
+
+
+class GmailMailSource(MailSource):
+    name = "gmail"
+    labels_supported = True
+
+    def __init__(self, mailbox=None):
+        self.mailbox = mailbox
+        self.mailboxes = (mailbox,) if mailbox is not None else ()
+
+    def fetch_batch(self, limit=None, **options) -> tuple[list[dict], bool, int]:
+        from src.agents.gmail_watcher import fetch_email_batch
+
+        return fetch_email_batch(limit=limit or 10, mailbox=self.mailbox, **options)
+
+
+class MultiMailboxSource(MailSource):
+    """
+    Several Gmail mailboxes polled as one source. Each fetch splits `limit`
+    evenly, lets a mailbox with a short backlog hand its unused share to
+    the next, and interleaves the results round-robin so no mailbox's
+    backlog is queued wholesale ahead of another's. The mailbox polled first
+    rotates every call. A mailbox that fails is skipped for that fetch.
+    """
+
+    name = "gmail-multi"
+    labels_supported = True
+
+    def __init__(self, mailboxes):
+        self.mailboxes = tuple(mailboxes)
+        self._sources = [GmailMailSource(mailbox) for mailbox in self.mailboxes]
+        self._start = 0
+
+    def fetch_batch(self, limit=None, **options) -> tuple[list[dict], bool, int]:
+        limit = limit or 10
+        order = self._sources[self._start:] + self._sources[:self._start]
+        self._start = (self._start + 1) % len(self._sources)
+
+        per_mailbox: list[list[dict]] = []
+        more_pending = False
+        backlog = 0
+        remaining = limit
+        for index, source in enumerate(order):
+            share = max(1, remaining // (len(order) - index))
+            try:
+                emails, more, pending = source.fetch_batch(limit=share, **options)
+            except Exception as exc:
+                print(f"Failed to fetch mailbox {source.mailbox.name}:", exc)
+                continue
+            per_mailbox.append(emails)
+            remaining = max(remaining - len(emails), 0)
+            more_pending = more_pending or more
+            backlog += pending
+
+        merged = [
+            email
+            for round_ in itertools.zip_longest(*per_mailbox)
+            for email in round_
+            if email is not None
+        ]
+        return merged, more_pending, backlog
+
+
+class ReplayMailSource(MailSource):
+    """
+    Replays a fixed list of emails once, in arrival order.
+
+    With `speed=None` everything is available immediately (full speed).
+    Otherwise emails are released on their recorded schedule, scaled by
+    `speed` (1.0 = real time, 10.0 = ten times faster); `fetch_batch` blocks
+    until the next one is due, so call it from a worker thread.
+    """
+
+    name = "replay"
+
+    def __init__(self, records: list[tuple[float, dict]], speed: float | None = None):
+        records = sorted(records, key=lambda item: item[0])
+        first = records[0][0] if records else 0.0
+        self._queue = [(arrival - first, mail) for arrival, mail in records]
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self.speed = speed
+        self._started: float | None = None
+
+    def _due_offset(self) -> float:
+        if self._started is None:
+            self._started = time.monotonic()
+        return (time.monotonic() - self._started) * self.speed
+
+    def fetch_batch(self, limit=None, **options) -> tuple[list[dict], bool, int]:
+        with self._lock:
+            remaining = len(self._queue) - self._cursor
+            if not remaining:
+                return [], False, 0
+            limit = limit or remaining
+            if self.speed:
+                next_offset = self._queue[self._cursor][0]
+                delay = (next_offset - self._due_offset()) / self.speed
+                if delay > 0:
+                    time.sleep(delay)
+                now_offset = self._due_offset()
+                end = self._cursor
+                while end < len(self._queue) and end - self._cursor < limit and self._queue[end][0] <= now_offset:
+                    end += 1
+            else:
+                end = min(self._cursor + limit, len(self._queue))
+            batch = [mail for _offset, mail in self._queue[self._cursor:end]]
+            self._cursor = end
+            remaining = len(self._queue) - end
+            # Under rate replay only already-due mail counts as backlog.
+            due_now = remaining if not self.speed else sum(
+                1 for offset, _ in self._queue[end:] if offset <= self._due_offset()
+            )
+            return batch, due_now > 0, remaining
+
+
+def _message_to_email(message: EmailMessage, fallback_id: str) -> dict:
+    """Flatten a parsed RFC 822 message into the pipeline's email dict."""
+    message_id_header = message.get("Message-ID")
+    references = (message.get("References") or "").split()
+    in_reply_to = message.get("In-Reply-To")
+    # The root of the References chain identifies the conversation, which
+    # is what Gmail's threadId groups by.
+    thread_root = (references[0] if references else in_reply_to) or message_id_header or fallback_id
+
+    body_part = message.get_body(preferencelist=("plain", "html"))
+    raw_body = body_part.get_content() if body_part is not None else ""
+    is_html = body_part is not None and body_part.get_content_subtype() == "html"
+
+    return {
+        "email_id": hashlib.sha1((message_id_header or fallback_id).encode("utf-8")).hexdigest()[:16],
+        "thread_id": hashlib.sha1(thread_root.encode("utf-8")).hexdigest()[:16],
+        "from": str(message.get("From", "")),
+        "subject": str(message.get("Subject", "")),
+        "date": str(message.get("Date", "")),
+        "body": clean_body(raw_body, is_html=is_html) if raw_body else "",
+        "message_id_header": message_id_header,
+    }
+
+
+def _arrival_time(mail: dict, index: int) -> float:
+    try:
+        return parsedate_to_datetime(mail.get("date") or "").timestamp()
+    except (TypeError, ValueError):
+        return float(index)
+
+
+def _load_rfc822(path: Path) -> list[dict]:
+    messages: list[tuple[str, EmailMessage]] = []
+    if path.is_dir() and (path / "cur").is_dir() and (path / "new").is_dir():
+        box = mailbox.Maildir(str(path), factory=None, create=False)
+        for key in box.iterkeys():
+            with box.get_file(key) as handle:
+                messages.append((key, email.message_from_binary_file(handle, policy=policy.default)))
+    elif path.is_dir():
+        for eml in sorted(path.glob("*.eml")):
+            with eml.open("rb") as handle:
+                messages.append((eml.name, email.message_from_binary_file(handle, policy=policy.default)))
+    else:
+        box = mailbox.mbox(str(path), create=False)
+        for key in box.iterkeys():
+            raw = box.get_bytes(key)
+            messages.append((f"{path.name}:{key}", email.message_from_bytes(raw, policy=policy.default)))
+    return [_message_to_email(message, fallback_id) for fallback_id, message in messages]
+
+
+def _load_jsonl(path: Path) -> list[dict]:
+    with path.open(encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+class FileMailSource(ReplayMailSource):
+    """Replays a Maildir, a directory of .eml files, or an mbox file."""
+
+    name = "file"
+
+    def __init__(self, path: str, speed: float | None = None):
+        emails = _load_rfc822(Path(path))
+        super().__init__([(_arrival_time(m, i), m) for i, m in enumerate(emails)], speed=speed)
+
+
+class JsonlMailSource(ReplayMailSource):
+    """
+    Replays one email dict per line. An optional "arrival_offset" (seconds)
+    sets the schedule; otherwise the Date field is used.
+    """
+
+    name = "jsonl"
+
+    def __init__(self, path: str, speed: float | None = None):
+        emails = _load_jsonl(Path(path))
+        records = [
+            (float(m.pop("arrival_offset")) if "arrival_offset" in m else _arrival_time(m, i), m)
+            for i, m in enumerate(emails)
+        ]
+        super().__init__(records, speed=speed)
+
+
+def get_mail_source(spec: str | None = None, speed: float | None = None) -> MailSource:
+    """
+    Build a source from MAIL_SOURCE: "gmail" (default; every mailbox listed
+    in MAILBOXES_FILE, or just token.json), a .jsonl file, a Maildir or .eml
+    directory, or an mbox file. MAIL_REPLAY_SPEED sets the replay rate
+    (unset = full speed).
+    """
+    spec = spec or os.getenv("MAIL_SOURCE", "gmail")
+    if speed is None and os.getenv("MAIL_REPLAY_SPEED"):
+        speed = float(os.environ["MAIL_REPLAY_SPEED"])
+    if spec == "gmail":
+        from src.agents.mailboxes import load_mailboxes
+
+        mailboxes = load_mailboxes()
+        if len(mailboxes) > 1:
+            return MultiMailboxSource(mailboxes)
+        return GmailMailSource(mailboxes[0])
+    if spec.endswith(".jsonl"):
+        return JsonlMailSource(spec, speed=speed)
+    return FileMailSource(spec, speed=speed)
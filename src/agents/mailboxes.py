@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass, fields
+from functools import lru_cache
+
+from src.agents.gmail_watcher import (
+    DISPUTE_LABEL_NAME,
+    HISTORY_CURSOR_KEY,
+    LABEL_ID_CACHE_KEY,
+    NON_DISPUTE_LABEL_NAME,
+    PROCESSED_LABEL_NAME,
+    GmailSession,
+    get_gmail_session,
+)
+
+DEFAULT_MAILBOX = "default"
+
+
+@dataclass(frozen=True)
+class Mailbox:
+    """
+    One Gmail mailbox we triage: its OAuth files and the label names used
+    in it. Each mailbox keeps its own history cursor and label-ID cache in
+    Redis; the default mailbox uses the original unscoped keys so existing
+    single-mailbox state carries over.
+    """
+
+    name: str = DEFAULT_MAILBOX
+    token_path: str = "token.json"
+    credentials_path: str = "credentials.json"
+    processed_label: str = PROCESSED_LABEL_NAME
+    non_dispute_label: str = NON_DISPUTE_LABEL_NAME
+    dispute_label: str = DISPUTE_LABEL_NAME
+
+    def _scoped(self, key: str) -> str:
+        return key if self.name == DEFAULT_MAILBOX else f"{key}:{self.name}"
+
+    @property
+    def history_cursor_key(self) -> str:
+        return self._scoped(HISTORY_CURSOR_KEY)
+
+    @property
+    def label_cache_key(self) -> str:
+        return self._scoped(LABEL_ID_CACHE_KEY)
+
+    @property
+    def label_names(self) -> list[str]:
+        return [self.processed_label, self.non_dispute_label, self.dispute_label]
+
+    @property
+    def session(self) -> GmailSession:
+        return get_gmail_session(self.token_path, self.credentials_path)
+
+    @property
+    def service(self):
+        return self.session.service
+
+
+@lru_cache(maxsize=None)
+def load_mailboxes(path: str | None = None) -> tuple[Mailbox, ...]:
+    """
+    Mailboxes listed in the JSON file at `path` (default: MAILBOXES_FILE),
+    e.g. [{"name": "ap-india", "token_path": "tokens/ap-india.json"}, ...].
+    Omitted fields take the Mailbox defaults. Without a file there is one
+    default mailbox using token.json and credentials.json.
+    """
+    path = path or os.getenv("MAILBOXES_FILE")
+    if not path:
+        return (Mailbox(),)
+    with open(path, "r", encoding="utf-8") as handle:
+        entries = json.load(handle)
+
+    allowed = {field.name for field in fields(Mailbox)}
+    mailboxes = []
+    for entry in entries:
+        unknown = set(entry) - allowed
+        if unknown:
+            raise ValueError(f"Unknown mailbox settings {sorted(unknown)} in {path}")
+        if not entry.get("name"):
+            raise ValueError(f"Every mailbox in {path} needs a name")
+        mailboxes.append(Mailbox(**entry))
+
+    names = [mailbox.name for mailbox in mailboxes]
+    if not names:
+        raise ValueError(f"No mailboxes configured in {path}")
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate mailbox names in {path}")
+    return tuple(mailboxes)
+
+
+def get_mailbox(name: str | None = None) -> Mailbox:
+    """The configured mailbox called `name`, or the first one when `name` is None."""
+    mailboxes = load_mailboxes()
+    if name is None:
+        return mailboxes[0]
+    for mailbox in mailboxes:
+        if mailbox.name == name:
+            return mailbox
+    raise ValueError(f"Unknown mailbox {name!r}")
@@ -1,66 +1,69 @@
 import json
 from datetime import datetime, timezone
-import redis
+from typing import Callable
+
+from src.db.stm_backends import STMBackend, get_stm_backend
 
 REDIS_TTL_SECONDS = 15 * 24 * 60 * 60  # 15 days
+CAS_MAX_ATTEMPTS = 5
 
 
 class STMManager:
-    def __init__(self):
-        self.redis = redis.Redis(
-            host="localhost",
-            port=6379,
-            decode_responses=True
-        )
+    def __init__(self, backend: STMBackend | None = None):
+        self.backend = backend or get_stm_backend()
 
-    def _key(self, thread_id: str) -> str:
-        return f"stm:thread:{thread_id}"
+    @property
+    def redis(self):
+        """Underlying Redis client when the Redis backend is active, else None."""
+        return getattr(self.backend, "redis", None)
 
     def get(self, thread_id: str) -> dict | None:
-        data = self.redis.get(self._key(thread_id))
+        data = self.backend.get(thread_id)
         return json.loads(data) if data else None
 
     def create_or_update(self, stm: dict):
-        from datetime import datetime, timezone
         now = datetime.now(timezone.utc).isoformat()
 
-
         stm.setdefault("created_at", now)
         stm["last_updated"] = now
 
-        self.redis.set(
-            self._key(stm["thread_id"]),
+        self.backend.set(
+            stm["thread_id"],
             json.dumps(stm),
-            ex=REDIS_TTL_SECONDS
+            REDIS_TTL_SECONDS
         )
 
+    def update(self, thread_id: str, mutate: Callable[[dict], dict | None]) -> dict:
+        """
+        Optimistic read-modify-write. `mutate` receives the current record and
+        may edit it in place or return a replacement; it is re-run against the
+        fresh record whenever a concurrent writer wins the race.
+        """
+        for _ in range(CAS_MAX_ATTEMPTS):
+            raw = self.backend.get(thread_id)
+            if not raw:
+                raise ValueError("STM not found")
+            stm = json.loads(raw)
+            stm = mutate(stm) or stm
+            now = datetime.now(timezone.utc).isoformat()
+            stm.setdefault("created_at", now)
+            stm["last_updated"] = now
+            if self.backend.compare_and_set(thread_id, raw, json.dumps(stm), REDIS_TTL_SECONDS):
+                return stm
+        raise RuntimeError(f"STM update for {thread_id} lost {CAS_MAX_ATTEMPTS} races")
+
     def update_state(self, thread_id: str, new_state: str):
-        stm = self.get(thread_id)
-        if not stm:
-            raise ValueError("STM not found")
+        def _apply(stm: dict) -> None:
+            stm["state"] = new_state
 
-        stm["state"] = new_state
-        self.create_or_update(stm)
+        self.update(thread_id, _apply)
 
     def delete(self, thread_id: str):
-        self.redis.delete(self._key(thread_id))
+        self.backend.delete(thread_id)
 
     def find_active_by_supplier_email(self, supplier_email_id: str) -> dict | None:
         if not supplier_email_id:
             return None
 
-        normalized = supplier_email_id.lower()
-        for key in self.redis.scan_iter(match="stm:thread:*"):
-            ttl = self.redis.ttl(key)
-            if ttl == -2:
-                continue
-            if ttl is not None and ttl <= 0:
-                continue
-            data = self.redis.get(key)
-            if not data:
-                continue
-            record = json.loads(data)
-            for candidate in record.get("supplier_email_ids", []):
-                if isinstance(candidate, str) and candidate.lower() == normalized:
-                    return record
-        return None
+        data = self.backend.find_by_supplier_email(supplier_email_id.lower())
+        return json.loads(data) if data else None
@@ -1,15 +1,33 @@
 from __future__ import annotations
 
 import os
+import threading
 from contextlib import contextmanager
 from dataclasses import dataclass
 
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from src.utils.circuit_breaker import CircuitBreaker
 
 load_dotenv()
 
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "8"))
+DB_CONNECT_TIMEOUT_SECONDS = int(os.getenv("DB_CONNECT_TIMEOUT_SECONDS", "5"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+_pool: ThreadedConnectionPool | None = None
+_pool_pid: int | None = None
+_pool_lock = threading.Lock()
+# Connection failures and statement timeouts; constraint violations and the
+# like say nothing about whether Postgres is up.
+db_breaker = CircuitBreaker(
+    "postgres",
+    is_failure=lambda exc: isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError)),
+)
+
 
 @dataclass(frozen=True)
 class DbConfig:
@@ -34,19 +52,47 @@ def _load_config() -> DbConfig:
     )
 
 
+def _get_pool() -> ThreadedConnectionPool:
+    """
+    Connection pool of the current process. Connections must not cross a
+    fork, so a child process builds its own pool on first use.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            config = _load_config()
+            _pool = ThreadedConnectionPool(
+                1,
+                DB_POOL_MAX,
+                dbname=config.name,
+                user=config.user,
+                password=config.password,
+                host=config.host,
+                port=config.port,
+                cursor_factory=RealDictCursor,
+                connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
 @contextmanager
 def db_connection():
-    config = _load_config()
-    conn = psycopg2.connect(
-        dbname=config.name,
-        user=config.user,
-        password=config.password,
-        host=config.host,
-        port=config.port,
-        cursor_factory=RealDictCursor,
-    )
-    try:
-        yield conn
-    finally:
-        conn.close()
-
+    """
+    Pooled connection for one unit of work. Raises CircuitOpen without
+    touching the pool while Postgres has been failing.
+    """
+    with db_breaker.guard():
+        pool = _get_pool()
+        conn = pool.getconn()
+        broken = False
+        try:
+            yield conn
+        finally:
+            # Uncommitted work is discarded, as closing the connection used to do.
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            pool.putconn(conn, close=broken or bool(conn.closed))
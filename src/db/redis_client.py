@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Above the longest blocking read (WorkStream.read blocks for 5s).
+REDIS_SOCKET_TIMEOUT_SECONDS = float(os.getenv("REDIS_SOCKET_TIMEOUT_SECONDS", "10"))
+REDIS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("REDIS_CONNECT_TIMEOUT_SECONDS", "5"))
+
+
+@lru_cache(maxsize=1)
+def get_redis_client() -> redis.Redis:
+    """Process-wide Redis client; honours REDIS_URL, defaults to localhost."""
+    url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    return redis.Redis.from_url(
+        url,
+        decode_responses=True,
+        socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS,
+    )
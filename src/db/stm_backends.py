@@ -0,0 +1,486 @@
+from __future__ import annotations
+
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+STM_KEY_PREFIX = "stm:thread:"
+# supplier email -> set of thread_ids whose record lists it (Redis backend)
+STM_SUPPLIER_PREFIX = "stm:supplier:"
+# Set once the supplier index covers records written before it existed.
+STM_SUPPLIER_INDEX_READY_KEY = "stm:supplier_index:ready"
+# Held by the one process building it; expires if that process dies mid-scan.
+STM_SUPPLIER_INDEX_LOCK_KEY = "stm:supplier_index:building"
+SUPPLIER_INDEX_LOCK_SECONDS = 600
+
+# Drop index entries whose record is gone, checked atomically so a record
+# created since the lookup read it keeps its entry.
+_PRUNE_SCRIPT = """
+for _, thread_id in ipairs(ARGV) do
+    if redis.call('EXISTS', KEYS[2] .. thread_id) == 0 then
+        redis.call('SREM', KEYS[1], thread_id)
+    end
+end
+"""
+
+
+def _supplier_emails(payload: str) -> list[str]:
+    """Lower-cased supplier addresses stored in a serialized STM record."""
+    try:
+        record = json.loads(payload)
+    except json.JSONDecodeError:
+        return []
+    emails = record.get("supplier_email_ids") or []
+    return [e.lower() for e in emails if isinstance(e, str) and e]
+
+
+class STMBackend:
+    """
+    Storage contract behind STMManager.
+
+    Records are opaque JSON strings keyed by thread_id. compare_and_set
+    compares against the previously read payload, so callers can do
+    optimistic read-modify-write without holding locks.
+    The sismember/sadd pair backs the processed-email set.
+    """
+
+    name = "base"
+
+    def get(self, thread_id: str) -> str | None:
+        raise NotImplementedError
+
+    def set(self, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        raise NotImplementedError
+
+    def compare_and_set(
+        self,
+        thread_id: str,
+        expected: str | None,
+        payload: str,
+        ttl_seconds: int,
+    ) -> bool:
+        raise NotImplementedError
+
+    def delete(self, thread_id: str) -> None:
+        raise NotImplementedError
+
+    def find_by_supplier_email(self, supplier_email: str) -> str | None:
+        raise NotImplementedError
+
+    def purge_expired(self) -> int:
+        return 0
+
+    def sismember(self, key: str, member: str) -> bool:
+        raise NotImplementedError
+
+    def sadd(self, key: str, *members: str) -> int:
+        raise NotImplementedError
+
+    def smismember(self, key: str, *members: str) -> list[bool]:
+        return [self.sismember(key, member) for member in members]
+
+
+class RedisSTMBackend(STMBackend):
+    """
+    Records live under stm:thread:<thread_id> and expire through Redis TTLs.
+    Each supplier address has a set of the threads listing it, written
+    alongside the record, so supplier lookups do not scan the keyspace
+    (except while the index of older records is still being built).
+    Index entries may outlive their record (expiry, a supplier dropped
+    from the record); lookups check the record, and prune entries whose
+    record has expired.
+    """
+
+    name = "redis"
+
+    def __init__(self, client=None):
+        if client is None:
+            from src.db.redis_client import get_redis_client
+
+            client = get_redis_client()
+        self.redis = client
+        self._index_ready = False
+        self._prune = client.register_script(_PRUNE_SCRIPT)
+
+    def _key(self, thread_id: str) -> str:
+        return f"{STM_KEY_PREFIX}{thread_id}"
+
+    def _supplier_key(self, supplier_email: str) -> str:
+        return f"{STM_SUPPLIER_PREFIX}{supplier_email}"
+
+    def _index(self, pipe, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        for email in _supplier_emails(payload):
+            pipe.sadd(self._supplier_key(email), thread_id)
+            # Records share one TTL, so the newest write bounds the whole set.
+            pipe.expire(self._supplier_key(email), ttl_seconds)
+
+    def _scan_records(self):
+        """(thread key, payload, ttl) of every live record, by scanning the keyspace."""
+        for key in self.redis.scan_iter(match=f"{STM_KEY_PREFIX}*"):
+            data = self.redis.get(key)
+            ttl = self.redis.ttl(key)
+            if data and ttl is not None and ttl > 0:
+                yield key, data, ttl
+
+    def _ensure_index(self) -> bool:
+        """
+        Whether the supplier index covers every record. Records written
+        before it existed are indexed by whichever process takes the build
+        lock; the ready marker is only set once that scan has finished.
+        """
+        if self._index_ready:
+            return True
+        if self.redis.get(STM_SUPPLIER_INDEX_READY_KEY):
+            self._index_ready = True
+            return True
+        if not self.redis.set(STM_SUPPLIER_INDEX_LOCK_KEY, "1", nx=True, ex=SUPPLIER_INDEX_LOCK_SECONDS):
+            return False
+        try:
+            indexed = 0
+            for key, data, ttl in self._scan_records():
+                pipe = self.redis.pipeline()
+                self._index(pipe, key[len(STM_KEY_PREFIX):], data, ttl)
+                pipe.execute()
+                indexed += 1
+            self.redis.set(STM_SUPPLIER_INDEX_READY_KEY, "1")
+            print(f"Indexed {indexed} STM records by supplier")
+        finally:
+            self.redis.delete(STM_SUPPLIER_INDEX_LOCK_KEY)
+        self._index_ready = True
+        return True
+
+    def get(self, thread_id: str) -> str | None:
+        return self.redis.get(self._key(thread_id))
+
+    def set(self, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        pipe = self.redis.pipeline()
+        pipe.set(self._key(thread_id), payload, ex=ttl_seconds)
+        self._index(pipe, thread_id, payload, ttl_seconds)
+        pipe.execute()
+
+    def compare_and_set(self, thread_id, expected, payload, ttl_seconds) -> bool:
+        import redis
+
+        key = self._key(thread_id)
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != expected:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.set(key, payload, ex=ttl_seconds)
+                self._index(pipe, thread_id, payload, ttl_seconds)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def delete(self, thread_id: str) -> None:
+        data = self.redis.get(self._key(thread_id))
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key(thread_id))
+        for email in _supplier_emails(data) if data else ():
+            pipe.srem(self._supplier_key(email), thread_id)
+        pipe.execute()
+
+    def find_by_supplier_email(self, supplier_email: str) -> str | None:
+        if not self._ensure_index():
+            # Still being built elsewhere: older threads may be missing from it.
+            for _key, data, _ttl in self._scan_records():
+                if supplier_email in _supplier_emails(data):
+                    return data
+            return None
+        index_key = self._supplier_key(supplier_email)
+        thread_ids = sorted(self.redis.smembers(index_key))
+        if not thread_ids:
+            return None
+        found = None
+        missing = []
+        records = self.redis.mget([self._key(thread_id) for thread_id in thread_ids])
+        for thread_id, data in zip(thread_ids, records):
+            if data is None:
+                missing.append(thread_id)
+            elif found is None and supplier_email in _supplier_emails(data):
+                found = data
+        if missing:
+            self._prune(keys=[index_key, STM_KEY_PREFIX], args=missing)
+        return found
+
+    def sismember(self, key: str, member: str) -> bool:
+        return bool(self.redis.sismember(key, member))
+
+    def sadd(self, key: str, *members: str) -> int:
+        if not members:
+            return 0
+        return self.redis.sadd(key, *members)
+
+    def smismember(self, key: str, *members: str) -> list[bool]:
+        if not members:
+            return []
+        return [bool(flag) for flag in self.redis.smismember(key, list(members))]
+
+
+class MemorySTMBackend(STMBackend):
+    """
+    Single-process store: a dict of records plus a min-heap of expiry times.
+    Expired entries are purged lazily on every access, so there is no
+    background thread. Rewriting a record leaves its old heap entry behind;
+    once stale entries outnumber live ones the heap is rebuilt.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records: dict[str, tuple[str, float]] = {}
+        self._expiry_heap: list[tuple[float, str]] = []
+        self._by_supplier: dict[str, set[str]] = {}
+        self._sets: dict[str, set[str]] = {}
+
+    def _index(self, thread_id: str, payload: str) -> None:
+        for email in _supplier_emails(payload):
+            self._by_supplier.setdefault(email, set()).add(thread_id)
+
+    def _unindex(self, thread_id: str, payload: str) -> None:
+        for email in _supplier_emails(payload):
+            threads = self._by_supplier.get(email)
+            if threads:
+                threads.discard(thread_id)
+                if not threads:
+                    del self._by_supplier[email]
+
+    def _drop(self, thread_id: str) -> None:
+        entry = self._records.pop(thread_id, None)
+        if entry:
+            self._unindex(thread_id, entry[0])
+
+    def _purge_locked(self) -> int:
+        now = time.monotonic()
+        purged = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, thread_id = heapq.heappop(self._expiry_heap)
+            entry = self._records.get(thread_id)
+            # Heap entries go stale when a record is rewritten; only the
+            # expiry stored alongside the record is authoritative.
+            if entry and entry[1] == expires_at:
+                self._drop(thread_id)
+                purged += 1
+        return purged
+
+    def _store_locked(self, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        self._drop(thread_id)
+        expires_at = time.monotonic() + ttl_seconds
+        self._records[thread_id] = (payload, expires_at)
+        heapq.heappush(self._expiry_heap, (expires_at, thread_id))
+        self._index(thread_id, payload)
+        if len(self._expiry_heap) > 2 * len(self._records) + 64:
+            self._expiry_heap = [(entry[1], tid) for tid, entry in self._records.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def get(self, thread_id: str) -> str | None:
+        with self._lock:
+            self._purge_locked()
+            entry = self._records.get(thread_id)
+            return entry[0] if entry else None
+
+    def set(self, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        with self._lock:
+            self._purge_locked()
+            self._store_locked(thread_id, payload, ttl_seconds)
+
+    def compare_and_set(self, thread_id, expected, payload, ttl_seconds) -> bool:
+        with self._lock:
+            self._purge_locked()
+            entry = self._records.get(thread_id)
+            current = entry[0] if entry else None
+            if current != expected:
+                return False
+            self._store_locked(thread_id, payload, ttl_seconds)
+            return True
+
+    def delete(self, thread_id: str) -> None:
+        with self._lock:
+            self._drop(thread_id)
+
+    def find_by_supplier_email(self, supplier_email: str) -> str | None:
+        with self._lock:
+            self._purge_locked()
+            for thread_id in self._by_supplier.get(supplier_email, ()):
+                entry = self._records.get(thread_id)
+                if entry:
+                    return entry[0]
+        return None
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge_locked()
+
+    def sismember(self, key: str, member: str) -> bool:
+        with self._lock:
+            return member in self._sets.get(key, ())
+
+    def sadd(self, key: str, *members: str) -> int:
+        with self._lock:
+            bucket = self._sets.setdefault(key, set())
+            before = len(bucket)
+            bucket.update(members)
+            return len(bucket) - before
+
+
+class SQLiteSTMBackend(STMBackend):
+    """
+    Durable single-node store in one SQLite file running in WAL mode, so
+    readers never block the writer. Expiry is a column; rows past it are
+    invisible to reads and deleted by purge_expired().
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = "stm.sqlite3"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS stm_records (
+                thread_id   TEXT PRIMARY KEY,
+                payload     TEXT NOT NULL,
+                expires_at  REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS stm_records_expiry ON stm_records (expires_at);
+            CREATE TABLE IF NOT EXISTS stm_suppliers (
+                supplier_email  TEXT NOT NULL,
+                thread_id       TEXT NOT NULL,
+                PRIMARY KEY (supplier_email, thread_id)
+            );
+            CREATE INDEX IF NOT EXISTS stm_suppliers_thread ON stm_suppliers (thread_id);
+            CREATE TABLE IF NOT EXISTS stm_sets (
+                set_key  TEXT NOT NULL,
+                member   TEXT NOT NULL,
+                PRIMARY KEY (set_key, member)
+            );
+            """
+        )
+
+    def _write_locked(self, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO stm_records (thread_id, payload, expires_at) VALUES (?, ?, ?)",
+            (thread_id, payload, time.time() + ttl_seconds),
+        )
+        self._conn.execute("DELETE FROM stm_suppliers WHERE thread_id = ?", (thread_id,))
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO stm_suppliers (supplier_email, thread_id) VALUES (?, ?)",
+            [(email, thread_id) for email in _supplier_emails(payload)],
+        )
+
+    def get(self, thread_id: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM stm_records WHERE thread_id = ? AND expires_at > ?",
+                (thread_id, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, thread_id: str, payload: str, ttl_seconds: int) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_locked(thread_id, payload, ttl_seconds)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def compare_and_set(self, thread_id, expected, payload, ttl_seconds) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT payload FROM stm_records WHERE thread_id = ? AND expires_at > ?",
+                    (thread_id, time.time()),
+                ).fetchone()
+                current = row[0] if row else None
+                if current != expected:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                self._write_locked(thread_id, payload, ttl_seconds)
+                self._conn.execute("COMMIT")
+                return True
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, thread_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM stm_records WHERE thread_id = ?", (thread_id,))
+            self._conn.execute("DELETE FROM stm_suppliers WHERE thread_id = ?", (thread_id,))
+
+    def find_by_supplier_email(self, supplier_email: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT r.payload
+                FROM stm_suppliers s
+                JOIN stm_records r ON r.thread_id = s.thread_id
+                WHERE s.supplier_email = ? AND r.expires_at > ?
+                LIMIT 1
+                """,
+                (supplier_email, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                """
+                DELETE FROM stm_suppliers
+                WHERE thread_id IN (SELECT thread_id FROM stm_records WHERE expires_at <= ?)
+                """,
+                (now,),
+            )
+            cursor = self._conn.execute("DELETE FROM stm_records WHERE expires_at <= ?", (now,))
+            return cursor.rowcount
+
+    def sismember(self, key: str, member: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM stm_sets WHERE set_key = ? AND member = ?",
+                (key, member),
+            ).fetchone()
+        return row is not None
+
+    def sadd(self, key: str, *members: str) -> int:
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO stm_sets (set_key, member) VALUES (?, ?)",
+                [(key, member) for member in members],
+            )
+            return self._conn.total_changes - before
+
+
+def get_stm_backend(kind: str | None = None) -> STMBackend:
+    """
+    Return the process-wide backend named by STM_BACKEND: "redis" (default),
+    "memory" or "sqlite". The SQLite file location comes from STM_SQLITE_PATH.
+    Shared so every STMManager in the process sees the same embedded store.
+    """
+    return _build_backend((kind or os.getenv("STM_BACKEND", "redis")).lower())
+
+
+@lru_cache(maxsize=None)
+def _build_backend(kind: str) -> STMBackend:
+    if kind == "redis":
+        return RedisSTMBackend()
+    if kind == "memory":
+        return MemorySTMBackend()
+    if kind == "sqlite":
+        return SQLiteSTMBackend(os.getenv("STM_SQLITE_PATH", "stm.sqlite3"))
+    raise ValueError(f"Unknown STM backend: {kind}")
@@ -0,0 +1,435 @@
+from __future__ import annotations
+
+import inspect
+import json
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from src.agents.ambiguity_resolver import resolve_ambiguity
+from src.agents.attachment_extractor import extract_attachment_text
+from src.agents.clarification_drafter import draft_clarification_email
+from src.agents.context_resolution_agent import resolve_conversational_context
+from src.agents.dispute_claim_extractor import extract_dispute_claim
+from src.agents.dispute_detector import detect_dispute
+from src.agents.email_preprocessor import preprocess_email_llm
+from src.db.postgres import db_breaker
+from src.pipeline.engine import RESULT_KEY, Stage, StageGraph
+from src.services.dispute_resolver import resolve_dispute_case
+
+ATTACHMENT_CLASSIFICATIONS = {"DISPUTE", "AMBIGUOUS"}
+
+
+@dataclass(frozen=True)
+class EmailFlowConfig:
+    """
+    What an entry point's triage flow does; everything else is shared.
+
+    stm_retention: "keep" records resolved threads in STM (RESOLVED_*);
+        "delete" removes the thread once it is resolved.
+    clarification: "drafter" writes a full clarification email;
+        "resolver" only generates the question.
+    context_resolution: run the context agent before preprocessing.
+    speculative: preprocess the raw email while context is being resolved
+        instead of waiting for the context-enriched copy.
+    attachments: read PDF/CSV/XLSX attachments of dispute candidates.
+    checkpoint: save context/preprocess/classify outputs for resumption.
+    llm_concurrency: cap on concurrent runs of each LLM stage.
+    stage_timeout: seconds allowed to each LLM stage (and a synchronous
+        dispute resolution); the engine's per-email budget still applies.
+    """
+
+    stm_retention: str = "delete"
+    clarification: str = "drafter"
+    context_resolution: bool = False
+    speculative: bool = False
+    attachments: bool = False
+    checkpoint: bool = False
+    llm_concurrency: int | None = None
+    stage_timeout: float | None = None
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _trail_entry(processed: dict, decision: dict) -> dict:
+    return {
+        "email_id": processed.get("email_id"),
+        "message_id_header": processed.get("message_id_header"),
+        "timestamp": _now(),
+        "classification": decision["classification"],
+        "summary": decision.get("reason") or "UNSPECIFIED_REASON",
+    }
+
+
+def _bootstrap_stm(processed: dict, decision: dict, state: str) -> dict:
+    now = _now()
+    supplier_email = processed.get("supplier_email_id")
+    return {
+        "thread_id": processed.get("thread_id"),
+        "supplier_id": processed.get("supplier_id"),
+        "supplier_email_ids": [supplier_email] if supplier_email else [],
+        "state": state,
+        "email_trail": [_trail_entry(processed, decision)],
+        "original_clean_text": processed.get("clean_text"),
+        "pending_question": None,
+        "pending_draft_body": None,
+        "last_classification": decision["classification"],
+        "confidence": decision.get("confidence") or 0.0,
+        "created_at": now,
+        "last_updated": now,
+    }
+
+
+def _append_trail(stm: dict, processed: dict, decision: dict) -> None:
+    """Add this email to the thread's trail and supplier list, once."""
+    stm.setdefault("email_trail", [])
+    if processed.get("email_id") not in {entry.get("email_id") for entry in stm["email_trail"]}:
+        stm["email_trail"].append(_trail_entry(processed, decision))
+
+    supplier_email = processed.get("supplier_email_id")
+    if supplier_email:
+        stm.setdefault("supplier_email_ids", [])
+        if supplier_email not in stm["supplier_email_ids"]:
+            stm["supplier_email_ids"].append(supplier_email)
+
+    if not stm.get("original_clean_text"):
+        stm["original_clean_text"] = processed.get("clean_text")
+
+
+def _awaiting_clarification(stm: dict | None) -> bool:
+    return bool(stm and stm.get("state") == "AWAITING_CLARIFICATION" and stm.get("pending_question"))
+
+
+def resolve_and_persist_dispute(processed_email: dict, decision: dict, state: dict | None = None) -> None:
+    """
+    Extract the claim and write the dispute case. `state` keeps the claim
+    across retries so a failed Postgres write does not pay for extraction
+    again, and extraction is not started while Postgres's breaker is open.
+    Errors propagate to the caller.
+    """
+    state = {} if state is None else state
+    if "claim" not in state:
+        db_breaker.check()
+        state["claim"] = extract_dispute_claim(processed_email)
+    result = resolve_dispute_case(
+        processed_email,
+        state["claim"],
+        decision.get("confidence", 0.0),
+    )
+    printable = {
+        "dispute_valid": result.dispute_valid,
+        "resolution_reason": result.resolution_reason,
+        "supplier_id": result.supplier_id,
+        "invoice_id": result.invoice_id,
+        "invoice_number": result.invoice_number,
+        "claimed_amount": str(result.claimed_amount) if result.claimed_amount is not None else None,
+        "sap_amount": str(result.sap_amount) if result.sap_amount is not None else None,
+        "dispute_case_id": result.dispute_case_row.get("case_id") if result.dispute_case_row else None,
+        "ltm_snapshot": result.supplier_ltm_row,
+    }
+    print("\nDISPUTE RESOLUTION RESULT")
+    print(json.dumps(printable, indent=2, default=str))
+
+
+def resolve_dispute_or_log(processed_email: dict, decision: dict) -> None:
+    """Inline dispute resolution for the synchronous loops; a failure must not stop them."""
+    try:
+        resolve_and_persist_dispute(processed_email, decision)
+    except Exception as exc:  # keep pipeline alive
+        print("Failed to resolve dispute:", exc)
+
+
+def build_email_graph(
+    config: EmailFlowConfig,
+    stm_manager,
+    mailer,
+    resolve_dispute: Callable[[dict, dict], Any] | None = resolve_dispute_or_log,
+    extra_stages: list[Stage] | None = None,
+    name: str = "email-triage",
+) -> StageGraph:
+    """
+    The triage flow shared by every entry point:
+
+        [context] -> preprocess -> annotate -> load_stm -> classify -> record
+            -> dispute (DISPUTE) / clarify (AMBIGUOUS) -> finish
+
+    annotate ends the run for SYSTEM senders and context for NO_OP
+    replies. `resolve_dispute(processed, decision)` may be a coroutine
+    function, e.g. one that hands the dispute to a background executor.
+    `extra_stages` are added to the graph; dispute and finish wait for them.
+    """
+    if config.stm_retention not in {"keep", "delete"}:
+        raise ValueError(f"Unknown stm_retention {config.stm_retention!r}")
+    if config.clarification not in {"drafter", "resolver"}:
+        raise ValueError(f"Unknown clarification {config.clarification!r}")
+
+    def resolve_context(email: dict) -> dict:
+        outcome = resolve_conversational_context(email, stm_manager)
+        fields = asdict(outcome)
+        stm = fields.pop("stm")
+        # Checkpoint the STM thread, not the snapshot; load_stm re-reads it.
+        fields["stm_thread_id"] = stm.get("thread_id") if stm else None
+
+        enriched = dict(email)
+        enriched["resolved_context"] = {
+            "decision": outcome.decision,
+            "similarity_score": outcome.similarity_score,
+            "notes": outcome.notes,
+            "stm_thread_id": fields["stm_thread_id"],
+        }
+        enriched["conversation_thread_id"] = fields["stm_thread_id"] or email.get("thread_id")
+        for key, value in (outcome.inherited_fields or {}).items():
+            if value and not enriched.get(key):
+                enriched[key] = value
+
+        print(f"[{email.get('email_id')}] Context resolution -> "
+              f"STM: {bool(stm)}, "
+              f"similarity: {outcome.similarity_score}, "
+              f"decision: {outcome.decision}")
+        skip = None
+        if outcome.skip_classification:
+            print(f"[{email.get('email_id')}] Context agent marked NO_OP; skipping classification.")
+            skip = "NO_OP"
+        return {"context": fields, "context_email": enriched, RESULT_KEY: skip}
+
+    def annotate(preprocessed: dict, email: dict, context: dict | None = None) -> dict:
+        processed = dict(preprocessed)
+        # Preserve the RFC Message-ID header for threading replies
+        processed["message_id_header"] = email.get("message_id_header")
+        if context is not None:
+            processed["gmail_thread_id"] = processed.get("thread_id")
+            conversation_thread_id = context.get("stm_thread_id") or email.get("thread_id")
+            if conversation_thread_id:
+                processed["thread_id"] = conversation_thread_id
+            processed["resolved_context"] = {
+                "decision": context.get("decision"),
+                "similarity_score": context.get("similarity_score"),
+                "notes": context.get("notes"),
+                "stm_thread_id": context.get("stm_thread_id"),
+            }
+            for key in ("supplier_email_id", "supplier_id"):
+                inherited_value = (context.get("inherited_fields") or {}).get(key)
+                if inherited_value and not processed.get(key):
+                    processed[key] = inherited_value
+        print("\nPREPROCESSED")
+        print(json.dumps(processed, indent=2))
+
+        skip = None
+        if processed.get("sender_type") == "SYSTEM":
+            print("Skipping SYSTEM email")
+            skip = "SYSTEM"
+        return {"processed": processed, RESULT_KEY: skip}
+
+    def load_stm(processed: dict) -> dict | None:
+        return stm_manager.get(processed["thread_id"])
+
+    def classify(email: dict, processed: dict, stm: dict | None) -> dict:
+        contextual = _awaiting_clarification(stm)
+        classified_email = processed
+        if contextual:
+            # Combine original email + clarification question + reply for richer classification
+            classified_email = dict(processed)
+            classified_email["clean_text"] = (
+                f"Original email:\n{stm.get('original_clean_text', '')}\n\n"
+                f"Clarification question sent:\n{stm.get('pending_question', '')}\n\n"
+                f"Supplier reply:\n{processed['clean_text']}"
+            )
+
+        decision = detect_dispute(classified_email)
+        attachment_text = None
+        if (
+            config.attachments
+            and decision["classification"] in ATTACHMENT_CLASSIFICATIONS
+            and email.get("attachments")
+        ):
+            # Pull attachment text only once an email looks like a dispute. An
+            # AMBIGUOUS verdict is re-checked with it, since an attached
+            # invoice often answers what a clarification email would ask.
+            attachment_text = extract_attachment_text(email) or None
+            if attachment_text and decision["classification"] == "AMBIGUOUS":
+                enriched = dict(classified_email)
+                enriched["clean_text"] = f"{classified_email.get('clean_text', '')}\n\n{attachment_text}"
+                rechecked = detect_dispute(enriched)
+                print(f"[{email.get('email_id')}] Re-classified with attachments: "
+                      f"{decision['classification']} -> {rechecked['classification']}")
+                decision = rechecked
+
+        print("\nDISPUTE DETECTION RESULT" + (" (CONTEXTUAL)" if contextual else ""))
+        print(json.dumps(decision, indent=2))
+        return {"decision": decision, "contextual": contextual, "attachment_text": attachment_text}
+
+    def record(processed: dict, decision: dict, contextual: bool, stm: dict | None) -> dict | None:
+        """Persist the verdict to STM according to `config.stm_retention`."""
+        classification = decision["classification"]
+        thread_id = processed["thread_id"]
+        resolved_state = {"NON_DISPUTE": "RESOLVED_NON_DISPUTE", "DISPUTE": "RESOLVED_DISPUTE"}.get(classification)
+
+        if contextual:
+            _append_trail(stm, processed, decision)
+            stm["last_classification"] = classification
+            stm["confidence"] = decision["confidence"]
+            stm["last_updated"] = _now()
+            stm["pending_question"] = None
+            if resolved_state:
+                stm["state"] = resolved_state
+        elif resolved_state:
+            if config.stm_retention == "delete":
+                stm = None
+            elif stm:
+                _append_trail(stm, processed, decision)
+                stm["state"] = resolved_state
+                stm["last_classification"] = classification
+                stm["confidence"] = decision["confidence"]
+            else:
+                stm = _bootstrap_stm(processed, decision, resolved_state)
+        elif classification == "AMBIGUOUS":
+            stm = stm or _bootstrap_stm(processed, decision, "AWAITING_CLARIFICATION")
+            _append_trail(stm, processed, decision)
+            stm["last_classification"] = classification
+            stm["confidence"] = decision["confidence"]
+            stm["last_updated"] = _now()
+        else:
+            return stm
+
+        if resolved_state and config.stm_retention == "delete":
+            stm_manager.delete(thread_id)
+            return None
+        stm_manager.create_or_update(stm)
+        return stm
+
+    def clarify(email: dict, processed: dict, decision: dict, stm_after: dict | None) -> dict | None:
+        thread_id = processed["thread_id"]
+        draft = None
+        if not (stm_after or {}).get("pending_question"):
+            if config.clarification == "resolver":
+                question = resolve_ambiguity(
+                    processed_email=processed,
+                    ambiguity_summary=decision["reason"],
+                    confidence=decision["confidence"],
+                )
+                print("\nAMBIGUITY RESOLVER OUTPUT")
+                print(question)
+            else:
+                draft = draft_clarification_email(
+                    processed_email=processed,
+                    ambiguity_summary=decision["reason"],
+                    confidence=decision["confidence"],
+                )
+                print("\nCLARIFICATION DRAFT OUTPUT")
+                print(json.dumps(draft, indent=2))
+
+        # The drafter stores the question in STM; send from there, once.
+        stm = stm_manager.get(thread_id)
+        if stm is None:
+            raise RuntimeError("STM record vanished before sending clarification")
+        if not (
+            stm.get("state") == "AWAITING_CLARIFICATION"
+            and stm.get("pending_question")
+            and not stm.get("clarification_sent_at")
+        ):
+            return None
+
+        print("Sending clarification email...")
+        email_trail = stm.get("email_trail")
+        if not isinstance(email_trail, list) or not email_trail:
+            raise RuntimeError("STM missing email trail for clarification")
+        first_email = email_trail[0]
+        original_email_id = first_email.get("email_id")
+        if not isinstance(original_email_id, str) or not original_email_id:
+            raise RuntimeError("STM email trail missing email_id")
+
+        supplier_email_ids = stm.get("supplier_email_ids")
+        if not isinstance(supplier_email_ids, list) or not supplier_email_ids:
+            raise RuntimeError("STM missing supplier email IDs for clarification")
+        supplier_email_id = supplier_email_ids[0]
+        if not isinstance(supplier_email_id, str) or not supplier_email_id:
+            raise RuntimeError("STM supplier email ID invalid")
+
+        draft_body = stm.get("pending_draft_body")
+        if draft_body is not None and not isinstance(draft_body, str):
+            raise RuntimeError("STM pending draft body invalid")
+
+        result = mailer.send_clarification(
+            thread_id=thread_id,
+            original_email_id=original_email_id,
+            original_message_id_header=first_email.get("message_id_header"),
+            supplier_email_id=supplier_email_id,
+            original_subject=processed["clean_text"].split("\n")[0],
+            clarification_question=stm["pending_question"],
+            body_text=draft_body,
+            # Reply from the mailbox the thread lives in.
+            mailbox=email.get("mailbox"),
+        )
+        print("Clarification email result:", result)
+        return result
+
+    def finish(decision: dict) -> str:
+        return decision["classification"]
+
+    def _with_attachments(processed: dict, attachment_text: str | None) -> dict:
+        if attachment_text:
+            processed = dict(processed, attachment_text=attachment_text)
+        return processed
+
+    if resolve_dispute is not None and inspect.iscoroutinefunction(resolve_dispute):
+        async def dispute(processed: dict, decision: dict, attachment_text: str | None):
+            return await resolve_dispute(_with_attachments(processed, attachment_text), decision)
+    elif resolve_dispute is not None:
+        def dispute(processed: dict, decision: dict, attachment_text: str | None):
+            return resolve_dispute(_with_attachments(processed, attachment_text), decision)
+
+    def _classification(context: dict) -> str | None:
+        return (context.get("decision") or {}).get("classification")
+
+    llm_limit = config.llm_concurrency
+    stage_timeout = config.stage_timeout
+    stages: list[Stage] = []
+    if config.context_resolution:
+        stages.append(Stage(
+            "context", resolve_context, inputs=("email",),
+            outputs=("context", "context_email", RESULT_KEY),
+            concurrency=llm_limit, checkpoint=config.checkpoint, timeout=stage_timeout,
+        ))
+    # Preprocessing reads only the email; speculatively it need not wait for context.
+    preprocess_input = (
+        "raw_email=context_email" if config.context_resolution and not config.speculative else "raw_email=email"
+    )
+    stages += [
+        Stage(
+            "preprocess", preprocess_email_llm, inputs=(preprocess_input,), outputs=("preprocessed",),
+            concurrency=llm_limit, checkpoint=config.checkpoint, timeout=stage_timeout,
+        ),
+        Stage(
+            "annotate", annotate,
+            inputs=("preprocessed", "email") + (("context",) if config.context_resolution else ()),
+            outputs=("processed", RESULT_KEY), executor="inline",
+        ),
+        Stage("load_stm", load_stm, inputs=("processed",), outputs=("stm",)),
+        Stage(
+            "classify", classify, inputs=("email", "processed", "stm"),
+            outputs=("decision", "contextual", "attachment_text"),
+            concurrency=llm_limit, checkpoint=config.checkpoint, timeout=stage_timeout,
+        ),
+        Stage("record", record, inputs=("processed", "decision", "contextual", "stm"), outputs=("stm_after",)),
+        Stage(
+            "clarify", clarify, inputs=("email", "processed", "decision", "stm_after"), outputs=("clarification",),
+            when=lambda c: _classification(c) == "AMBIGUOUS" and not c.get("contextual"),
+            timeout=stage_timeout,
+        ),
+    ]
+    extra_stages = list(extra_stages or [])
+    stages += extra_stages
+    if resolve_dispute is not None:
+        stages.append(Stage(
+            "dispute", dispute, inputs=("processed", "decision", "attachment_text"),
+            after=("record",) + tuple(stage.name for stage in extra_stages),
+            when=lambda c: _classification(c) == "DISPUTE",
+            timeout=stage_timeout,
+        ))
+    stages.append(Stage(
+        "finish", finish, inputs=("decision",), outputs=(RESULT_KEY,),
+        after=tuple(stage.name for stage in stages), executor="inline",
+    ))
+    return StageGraph(stages, initial=("email",), name=name)
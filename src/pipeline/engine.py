@@ -0,0 +1,494 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from src.utils.deadlines import DeadlineExceeded, deadline_scope, remaining_seconds
+from src.utils.llm_client import track_token_usage
+
+# Setting this key ends the run: stages that have not started are skipped
+# and running ones are cancelled.
+RESULT_KEY = "outcome"
+EXECUTORS = ("inline", "thread", "process", "async")
+TIMING_WINDOW = 500
+
+
+class StageTimeout(TimeoutError):
+    """A stage ran out of its own timeout or of the run's deadline."""
+
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"stage {stage} timed out after {timeout:.1f}s")
+        self.stage = stage
+        self.timeout = timeout
+
+
+@dataclass
+class Stage:
+    """
+    One step of a pipeline.
+
+    `func` is called with each name in `inputs` as a keyword argument (None
+    when nothing produced it); "arg=key" passes context[key] as `arg`. A single output is bound to the return value;
+    several outputs expect a dict keyed by output name. The stage waits for
+    every stage producing one of its inputs, plus any named in `after`, and
+    is skipped when `when(context)` is false.
+
+    `executor` overrides the engine default for this stage; coroutine
+    functions are always awaited on the event loop. `concurrency` caps how
+    many runs of this stage execute at once across the engine. With
+    `checkpoint`, outputs (which must then be JSON-serialisable) are saved
+    and a resumed run reuses them instead of calling `func` again.
+
+    `timeout` caps the stage in seconds, including any wait for its
+    concurrency slot; the run's remaining deadline caps it further.
+    """
+
+    name: str
+    func: Callable[..., Any]
+    inputs: tuple[str, ...] = ()
+    outputs: tuple[str, ...] = ()
+    when: Callable[[dict], bool] | None = None
+    after: tuple[str, ...] = ()
+    executor: str | None = None
+    concurrency: int | None = None
+    checkpoint: bool = False
+    timeout: float | None = None
+
+    def bindings(self) -> list[tuple[str, str]]:
+        """(argument name, context key) for each input."""
+        return [tuple(item.split("=", 1)) if "=" in item else (item, item) for item in self.inputs]
+
+
+class StageGraph:
+    """Validated set of stages; dependencies come from inputs/outputs and `after`."""
+
+    def __init__(self, stages: list[Stage], initial: tuple[str, ...] = ("email",), name: str = "pipeline"):
+        self.name = name
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError(f"{name}: duplicate stage names")
+
+        producers: dict[str, str] = {}
+        for stage in stages:
+            if stage.executor is not None and stage.executor not in EXECUTORS:
+                raise ValueError(f"{name}: stage {stage.name} has unknown executor {stage.executor!r}")
+            for output in stage.outputs:
+                if output in initial:
+                    raise ValueError(f"{name}: stage {stage.name} overwrites initial input {output!r}")
+                if output in producers and output != RESULT_KEY:
+                    raise ValueError(f"{name}: {output!r} produced by both {producers[output]} and {stage.name}")
+                producers.setdefault(output, stage.name)
+        self.initial = initial
+
+        self.dependencies: dict[str, set[str]] = {}
+        for stage in stages:
+            deps = set(stage.after)
+            for _arg, item in stage.bindings():
+                if item in initial:
+                    continue
+                if item not in producers:
+                    raise ValueError(f"{name}: stage {stage.name} needs {item!r}, which nothing produces")
+                deps.update(s.name for s in stages if item in s.outputs)
+            unknown = deps - self.stages.keys()
+            if unknown:
+                raise ValueError(f"{name}: stage {stage.name} runs after unknown stages {sorted(unknown)}")
+            deps.discard(stage.name)
+            self.dependencies[stage.name] = deps
+        self._check_acyclic()
+
+    def _check_acyclic(self) -> None:
+        remaining = {name: set(deps) for name, deps in self.dependencies.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"{self.name}: dependency cycle among {sorted(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+
+class _StageStats:
+    def __init__(self):
+        self.runs = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.timeouts = 0
+        self.tokens = 0
+        # Tokens of cancelled or timed-out runs, booked once their threads return.
+        self.wasted_tokens = 0
+        self._waste_lock = threading.Lock()
+        self.total_seconds = 0.0
+        self.durations: deque[float] = deque(maxlen=TIMING_WINDOW)
+
+    def as_dict(self) -> dict:
+        durations = sorted(self.durations)
+
+        def _pct(q: float) -> float | None:
+            if not durations:
+                return None
+            return round(durations[min(len(durations) - 1, int(q * len(durations)))], 3)
+
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "resumed": self.resumed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "timeouts": self.timeouts,
+            "mean_s": round(statistics.fmean(durations), 3) if durations else None,
+            "p50_s": _pct(0.50),
+            "p95_s": _pct(0.95),
+            "tokens": self.tokens,
+            "wasted_tokens": self.wasted_tokens,
+        }
+
+    def book_waste(self, tokens: int) -> None:
+        with self._waste_lock:
+            self.wasted_tokens += tokens
+
+
+class _StageCall:
+    """
+    Books the tokens of a stage run that was cancelled or timed out once
+    they are final. A thread cannot be interrupted, so a stage running in
+    one keeps spending after it is abandoned; its tokens are booked when the
+    thread returns. A run abandoned before its thread started never runs.
+    """
+
+    def __init__(self, stats: _StageStats, usage: dict):
+        self._stats = stats
+        self._usage = usage
+        self._lock = threading.Lock()
+        self._in_thread = False
+        self._abandoned = False
+
+    def run(self, call: Callable[[], Any]) -> Any:
+        """Run `call` in the worker thread."""
+        with self._lock:
+            if self._abandoned:
+                return None
+            self._in_thread = True
+        try:
+            return call()
+        finally:
+            with self._lock:
+                self._in_thread = False
+                if self._abandoned:
+                    self._stats.book_waste(self._usage.get("total_tokens", 0))
+
+    def abandon(self) -> None:
+        with self._lock:
+            self._abandoned = True
+            if not self._in_thread:
+                self._stats.book_waste(self._usage.get("total_tokens", 0))
+
+
+def _importable(func: Callable[..., Any]) -> bool:
+    """Whether a process pool can pickle `func`, i.e. find it again by module and name."""
+    if inspect.iscoroutinefunction(func):
+        return True  # awaited on the event loop, never sent to the pool
+    while isinstance(func, functools.partial):
+        func = func.func
+    qualname = getattr(func, "__qualname__", "")
+    return bool(qualname) and "<locals>" not in qualname and "<lambda>" not in qualname
+
+
+class PipelineEngine:
+    """
+    Runs a StageGraph once per email. Stages whose dependencies are settled
+    run concurrently; the run ends when every stage has run or been
+    skipped, or as soon as a stage sets RESULT_KEY.
+
+    `executor` is the default way to call synchronous stage functions:
+    "inline" (on the caller, one at a time), "thread" (a pool of
+    `max_workers` threads), "process" (a process pool; stage functions must
+    be module-level and their arguments picklable, and token tracking and
+    the deadline stay behind in this process) or "async" (asyncio's default
+    thread pool). `checkpoints` is any object with load(run_id) and
+    save(run_id, stage, output), e.g. StageCheckpoints.
+
+    Each run gets `budget_seconds` (or an explicit `deadline`). Every
+    stage is given what is left of it, capped by its own `timeout`, and is
+    cancelled when that runs out; the run then fails with StageTimeout. The
+    deadline is visible to stage code through src.utils.deadlines, so
+    blocking clients can size their own request timeouts from it. A thread
+    cannot be interrupted: a timed-out stage's thread runs on until its
+    client call returns, but its worker slot is released at once. Inline
+    stages block the event loop and cannot be timed out at all.
+    """
+
+    def __init__(
+        self,
+        graph: StageGraph,
+        executor: str = "inline",
+        max_workers: int = 8,
+        checkpoints=None,
+        budget_seconds: float | None = None,
+    ):
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor {executor!r}; expected one of {EXECUTORS}")
+        for stage in graph.stages.values():
+            if (stage.executor or executor) == "process" and not _importable(stage.func):
+                raise ValueError(
+                    f"{graph.name}: stage {stage.name} cannot run in a process; "
+                    f"{getattr(stage.func, '__qualname__', stage.func)!r} is not a module-level function"
+                )
+        self.graph = graph
+        self.executor = executor
+        self.max_workers = max_workers
+        self.checkpoints = checkpoints
+        self.budget_seconds = budget_seconds
+        self._pools: dict[str, Executor] = {}
+        self._limits = {
+            stage.name: asyncio.Semaphore(stage.concurrency)
+            for stage in graph.stages.values()
+            if stage.concurrency
+        }
+        self._stats = {name: _StageStats() for name in graph.stages}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.runs = 0
+        self.wall_seconds = 0.0
+        self.overlap_seconds = 0.0
+        self.deadline_exceeded = 0
+
+    # ------------------------------------------------------------------
+    # Executors
+    # ------------------------------------------------------------------
+    def _pool(self, kind: str) -> Executor:
+        if kind not in self._pools:
+            if kind == "process":
+                self._pools[kind] = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._pools[kind] = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=f"{self.graph.name}-stage"
+                )
+        return self._pools[kind]
+
+    async def _call(self, stage: Stage, kwargs: dict, ledger: _StageCall) -> Any:
+        if inspect.iscoroutinefunction(stage.func):
+            return await stage.func(**kwargs)
+        kind = stage.executor or self.executor
+        if kind == "inline":
+            return stage.func(**kwargs)
+
+        call = functools.partial(stage.func, **kwargs)
+        if kind == "process":
+            return await asyncio.get_running_loop().run_in_executor(self._pool(kind), call)
+        call = functools.partial(ledger.run, call)
+        if kind == "async":
+            return await asyncio.to_thread(call)
+        # Carry context variables (token tracking) into the worker thread.
+        context = contextvars.copy_context()
+        future = self._pool(kind).submit(context.run, call)
+        return await asyncio.wrap_future(future)
+
+    async def _run_stage(self, stage: Stage, context: dict, done: dict, run_id: str | None) -> tuple[dict, float]:
+        stats = self._stats[stage.name]
+        if stage.checkpoint and stage.name in done:
+            saved = done[stage.name]["output"]
+            if len(stage.outputs) <= 1 or (isinstance(saved, dict) and set(stage.outputs) <= saved.keys()):
+                print(f"[{run_id}] Resuming: stage {stage.name} already done at {done[stage.name].get('at')}")
+                stats.resumed += 1
+                return self._bind(stage, saved), 0.0
+
+        kwargs = {arg: context.get(key) for arg, key in stage.bindings()}
+        timeout = self._stage_timeout(stage)
+        elapsed = 0.0
+        with track_token_usage() as usage:
+            ledger = _StageCall(stats, usage)
+            started = time.monotonic()
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise DeadlineExceeded(f"no budget left for stage {stage.name}")
+                result = await self._call_within(stage, kwargs, timeout, ledger)
+            except asyncio.CancelledError:
+                stats.cancelled += 1
+                # A cancelled thread still finishes; whatever it spends is waste.
+                ledger.abandon()
+                raise
+            except (StageTimeout, DeadlineExceeded):
+                stats.timeouts += 1
+                ledger.abandon()
+                raise StageTimeout(stage.name, time.monotonic() - started) from None
+            except Exception:
+                stats.failed += 1
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                stats.total_seconds += elapsed
+                stats.durations.append(elapsed)
+        stats.runs += 1
+        stats.tokens += usage.get("total_tokens", 0)
+
+        outputs = self._bind(stage, result)
+        if stage.checkpoint and self.checkpoints is not None and run_id:
+            saved = result if len(stage.outputs) <= 1 else {k: outputs.get(k) for k in stage.outputs}
+            await asyncio.to_thread(self.checkpoints.save, run_id, stage.name, saved)
+        return outputs, elapsed
+
+    @staticmethod
+    def _stage_timeout(stage: Stage) -> float | None:
+        left = remaining_seconds()
+        if left is None:
+            return stage.timeout
+        return left if stage.timeout is None else min(stage.timeout, left)
+
+    async def _call_within(self, stage: Stage, kwargs: dict, timeout: float | None, ledger: _StageCall) -> Any:
+        async def call() -> Any:
+            limit = self._limits.get(stage.name)
+            if limit:
+                async with limit:
+                    return await self._call(stage, kwargs, ledger)
+            return await self._call(stage, kwargs, ledger)
+
+        if timeout is None:
+            return await call()
+        # Not wait_for: a TimeoutError raised by the stage itself must stay
+        # a failure of the stage, not look like the stage running out of time.
+        task = asyncio.ensure_future(call())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not done:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise StageTimeout(stage.name, timeout)
+        return task.result()
+
+    @staticmethod
+    def _bind(stage: Stage, result: Any) -> dict:
+        if not stage.outputs:
+            return {}
+        if len(stage.outputs) == 1:
+            return {stage.outputs[0]: result}
+        if not isinstance(result, dict):
+            raise TypeError(f"Stage {stage.name} must return a dict with keys {stage.outputs}")
+        return {name: result.get(name) for name in stage.outputs}
+
+    # ------------------------------------------------------------------
+    # Running
+    # ------------------------------------------------------------------
+    async def run_async(self, run_id: str | None = None, deadline: float | None = None, **initial: Any) -> dict:
+        """
+        Run the graph over `initial` inputs and return the final context.
+        `deadline` (time.monotonic()) defaults to now plus `budget_seconds`.
+        """
+        if deadline is None and self.budget_seconds:
+            deadline = time.monotonic() + self.budget_seconds
+        with deadline_scope(deadline):
+            try:
+                return await self._run(run_id, initial)
+            except StageTimeout as exc:
+                self.deadline_exceeded += 1
+                print(f"[{run_id}] {exc}")
+                raise
+
+    async def _run(self, run_id: str | None, initial: dict) -> dict:
+        missing = [name for name in self.graph.initial if name not in initial]
+        if missing:
+            raise ValueError(f"{self.graph.name}: missing initial inputs {missing}")
+
+        context = dict(initial)
+        done = {}
+        if self.checkpoints is not None and run_id:
+            done = await asyncio.to_thread(self.checkpoints.load, run_id)
+
+        pending = dict(self.graph.dependencies)
+        settled: set[str] = set()
+        running: dict[asyncio.Task, Stage] = {}
+        started = time.monotonic()
+        busy_seconds = 0.0
+
+        try:
+            while pending or running:
+                if context.get(RESULT_KEY) is not None:
+                    for name in pending:
+                        self._stats[name].skipped += 1
+                    pending.clear()
+                    for task in running:
+                        task.cancel()
+                    await asyncio.gather(*running, return_exceptions=True)
+                    break
+
+                # A skipped stage settles at once and may unblock others, so
+                # keep scanning until nothing new becomes ready.
+                ready = [n for n, deps in pending.items() if deps <= settled]
+                while ready:
+                    for name in ready:
+                        del pending[name]
+                        stage = self.graph.stages[name]
+                        if stage.when is not None and not stage.when(context):
+                            self._stats[name].skipped += 1
+                            settled.add(name)
+                            continue
+                        task = asyncio.create_task(self._run_stage(stage, context, done, run_id))
+                        running[task] = stage
+                    ready = [n for n, deps in pending.items() if deps <= settled]
+
+                if not running:
+                    if pending:
+                        # Only reachable if dependencies were skipped in a way
+                        # that leaves nothing runnable; treat the rest as skipped.
+                        for name in pending:
+                            self._stats[name].skipped += 1
+                        pending.clear()
+                    break
+
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    stage = running.pop(task)
+                    outputs, elapsed = task.result()
+                    context.update(outputs)
+                    busy_seconds += elapsed
+                    settled.add(stage.name)
+        except BaseException:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+        finally:
+            wall = time.monotonic() - started
+            self.runs += 1
+            self.wall_seconds += wall
+            # Time saved by running independent stages side by side.
+            self.overlap_seconds += max(busy_seconds - wall, 0.0)
+        return context
+
+    def run(self, run_id: str | None = None, deadline: float | None = None, **initial: Any) -> dict:
+        """Blocking `run_async` for synchronous entry points."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.run_async(run_id=run_id, deadline=deadline, **initial))
+
+    def close(self) -> None:
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools.clear()
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+
+    def metrics(self) -> dict:
+        return {
+            "graph": self.graph.name,
+            "executor": self.executor,
+            "runs": self.runs,
+            "mean_wall_s": round(self.wall_seconds / self.runs, 3) if self.runs else None,
+            "overlap_saved_s": round(self.overlap_seconds, 3),
+            "timed_out_runs": self.deadline_exceeded,
+            "stages": {name: stats.as_dict() for name, stats in self._stats.items()},
+        }
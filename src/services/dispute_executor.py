@@ -0,0 +1,363 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+import redis
+
+from src.services.retry_queue import (
+    DEFAULT_BASE_DELAY_SECONDS,
+    DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_MAX_DELAY_SECONDS,
+)
+from src.utils.circuit_breaker import CircuitOpen
+from src.utils.deadlines import deadline_scope
+
+DISPUTE_JOBS_KEY = "dispute:jobs"
+DISPUTE_LEASE_PREFIX = "dispute:lease:"
+DEFAULT_LEASE_MS = 60_000
+RECOVER_INTERVAL_SECONDS = 60.0
+LATENCY_WINDOW = 500
+STATUS_HISTORY = 10_000
+
+# Renew or release a job lease only while this executor still holds it.
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class DisputeJobExecutor:
+    """
+    Bounded background executor for dispute resolution (claim extraction
+    plus the Postgres writes), so triage can label an email and move on as
+    soon as its classification and STM are saved.
+
+    `resolve(processed, decision, state)` does the work; `state` is a dict
+    kept across attempts (e.g. the extracted claim) so a retry does not
+    repeat finished steps. Failed jobs are retried with the RetryQueue
+    backoff (capped, with jitter) up to `max_attempts`, then kept with
+    status "failed" until replayed (`python -m src.services.dispute_executor`).
+
+    With `timeout_seconds`, an attempt that runs longer is cancelled and
+    counts as a failure; the deadline also bounds the LLM and database
+    calls it makes.
+
+    A job that hits an open circuit breaker is parked until the breaker
+    lets calls through again; that does not count as an attempt.
+
+    With a Redis `store`, each job is written to the DISPUTE_JOBS_KEY hash
+    when submitted and removed when it succeeds. While a job is queued,
+    running or waiting to retry, this executor holds a lease on it, renewed
+    every `lease_ms / 3`. `recover()`, run at start and every
+    RECOVER_INTERVAL_SECONDS, takes over jobs whose lease has lapsed, i.e.
+    those of a crashed process and replayed failures, never a job another
+    live process is working on.
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[dict, dict, dict], Awaitable[Any]],
+        workers: int = 2,
+        max_queue: int = 200,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        retry_base_seconds: float = DEFAULT_BASE_DELAY_SECONDS,
+        store: redis.Redis | None = None,
+        timeout_seconds: float | None = None,
+        max_retry_seconds: float = DEFAULT_MAX_DELAY_SECONDS,
+        lease_ms: int = DEFAULT_LEASE_MS,
+    ):
+        self.resolve = resolve
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.store = store
+        self.timeout_seconds = timeout_seconds
+        self.lease_ms = lease_ms
+        self._token = uuid.uuid4().hex
+        # email_ids whose lease this executor holds
+        self._held: set[str] = set()
+        if store is not None:
+            self._renew = store.register_script(_RENEW_SCRIPT)
+            self._release = store.register_script(_RELEASE_SCRIPT)
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_queue)
+        self._tasks: list[asyncio.Task] = []
+        self._delayed: set[asyncio.Task] = set()
+        self._status: OrderedDict[str, str] = OrderedDict()
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.timed_out = 0
+        self.parked = 0
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"dispute-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        if self.store is not None:
+            self._tasks.append(asyncio.create_task(self._lease_loop(), name="dispute-leases"))
+
+    def _acquire(self, email_id: str) -> bool:
+        """Lease a job; False only if another executor holds it. Redis errors propagate."""
+        if self.store is None:
+            return True
+        acquired = bool(
+            self.store.set(DISPUTE_LEASE_PREFIX + email_id, self._token, nx=True, px=self.lease_ms)
+        )
+        if acquired:
+            self._held.add(email_id)
+        return acquired
+
+    def _give_up(self, email_id: str) -> None:
+        self._held.discard(email_id)
+        if self.store is None:
+            return
+        try:
+            self._release(keys=[DISPUTE_LEASE_PREFIX + email_id], args=[self._token])
+        except redis.RedisError as exc:
+            print(f"[{email_id}] Failed to release dispute job lease:", exc)
+
+    def _renew_leases(self) -> None:
+        for email_id in list(self._held):
+            if not self._renew(keys=[DISPUTE_LEASE_PREFIX + email_id], args=[self._token, self.lease_ms]):
+                print(f"[{email_id}] Dispute job lease lapsed; another process may take it over")
+
+    async def _lease_loop(self) -> None:
+        last_recovery = time.monotonic()
+        while True:
+            await asyncio.sleep(self.lease_ms / 3000)
+            try:
+                await asyncio.to_thread(self._renew_leases)
+            except redis.RedisError as exc:
+                print("Failed to renew dispute job leases:", exc)
+            if time.monotonic() - last_recovery >= RECOVER_INTERVAL_SECONDS:
+                last_recovery = time.monotonic()
+                try:
+                    recovered = await self.recover()
+                except redis.RedisError as exc:
+                    print("Failed to recover dispute jobs:", exc)
+                    continue
+                if recovered:
+                    print(f"Recovered {recovered} unfinished dispute resolutions")
+
+    def _persist(self, job: dict) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.hset(DISPUTE_JOBS_KEY, job["email_id"], json.dumps(job, default=str))
+        except redis.RedisError as exc:
+            print(f"[{job['email_id']}] Failed to persist dispute job:", exc)
+
+    def _forget(self, email_id: str) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.hdel(DISPUTE_JOBS_KEY, email_id)
+        except redis.RedisError as exc:
+            print(f"[{email_id}] Failed to clear dispute job:", exc)
+
+    async def submit(self, processed: dict, decision: dict) -> bool:
+        """
+        Queue a dispute; waits only while the queue is full. False if it is
+        already in hand elsewhere. A Redis error while leasing it raises, so
+        the triage run fails and is retried instead of dropping the dispute.
+        """
+        job = {
+            "email_id": processed.get("email_id"),
+            "processed": processed,
+            "decision": decision,
+            "state": {},
+            "attempts": 0,
+            "status": "queued",
+            "submitted_at": datetime.now(timezone.utc).isoformat(),
+        }
+        if not await asyncio.to_thread(self._acquire, job["email_id"]):
+            # A retried triage of an email whose dispute is already in hand.
+            print(f"[{job['email_id']}] Dispute already being resolved elsewhere; not resubmitting")
+            return False
+        await asyncio.to_thread(self._persist, job)
+        await self._enqueue(job)
+        return True
+
+    def _set_status(self, email_id: str, status: str) -> None:
+        self._status[email_id] = status
+        self._status.move_to_end(email_id)
+        while len(self._status) > STATUS_HISTORY:
+            self._status.popitem(last=False)
+
+    async def _enqueue(self, job: dict) -> None:
+        job["_enqueued_at"] = time.monotonic()
+        self._set_status(job["email_id"], "queued")
+        await self._queue.put(job)
+
+    async def recover(self) -> int:
+        """Re-queue unfinished jobs that no live executor holds a lease on."""
+        if self.store is None:
+            return 0
+        raw_jobs = await asyncio.to_thread(self.store.hgetall, DISPUTE_JOBS_KEY)
+        recovered = 0
+        for raw in raw_jobs.values():
+            job = json.loads(raw)
+            if job.get("status") == "failed" or job["email_id"] in self._held:
+                continue
+            if not await asyncio.to_thread(self._acquire, job["email_id"]):
+                continue
+            await self._enqueue(job)
+            recovered += 1
+        return recovered
+
+    def status(self, email_id: str) -> str | None:
+        return self._status.get(email_id)
+
+    async def _retry_later(self, job: dict, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self._enqueue(job)
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_retry_seconds, self.retry_base_seconds * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _schedule_retry(self, job: dict, delay: float) -> None:
+        task = asyncio.create_task(self._retry_later(job, delay))
+        self._delayed.add(task)
+        task.add_done_callback(self._delayed.discard)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            email_id = job["email_id"]
+            self._set_status(email_id, "running")
+            job["attempts"] += 1
+            deadline = time.monotonic() + self.timeout_seconds if self.timeout_seconds else None
+            try:
+                with deadline_scope(deadline):
+                    await asyncio.wait_for(
+                        self.resolve(job["processed"], job["decision"], job["state"]),
+                        timeout=self.timeout_seconds,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except CircuitOpen as exc:
+                job["attempts"] -= 1
+                job["status"] = "parked"
+                self._set_status(email_id, "parked")
+                self.parked += 1
+                self._schedule_retry(job, exc.retry_after)
+                await asyncio.to_thread(self._persist, job)
+            except Exception as exc:
+                if isinstance(exc, asyncio.TimeoutError):
+                    self.timed_out += 1
+                    exc = TimeoutError(f"dispute resolution exceeded {self.timeout_seconds}s")
+                job["last_error"] = f"{type(exc).__name__}: {exc}"
+                if job["attempts"] >= self.max_attempts:
+                    job["status"] = "failed"
+                    self._set_status(email_id, "failed")
+                    self.failed += 1
+                    print(
+                        f"[{email_id}] Dispute resolution failed after {job['attempts']} attempts; "
+                        "replay with `python -m src.services.dispute_executor replay`:",
+                        exc,
+                    )
+                else:
+                    job["status"] = "retrying"
+                    self._set_status(email_id, "retrying")
+                    self.retried += 1
+                    self._schedule_retry(job, self.backoff(job["attempts"]))
+                await asyncio.to_thread(self._persist, job)
+                if job["status"] == "failed":
+                    await asyncio.to_thread(self._give_up, email_id)
+            else:
+                await asyncio.to_thread(self._forget, email_id)
+                await asyncio.to_thread(self._give_up, email_id)
+                self._set_status(email_id, "done")
+                self.completed += 1
+                self._latencies.append(time.monotonic() - job["_enqueued_at"])
+            finally:
+                self._queue.task_done()
+
+    async def drain(self) -> None:
+        """
+        Wait for queued and running jobs to settle. Jobs waiting out a retry
+        backoff are not waited for; they stay persisted and, once `stop`
+        releases their leases, any executor's `recover` picks them up.
+        """
+        await self._queue.join()
+
+    async def stop(self) -> None:
+        for task in [*self._tasks, *self._delayed]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._delayed, return_exceptions=True)
+        self._tasks = []
+        for email_id in list(self._held):
+            await asyncio.to_thread(self._give_up, email_id)
+
+    def metrics(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            "queued": self._queue.qsize(),
+            "waiting_retry": len(self._delayed),
+            "running": sum(1 for status in self._status.values() if status == "running"),
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "parked": self.parked,
+            "latency_p50_s": round(latencies[len(latencies) // 2], 3) if latencies else None,
+        }
+
+
+def replay_failed(store: redis.Redis, email_ids: list[str] | None = None) -> int:
+    """Reset failed jobs (all, or just `email_ids`) so the next `recover` runs them with a fresh attempt budget."""
+    replayed = 0
+    for email_id, raw in store.hgetall(DISPUTE_JOBS_KEY).items():
+        job = json.loads(raw)
+        if job.get("status") != "failed" or (email_ids is not None and job["email_id"] not in email_ids):
+            continue
+        job["status"] = "queued"
+        job["attempts"] = 0
+        job["replayed_at"] = datetime.now(timezone.utc).isoformat()
+        store.hset(DISPUTE_JOBS_KEY, email_id, json.dumps(job, default=str))
+        replayed += 1
+    return replayed
+
+
+def main() -> None:
+    from src.db.redis_client import get_redis_client
+
+    parser = argparse.ArgumentParser(description="Inspect and replay failed dispute resolutions.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="Show unfinished and failed dispute jobs")
+    replay = sub.add_parser("replay", help="Retry failed dispute jobs")
+    replay.add_argument("email_ids", nargs="*", help="Only these emails (default: all)")
+
+    args = parser.parse_args()
+    store = get_redis_client()
+    if args.command == "list":
+        for raw in store.hgetall(DISPUTE_JOBS_KEY).values():
+            job = json.loads(raw)
+            print(f"{job['email_id']}  status={job.get('status')}  attempts={job.get('attempts')}")
+            print(f"    error: {job.get('last_error')}")
+    else:
+        print("Replayed dispute jobs:", replay_failed(store, args.email_ids or None))
+
+
+if __name__ == "__main__":
+    main()
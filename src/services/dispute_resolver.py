@@ -7,9 +7,12 @@ from typing import Any, Optional
 from psycopg2.extras import RealDictCursor
 
 from src.db.postgres import db_connection
+from src.utils.single_flight import SingleFlight
 
 AMOUNT_TOLERANCE = Decimal("1.00")  # INR tolerance; adjust per currency
 
+_supplier_flight = SingleFlight("supplier_lookup")
+
 
 @dataclass
 class DisputeResolution:
@@ -25,6 +28,12 @@ class DisputeResolution:
 
 
 def _fetch_supplier_id(cursor: RealDictCursor, supplier_email: str) -> int:
+    # A plain read, so concurrent disputes from one supplier can share the
+    # first caller's query instead of each running it on their own cursor.
+    return _supplier_flight.do(supplier_email.lower(), _query_supplier_id, cursor, supplier_email)
+
+
+def _query_supplier_id(cursor: RealDictCursor, supplier_email: str) -> int:
     cursor.execute(
         """
         SELECT supplier_id
@@ -217,9 +226,13 @@ def resolve_dispute_case(
                         dispute_valid = False
                         resolution_reason = "AMOUNT_MISMATCH_INVALID"
 
+            # An attempt the executor timed out may still be running in its
+            # thread; whichever commits first writes the case and counts it
+            # in supplier_ltm, the other finds the row and leaves both alone.
             cursor.execute(
                 """
                 INSERT INTO dispute_cases (
+                    email_id,
                     supplier_id,
                     invoice_id,
                     invoice_number,
@@ -229,10 +242,12 @@ def resolve_dispute_case(
                     confidence_score,
                     resolution_reason
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (email_id) DO NOTHING
                 RETURNING *;
                 """,
                 (
+                    processed_email.get("email_id"),
                     supplier_id,
                     invoice_id,
                     invoice_number,
@@ -245,8 +260,17 @@ def resolve_dispute_case(
             )
             dispute_case_row = cursor.fetchone()
 
-            _upsert_supplier_ltm(cursor, supplier_id)
-            supplier_ltm_row = _update_supplier_ltm(cursor, supplier_id, dispute_valid)
+            if dispute_case_row is None:
+                cursor.execute(
+                    "SELECT * FROM dispute_cases WHERE email_id = %s",
+                    (processed_email.get("email_id"),),
+                )
+                dispute_case_row = cursor.fetchone()
+                cursor.execute("SELECT * FROM supplier_ltm WHERE supplier_id = %s", (supplier_id,))
+                supplier_ltm_row = cursor.fetchone()
+            else:
+                _upsert_supplier_ltm(cursor, supplier_id)
+                supplier_ltm_row = _update_supplier_ltm(cursor, supplier_id, dispute_valid)
 
         conn.commit()
 
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import re
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+from typing import Callable
+
+# Lower runs first.
+PRIORITY_CLARIFICATION_REPLY = 0
+PRIORITY_HIGH_VALUE = 1
+PRIORITY_NORMAL = 2
+
+# "INR 1,25,000.50", "Rs. 4500", "₹ 12,000", "$1,200", "USD 300", "€90".
+# Alphabetic prefixes need a word boundary ("orders 120000" is not Rs), and
+# an unseparated run of ten or more digits is a PO or invoice number.
+_NUMBER = r"(\d{1,3}(?:,\d{2,3})+(?:\.\d{1,2})?|\d{1,9}(?:\.\d{1,2})?)(?![\d,]*\d|\w)"
+_AMOUNT_PATTERN = re.compile(
+    rf"(?:₹|\$|€|£|\b(?:rs\.?|inr|usd|eur|gbp))\s?{_NUMBER}"
+    rf"|\b{_NUMBER}\s?(?:inr|usd|eur|gbp|rupees|dollars)\b",
+    re.IGNORECASE,
+)
+MAX_SCANNED_CHARS = 20_000
+
+
+def largest_claimed_amount(email: dict) -> Decimal | None:
+    """
+    Largest currency amount mentioned in the subject or body, as a cheap
+    stand-in for the claim extractor's figure before any LLM has run.
+    """
+    text = f"{email.get('subject') or ''}\n{email.get('body') or email.get('snippet') or ''}"
+    largest = None
+    for match in _AMOUNT_PATTERN.finditer(text[:MAX_SCANNED_CHARS]):
+        raw = (match.group(1) or match.group(2)).replace(",", "")
+        try:
+            amount = Decimal(raw)
+        except InvalidOperation:
+            continue
+        if largest is None or amount > largest:
+            largest = amount
+    return largest
+
+
+class SupplierRiskCache:
+    """
+    supplier email -> supplier_ltm.risk_score, reloaded in full at most
+    every `ttl_seconds`. Prioritising runs on every fetched email, so this
+    trades freshness for one query per TTL instead of one per email. When
+    Postgres is unavailable the last loaded scores are kept.
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0):
+        self.ttl_seconds = ttl_seconds
+        self._scores: dict[str, float] = {}
+        self._loaded_at: float | None = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict[str, float]:
+        from src.db.postgres import db_connection
+
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT LOWER(s.supplier_email) AS supplier_email, l.risk_score
+                    FROM suppliers s
+                    JOIN supplier_ltm l ON l.supplier_id = s.supplier_id
+                    """
+                )
+                return {row["supplier_email"]: float(row["risk_score"]) for row in cursor.fetchall()}
+
+    def risk_score(self, supplier_email: str | None) -> float | None:
+        if not supplier_email:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded_at is None or now - self._loaded_at >= self.ttl_seconds:
+                # Stamp first so a failing database is retried once per TTL, not per email.
+                self._loaded_at = now
+                try:
+                    self._scores = self._load()
+                except Exception as exc:
+                    print("Failed to load supplier risk scores:", exc)
+            return self._scores.get(supplier_email.lower())
+
+
+class EmailPrioritizer:
+    """
+    Orders incoming mail by how much it unblocks:
+
+    0. replies on a thread AWAITING_CLARIFICATION, which release a
+       conversation already waiting on the supplier;
+    1. mail from suppliers whose risk_score is at least `risk_threshold`,
+       or mentioning an amount of at least `amount_threshold`;
+    2. everything else.
+
+    Starvation is left to the queue: EmailWorkerPool ages waiting emails.
+    """
+
+    def __init__(
+        self,
+        risk_lookup: Callable[[str | None], float | None] | None = None,
+        risk_threshold: float = 50.0,
+        amount_threshold: Decimal | float = Decimal("100000"),
+    ):
+        self.risk_lookup = risk_lookup
+        self.risk_threshold = risk_threshold
+        self.amount_threshold = Decimal(str(amount_threshold))
+        self.counts = {PRIORITY_CLARIFICATION_REPLY: 0, PRIORITY_HIGH_VALUE: 0, PRIORITY_NORMAL: 0}
+
+    def priority(self, email: dict, stm: dict | None, supplier: str | None) -> tuple[int, str]:
+        """(priority, reason) for `email`; `stm` is its conversation's record, if any."""
+        priority, reason = self._classify(email, stm, supplier)
+        self.counts[priority] += 1
+        return priority, reason
+
+    def _classify(self, email: dict, stm: dict | None, supplier: str | None) -> tuple[int, str]:
+        if stm and stm.get("state") == "AWAITING_CLARIFICATION":
+            return PRIORITY_CLARIFICATION_REPLY, "clarification reply"
+        if self.risk_lookup is not None:
+            try:
+                risk = self.risk_lookup(supplier)
+            except Exception as exc:
+                print(f"[{email.get('email_id')}] Risk lookup failed:", exc)
+                risk = None
+            if risk is not None and risk >= self.risk_threshold:
+                return PRIORITY_HIGH_VALUE, f"supplier risk {risk:g}"
+        amount = largest_claimed_amount(email)
+        if amount is not None and amount >= self.amount_threshold:
+            return PRIORITY_HIGH_VALUE, f"amount {amount}"
+        return PRIORITY_NORMAL, "normal"
+
+    def metrics(self) -> dict:
+        return {
+            "clarification_replies": self.counts[PRIORITY_CLARIFICATION_REPLY],
+            "high_value": self.counts[PRIORITY_HIGH_VALUE],
+            "normal": self.counts[PRIORITY_NORMAL],
+        }
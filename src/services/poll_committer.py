@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from src.agents.gmail_watcher import BATCH_MODIFY_SIZE, RETRYABLE_STATUSES
+from src.utils.circuit_breaker import CircuitOpen
+
+LABELED_SET_KEY = "labeled:email_ids"
+
+
+class PollCommitter:
+    """
+    Collects the side effects of one poll cycle and applies them in bulk.
+
+    Processed marks go out as one SADD. Gmail labels are grouped by label set
+    and written with users.messages.batchModify. An email is only added to
+    LABELED_SET_KEY once its batch succeeds, and anything already in that set
+    is filtered out before sending, so a retried flush never re-labels an
+    email that was labeled before.
+
+    Labels for an email from another mailbox go through that mailbox's
+    client in `mailbox_services`; untagged emails use `gmail_service`.
+    """
+
+    def __init__(
+        self,
+        gmail_service,
+        store,
+        processed_key: str,
+        labeled_key: str = LABELED_SET_KEY,
+        max_attempts: int = 3,
+        retry_base_seconds: float = 1.0,
+        mailbox_services: dict | None = None,
+    ):
+        self.gmail_service = gmail_service
+        self.mailbox_services = mailbox_services or {}
+        self.store = store
+        self.processed_key = processed_key
+        self.labeled_key = labeled_key
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self._processed: list[str] = []
+        self._labels: dict[str, tuple[str | None, tuple[str, ...]]] = {}
+        # Workers record results on the event loop while flush runs in a thread.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def mark_processed(self, email_id: str) -> None:
+        with self._lock:
+            self._processed.append(email_id)
+
+    def add_labels(self, email_id: str, label_ids: list[str], mailbox: str | None = None) -> None:
+        if label_ids:
+            with self._lock:
+                self._labels[email_id] = (mailbox, tuple(sorted(set(label_ids))))
+
+    def _settle(self, email_ids: list[str]) -> None:
+        with self._lock:
+            for email_id in email_ids:
+                self._labels.pop(email_id, None)
+
+    def flush(self) -> None:
+        """Write pending marks and labels. Failed label batches stay queued for the next flush."""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            processed, self._processed = self._processed, []
+            labels = dict(self._labels)
+
+        if processed:
+            try:
+                self.store.sadd(self.processed_key, *processed)
+            except Exception:
+                with self._lock:
+                    self._processed[:0] = processed
+                raise
+
+        if not labels:
+            return
+
+        email_ids = list(labels)
+        already = self.store.smismember(self.labeled_key, *email_ids)
+        done_ids = [email_id for email_id, done in zip(email_ids, already) if done]
+        self._settle(done_ids)
+        for email_id in done_ids:
+            del labels[email_id]
+
+        groups: dict[tuple[str | None, tuple[str, ...]], list[str]] = {}
+        for email_id, mailbox_labels in labels.items():
+            groups.setdefault(mailbox_labels, []).append(email_id)
+
+        for (mailbox, label_ids), ids in groups.items():
+            service = self.mailbox_services.get(mailbox, self.gmail_service)
+            for start in range(0, len(ids), BATCH_MODIFY_SIZE):
+                chunk = ids[start:start + BATCH_MODIFY_SIZE]
+                outcome = self._modify_with_retry(service, chunk, list(label_ids))
+                if outcome == "deferred":
+                    continue
+                if outcome == "applied":
+                    self.store.sadd(self.labeled_key, *chunk)
+                self._settle(chunk)
+
+    def _modify_with_retry(self, service, message_ids: list[str], label_ids: list[str]) -> str:
+        """Return "applied", "failed" (permanent error, dropped) or "deferred" (retry next flush)."""
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.retry_base_seconds * (2 ** (attempt - 1)))
+            try:
+                service.users().messages().batchModify(
+                    userId="me",
+                    body={"ids": message_ids, "addLabelIds": label_ids, "removeLabelIds": []},
+                ).execute()
+                return "applied"
+            except CircuitOpen as exc:
+                # No point backing off here; Gmail was already failing.
+                print(f"Deferring labels on {len(message_ids)} emails:", exc)
+                return "deferred"
+            except HttpError as exc:
+                if exc.resp.status not in RETRYABLE_STATUSES:
+                    print("Failed to mark labels:", exc)
+                    return "failed"
+        print(f"Failed to mark labels on {len(message_ids)} emails; will retry next cycle")
+        return "deferred"
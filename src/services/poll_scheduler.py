@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Callable
+
+from src.agents.gmail_watcher import PROCESSED_LABEL_NAME, default_header_filter, fetch_email_batch
+
+
+class AdaptivePollScheduler:
+    """
+    Decides how much to fetch and how long to wait between Gmail polls.
+
+    - Batch size shrinks as the downstream queue fills (`queue_depth`), so a
+      burst is pulled in as fast as it can be processed and no faster.
+    - While Gmail reports more pending messages, the next poll runs
+      immediately, draining the backlog page by page, as long as the last
+      poll found new work (`record_new`). Emails still in flight come back
+      unlabeled until committed, and re-polling for only those would spin.
+    - A poll that returns work resets the interval to `base_interval`;
+      every empty poll doubles it, up to `max_interval`.
+
+    `fetch_emails` keeps the watcher's signature, so the scheduler is a
+    drop-in replacement; `limit` becomes the ceiling for the batch size.
+    """
+
+    def __init__(
+        self,
+        base_interval: float = 10.0,
+        max_interval: float = 300.0,
+        backoff_factor: float = 2.0,
+        min_batch: int = 1,
+        max_batch: int = 100,
+        queue_depth: Callable[[], int] | None = None,
+        fetch_batch=fetch_email_batch,
+    ):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.queue_depth = queue_depth or (lambda: 0)
+        self.fetch_batch = fetch_batch
+
+        self.interval = base_interval
+        self.backlog = 0
+        self.more_pending = False
+        self.last_batch_size = 0
+        self.last_fetched = 0
+        self.last_new = 0
+        self.polls = 0
+        self.empty_polls = 0
+
+    def next_batch_size(self, limit: int | None = None) -> int:
+        ceiling = min(limit or self.max_batch, self.max_batch)
+        return max(self.min_batch, ceiling - self.queue_depth())
+
+    def fetch_emails(
+        self,
+        limit=None,
+        exclude_processed: bool = True,
+        processed_label: str = PROCESSED_LABEL_NAME,
+        incremental: bool = False,
+        two_phase: bool = False,
+        header_filter=default_header_filter,
+    ) -> list[dict]:
+        batch_size = self.next_batch_size(limit)
+        emails, more_pending, estimate = self.fetch_batch(
+            limit=batch_size,
+            exclude_processed=exclude_processed,
+            processed_label=processed_label,
+            incremental=incremental,
+            two_phase=two_phase,
+            header_filter=header_filter,
+        )
+        self.record(len(emails), more_pending, estimate, batch_size)
+        return emails
+
+    def record(self, fetched: int, more_pending: bool, backlog: int, batch_size: int = 0) -> None:
+        self.polls += 1
+        self.last_fetched = fetched
+        self.last_batch_size = batch_size
+        self.more_pending = more_pending
+        self.backlog = max(backlog, fetched)
+        if more_pending:
+            self.interval = 0.0
+        elif fetched:
+            self.interval = self.base_interval
+            self.empty_polls = 0
+        else:
+            self.empty_polls += 1
+            self.interval = min(
+                max(self.interval, self.base_interval) * self.backoff_factor,
+                self.max_interval,
+            )
+
+    def record_new(self, new: int) -> None:
+        """How many of the last poll's emails were not already in flight."""
+        self.last_new = new
+        if not new and self.interval < self.base_interval:
+            self.interval = self.base_interval
+
+    def reset(self) -> None:
+        """Poll promptly again, e.g. after a push notification."""
+        self.interval = 0.0
+        self.empty_polls = 0
+
+    async def wait(self) -> None:
+        if self.interval > 0:
+            await asyncio.sleep(self.interval)
+
+    def metrics(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "backlog": self.backlog,
+            "more_pending": self.more_pending,
+            "last_batch_size": self.last_batch_size,
+            "last_fetched": self.last_fetched,
+            "last_new": self.last_new,
+            "polls": self.polls,
+            "empty_polls": self.empty_polls,
+            "queue_depth": self.queue_depth(),
+        }
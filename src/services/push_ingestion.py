@@ -0,0 +1,212 @@
+"""
+Push-based ingestion for Gmail.
+
+Gmail `users.watch` publishes a notification to Pub/Sub whenever the mailbox
+changes, and a push subscription POSTs it to PushNotifier's HTTP endpoint.
+The notification only carries a historyId, so the endpoint just wakes the
+pipeline, which then runs an incremental history sync.
+
+Without Google Cloud, LocalPushPublisher plays the Pub/Sub role: it POSTs
+envelopes of the same shape, either one at a time or replayed from a JSONL
+recording. Run:
+    python -m src.services.push_ingestion replay notifications.jsonl
+    python -m src.services.push_ingestion publish --email ap@example.com --history-id 12345
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_PUSH_HOST = "127.0.0.1"
+DEFAULT_PUSH_PORT = 8085
+DEFAULT_PUSH_PATH = "/gmail/push"
+
+
+def build_envelope(email_address: str, history_id: str | int, message_id: str | None = None) -> dict:
+    """Wrap a Gmail notification the way a Pub/Sub push subscription delivers it."""
+    data = json.dumps({"emailAddress": email_address, "historyId": str(history_id)})
+    return {
+        "message": {
+            "data": base64.b64encode(data.encode("utf-8")).decode("ascii"),
+            "messageId": message_id or str(time.time_ns()),
+            "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "subscription": "local/gmail-push",
+    }
+
+
+def decode_envelope(envelope: dict) -> dict:
+    """Return the Gmail notification ({"emailAddress", "historyId"}) inside a push envelope."""
+    message = envelope.get("message") or {}
+    data = message.get("data")
+    if not data:
+        raise ValueError("Push envelope has no message data")
+    return json.loads(base64.b64decode(data).decode("utf-8"))
+
+
+class PushNotifier:
+    """
+    Minimal HTTP endpoint for Pub/Sub push deliveries.
+
+    Runs a ThreadingHTTPServer in a daemon thread and signals an asyncio
+    event on the pipeline's loop. Notifications that arrive while a sync is
+    already pending coalesce into one wake-up, since a single history sync
+    covers all of them. If `verification_token` is set, requests must carry
+    it as `?token=...` (the usual way to authenticate push endpoints).
+    """
+
+    def __init__(
+        self,
+        host: str = DEFAULT_PUSH_HOST,
+        port: int = DEFAULT_PUSH_PORT,
+        path: str = DEFAULT_PUSH_PATH,
+        verification_token: str | None = None,
+    ):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.verification_token = verification_token
+        self.latest_history_id: str | None = None
+        self.received = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._event: asyncio.Event | None = None
+        self._server: ThreadingHTTPServer | None = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Listening for Gmail push notifications on http://{self.host}:{self.port}{self.path}")
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """Wait for a notification; False on timeout. Clears the pending signal."""
+        if self._event is None:
+            raise RuntimeError("PushNotifier.start() must be called first")
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+    def _notify(self, notification: dict) -> None:
+        self.received += 1
+        self.latest_history_id = notification.get("historyId")
+        if self._loop and self._event:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def _handler_class(self):
+        notifier = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != notifier.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if notifier.verification_token:
+                    token = parse_qs(url.query).get("token", [None])[0]
+                    if token != notifier.verification_token:
+                        self.send_response(403)
+                        self.end_headers()
+                        return
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    notification = decode_envelope(json.loads(self.rfile.read(length)))
+                except (ValueError, json.JSONDecodeError) as exc:
+                    # 4xx tells Pub/Sub not to redeliver a malformed message.
+                    print("Rejected push notification:", exc)
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                notifier._notify(notification)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return _Handler
+
+
+class LocalPushPublisher:
+    """Stand-in for Pub/Sub: POSTs push envelopes to a PushNotifier endpoint."""
+
+    def __init__(self, url: str = f"http://{DEFAULT_PUSH_HOST}:{DEFAULT_PUSH_PORT}{DEFAULT_PUSH_PATH}"):
+        self.url = url
+
+    def publish(self, email_address: str, history_id: str | int) -> int:
+        envelope = build_envelope(email_address, history_id)
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(envelope).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+
+    def replay(self, path: str, speed: float | None = None) -> int:
+        """
+        Publish every notification in a JSONL file. Lines are
+        {"emailAddress", "historyId", optional "offset_seconds"}. With
+        `speed`, the recorded offsets are honoured (2.0 = twice as fast);
+        otherwise everything is sent back to back.
+        """
+        sent = 0
+        started = time.monotonic()
+        with open(path, encoding="utf-8") as handle:
+            for line in handle:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                offset = record.get("offset_seconds")
+                if speed and offset is not None:
+                    delay = offset / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                self.publish(record["emailAddress"], record["historyId"])
+                sent += 1
+        return sent
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for Gmail Pub/Sub push delivery.")
+    parser.add_argument("--url", default=f"http://{DEFAULT_PUSH_HOST}:{DEFAULT_PUSH_PORT}{DEFAULT_PUSH_PATH}")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    publish = sub.add_parser("publish", help="Send a single notification")
+    publish.add_argument("--email", required=True)
+    publish.add_argument("--history-id", required=True)
+
+    replay = sub.add_parser("replay", help="Replay notifications from a JSONL file")
+    replay.add_argument("path")
+    replay.add_argument("--speed", type=float, default=None)
+
+    args = parser.parse_args()
+    publisher = LocalPushPublisher(args.url)
+    if args.command == "publish":
+        print("Status:", publisher.publish(args.email, args.history_id))
+    else:
+        print("Replayed notifications:", publisher.replay(args.path, speed=args.speed))
+
+
+if __name__ == "__main__":
+    main()
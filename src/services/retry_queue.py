@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+import redis
+
+RETRY_SCHEDULE_KEY = "retry:schedule"
+RETRY_PAYLOAD_KEY = "retry:payloads"
+DEAD_LETTER_KEY = "retry:dead_letter"
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY_SECONDS = 30.0
+DEFAULT_MAX_DELAY_SECONDS = 3600.0
+# A claimed retry becomes due again if its worker never reports back.
+CLAIM_TIMEOUT_SECONDS = 15 * 60
+
+# Hand out due emails to exactly one caller by pushing their score past the
+# claim timeout; a finished attempt removes or reschedules them.
+_CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, member in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], member)
+end
+return due
+"""
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class RetryQueue:
+    """
+    Delayed retries for emails whose processing raised.
+
+    The schedule is a sorted set of email_id scored by the next attempt time,
+    and the email plus its attempt history sit in a hash beside it. Every
+    failure backs off exponentially (base * 2^(attempts-1), capped, with
+    jitter); after `max_attempts` the record moves to the dead-letter list,
+    where it stays until someone inspects or replays it. Emails parked
+    behind an open circuit breaker wait without using up attempts.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        base_delay: float = DEFAULT_BASE_DELAY_SECONDS,
+        max_delay: float = DEFAULT_MAX_DELAY_SECONDS,
+    ):
+        self.redis = client
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._claim = client.register_script(_CLAIM_SCRIPT)
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def schedule(self, email: dict, error: BaseException | str) -> str:
+        """Record a failed attempt. Returns "retry" or "dead"."""
+        email_id = email["email_id"]
+        raw = self.redis.hget(RETRY_PAYLOAD_KEY, email_id)
+        record = json.loads(raw) if raw else {"email": email, "attempts": 0, "first_failed_at": _now_iso()}
+        record["email"] = email
+        record["attempts"] += 1
+        record["last_error"] = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+        record["last_failed_at"] = _now_iso()
+
+        pipe = self.redis.pipeline()
+        if record["attempts"] >= self.max_attempts:
+            record.pop("next_attempt_at", None)
+            pipe.zrem(RETRY_SCHEDULE_KEY, email_id)
+            pipe.hdel(RETRY_PAYLOAD_KEY, email_id)
+            pipe.rpush(DEAD_LETTER_KEY, json.dumps(record, default=str))
+            pipe.execute()
+            return "dead"
+        record["next_attempt_at"] = time.time() + self.backoff(record["attempts"])
+        pipe.hset(RETRY_PAYLOAD_KEY, email_id, json.dumps(record, default=str))
+        pipe.zadd(RETRY_SCHEDULE_KEY, {email_id: record["next_attempt_at"]})
+        pipe.execute()
+        return "retry"
+
+    def park(self, email: dict, reason: BaseException | str, delay: float) -> str:
+        """
+        Hold `email` for `delay` seconds without counting an attempt, for
+        failures that say nothing about the email itself (an open circuit
+        breaker). Returns "parked".
+        """
+        email_id = email["email_id"]
+        raw = self.redis.hget(RETRY_PAYLOAD_KEY, email_id)
+        record = json.loads(raw) if raw else {"email": email, "attempts": 0, "first_failed_at": _now_iso()}
+        record["email"] = email
+        record["parked_reason"] = str(reason)
+        record["next_attempt_at"] = time.time() + delay * random.uniform(1.0, 1.2)
+
+        pipe = self.redis.pipeline()
+        pipe.hset(RETRY_PAYLOAD_KEY, email_id, json.dumps(record, default=str))
+        pipe.zadd(RETRY_SCHEDULE_KEY, {email_id: record["next_attempt_at"]})
+        pipe.execute()
+        return "parked"
+
+    def claim_due(self, limit: int = 50) -> list[dict]:
+        """Due emails, each tagged with "retry_attempts"; claimed so no other process takes them."""
+        if limit <= 0:
+            return []
+        now = time.time()
+        email_ids = self._claim(
+            keys=[RETRY_SCHEDULE_KEY], args=[now, limit, now + CLAIM_TIMEOUT_SECONDS]
+        )
+        if not email_ids:
+            return []
+        emails = []
+        for email_id, raw in zip(email_ids, self.redis.hmget(RETRY_PAYLOAD_KEY, email_ids)):
+            if raw is None:
+                self.redis.zrem(RETRY_SCHEDULE_KEY, email_id)
+                continue
+            record = json.loads(raw)
+            email = dict(record["email"])
+            email["retry_attempts"] = record["attempts"]
+            emails.append(email)
+        return emails
+
+    def complete(self, email_id: str) -> None:
+        pipe = self.redis.pipeline()
+        pipe.zrem(RETRY_SCHEDULE_KEY, email_id)
+        pipe.hdel(RETRY_PAYLOAD_KEY, email_id)
+        pipe.execute()
+
+    def pending(self) -> int:
+        return self.redis.zcard(RETRY_SCHEDULE_KEY)
+
+    def dead_letters(self, limit: int = 100) -> list[dict]:
+        return [json.loads(raw) for raw in self.redis.lrange(DEAD_LETTER_KEY, 0, limit - 1)]
+
+    def replay_dead_letters(self, email_ids: list[str] | None = None) -> int:
+        """Move dead letters (all, or just `email_ids`) back onto the schedule with a fresh attempt budget."""
+        replayed = 0
+        for raw in self.redis.lrange(DEAD_LETTER_KEY, 0, -1):
+            record = json.loads(raw)
+            email_id = record["email"]["email_id"]
+            if email_ids is not None and email_id not in email_ids:
+                continue
+            record["attempts"] = 0
+            record["replayed_at"] = _now_iso()
+            pipe = self.redis.pipeline()
+            pipe.lrem(DEAD_LETTER_KEY, 1, raw)
+            pipe.hset(RETRY_PAYLOAD_KEY, email_id, json.dumps(record, default=str))
+            pipe.zadd(RETRY_SCHEDULE_KEY, {email_id: time.time()})
+            pipe.execute()
+            replayed += 1
+        return replayed
+
+    def purge_dead_letters(self, email_ids: list[str] | None = None) -> int:
+        if email_ids is None:
+            count = self.redis.llen(DEAD_LETTER_KEY)
+            self.redis.delete(DEAD_LETTER_KEY)
+            return count
+        purged = 0
+        for raw in self.redis.lrange(DEAD_LETTER_KEY, 0, -1):
+            if json.loads(raw)["email"]["email_id"] in email_ids:
+                purged += self.redis.lrem(DEAD_LETTER_KEY, 1, raw)
+        return purged
+
+
+def main() -> None:
+    from src.db.redis_client import get_redis_client
+
+    parser = argparse.ArgumentParser(description="Inspect and replay failed emails.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("status", help="Count scheduled retries and dead letters")
+    listing = sub.add_parser("list", help="Show dead letters")
+    listing.add_argument("--limit", type=int, default=20)
+    replay = sub.add_parser("replay", help="Put dead letters back on the retry schedule")
+    replay.add_argument("email_ids", nargs="*", help="Only these emails (default: all)")
+    purge = sub.add_parser("purge", help="Delete dead letters")
+    purge.add_argument("email_ids", nargs="*", help="Only these emails (default: all)")
+
+    args = parser.parse_args()
+    queue = RetryQueue(get_redis_client())
+    if args.command == "status":
+        print("Scheduled retries:", queue.pending())
+        print("Dead letters:", queue.redis.llen(DEAD_LETTER_KEY))
+    elif args.command == "list":
+        for record in queue.dead_letters(args.limit):
+            email = record["email"]
+            print(f"{email['email_id']}  attempts={record['attempts']}  "
+                  f"last_failed_at={record.get('last_failed_at')}  from={email.get('from')}")
+            print(f"    subject: {email.get('subject')}")
+            print(f"    error:   {record.get('last_error')}")
+    elif args.command == "replay":
+        print("Replayed dead letters:", queue.replay_dead_letters(args.email_ids or None))
+    else:
+        print("Purged dead letters:", queue.purge_dead_letters(args.email_ids or None))
+
+
+if __name__ == "__main__":
+    main()
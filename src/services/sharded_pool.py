@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import multiprocessing
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncContextManager, Awaitable, Callable
+
+from src.services.worker_pool import EmailWorkerPool
+from src.utils.circuit_breaker import CircuitOpen
+
+METRICS_INTERVAL_SECONDS = 5.0
+_POLL_SECONDS = 0.5
+
+
+def shard_for(key: Any, shards: int) -> int:
+    """Stable shard of `key`; unlike hash(), identical in every process."""
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+@asynccontextmanager
+async def _no_lifespan():
+    yield None
+
+
+async def _serve_shard(
+    shard: int,
+    inbox: multiprocessing.Queue,
+    outbox: multiprocessing.Queue,
+    handler: Callable[[dict], Awaitable[Any]],
+    lifespan: Callable[[], AsyncContextManager[Callable[[], dict] | None]] | None,
+    workers: int,
+    max_queue: int,
+    aging_seconds: float,
+) -> None:
+    def _on_done(email: dict, result: Any) -> None:
+        if isinstance(result, Exception) and not isinstance(result, CircuitOpen):
+            # Exceptions do not always pickle; the parent only needs the message.
+            # CircuitOpen does, and the parent parks rather than retries on it.
+            result = ("error", f"{type(result).__name__}: {result}")
+        outbox.put(("done", shard, email["email_id"], result))
+
+    pool = EmailWorkerPool(handler, _on_done, workers=workers, max_queue=max_queue, aging_seconds=aging_seconds)
+    async with (lifespan or _no_lifespan)() as extra_metrics:
+        async def _report_metrics() -> None:
+            while True:
+                await asyncio.sleep(METRICS_INTERVAL_SECONDS)
+                snapshot = pool.metrics()
+                if extra_metrics is not None:
+                    snapshot.update(extra_metrics())
+                outbox.put(("metrics", shard, snapshot))
+
+        pool.start()
+        reporter = asyncio.create_task(_report_metrics())
+        try:
+            while True:
+                item = await asyncio.to_thread(inbox.get)
+                if item is None:
+                    break
+                email, key, group, priority = item
+                await pool.submit(email, key=key, group=group, priority=priority)
+        finally:
+            # Like EmailWorkerPool.stop, unfinished emails are abandoned and
+            # picked up again by the next poll or stream reclaim.
+            reporter.cancel()
+            await pool.stop()
+
+
+def _run_shard(*args: Any) -> None:
+    try:
+        asyncio.run(_serve_shard(*args))
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardedWorkerPool:
+    """
+    EmailWorkerPool spread over `processes` worker processes, for when JSON
+    handling, body extraction and similarity math saturate one interpreter's
+    GIL. Drop-in for EmailWorkerPool from the caller's side.
+
+    Emails are routed by a stable hash of their `key`, so one conversation
+    always lands on the same process and keeps its ordering; inside a
+    process the usual pool (priorities, supplier round-robin) applies.
+    Processes are spawned, not forked, so each opens its own Redis and
+    Postgres pools. `handler` and `lifespan` must be importable module-level
+    callables. `lifespan()` is an async context manager run around each
+    process's pool (e.g. to start its dispute executor); what it yields, if
+    callable, adds fields to that process's metrics. `stop` gives each
+    process `stop_timeout` seconds to leave its lifespan before killing it,
+    so this must exceed whatever the lifespan's shutdown may wait for.
+
+    `on_done` runs in the parent's event loop. A handler exception arrives
+    as a RuntimeError carrying the original message, except CircuitOpen,
+    which arrives as itself. If a process dies, its in-flight emails fail
+    with a RuntimeError and the process is restarted.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Awaitable[Any]],
+        on_done: Callable[[dict, Any], None],
+        processes: int = 2,
+        workers: int = 4,
+        max_queue: int = 100,
+        aging_seconds: float = 60.0,
+        lifespan: Callable[[], AsyncContextManager[Any]] | None = None,
+        stop_timeout: float = 60.0,
+    ):
+        self.handler = handler
+        self.on_done = on_done
+        self.process_count = processes
+        self.worker_count = workers
+        self.max_queue = max_queue
+        self.aging_seconds = aging_seconds
+        self.lifespan = lifespan
+        self.stop_timeout = stop_timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._inboxes: list[multiprocessing.Queue] = []
+        self._processes: list[multiprocessing.Process] = []
+        # email_id -> (shard, email) submitted and not reported back yet
+        self._inflight: dict[str, tuple[int, dict]] = {}
+        self._outstanding = [0] * processes
+        self._snapshots: dict[int, dict] = {}
+        self._cond: asyncio.Condition | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._reader: threading.Thread | None = None
+        # Closing: no more restarts. Stopping: shards joined, the reader may exit.
+        self._closing = threading.Event()
+        self._stopping = threading.Event()
+        self._restarting: set[int] = set()
+        self._started_at = 0.0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+
+    def _spawn(self, shard: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=_run_shard,
+            args=(
+                shard, self._inboxes[shard], self._outbox, self.handler, self.lifespan,
+                self.worker_count, self.max_queue, self.aging_seconds,
+            ),
+            name=f"email-shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._cond = asyncio.Condition()
+        self._started_at = time.monotonic()
+        self._inboxes = [self._context.Queue() for _ in range(self.process_count)]
+        self._processes = [self._spawn(shard) for shard in range(self.process_count)]
+        self._reader = threading.Thread(target=self._read_outbox, name="email-shard-reader", daemon=True)
+        self._reader.start()
+
+    async def submit(self, email: dict, key: Any = None, group: Any = None, priority: int = 0) -> None:
+        if key is None:
+            key = ("email", email.get("email_id"))
+        shard = shard_for(key, self.process_count)
+        async with self._cond:
+            # Each process queues up to max_queue emails on top of those in
+            # its workers; beyond that the caller waits, as with one pool.
+            limit = self.max_queue + self.worker_count
+            await self._cond.wait_for(lambda: self._outstanding[shard] < limit)
+            self._outstanding[shard] += 1
+            self._inflight[email["email_id"]] = (shard, email)
+        self._inboxes[shard].put((email, key, group, priority))
+
+    def depth(self) -> int:
+        return sum(self._outstanding)
+
+    def _read_outbox(self) -> None:
+        checked_at = time.monotonic()
+        while not self._stopping.is_set():
+            try:
+                message = self._outbox.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                message = None
+            if message is not None:
+                self._loop.call_soon_threadsafe(self._handle, message)
+            if time.monotonic() - checked_at >= _POLL_SECONDS:
+                checked_at = time.monotonic()
+                self._check_processes()
+        # Results the shards reported on their way out.
+        while True:
+            try:
+                message = self._outbox.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                return
+            self._loop.call_soon_threadsafe(self._handle, message)
+
+    def _check_processes(self) -> None:
+        for shard, process in enumerate(self._processes):
+            if process.is_alive() or self._closing.is_set() or shard in self._restarting:
+                continue
+            print(f"Shard {shard} exited with code {process.exitcode}; restarting")
+            self._restarting.add(shard)
+            self._loop.call_soon_threadsafe(self._restart_shard, shard)
+
+    def _restart_shard(self, shard: int) -> None:
+        # Runs on the event loop, so no submit can slip in between failing
+        # the shard's emails and swapping its inbox. The inbox is replaced
+        # rather than drained: the dead process may have held its read lock.
+        self._inboxes[shard] = self._context.Queue()
+        lost = [email_id for email_id, (owner, _) in self._inflight.items() if owner == shard]
+        for email_id in lost:
+            self._handle(("done", shard, email_id, ("error", f"worker process for shard {shard} died")))
+        if not self._closing.is_set():
+            self._processes[shard] = self._spawn(shard)
+            self.restarts += 1
+        self._restarting.discard(shard)
+
+    def _handle(self, message: tuple) -> None:
+        if message[0] == "metrics":
+            _, shard, snapshot = message
+            self._snapshots[shard] = snapshot
+            return
+        _, shard, email_id, result = message
+        entry = self._inflight.pop(email_id, None)
+        if entry is None:
+            return
+        self._outstanding[shard] -= 1
+        if isinstance(result, tuple) and result[:1] == ("error",):
+            result = RuntimeError(result[1])
+        if isinstance(result, Exception):
+            self.failed += 1
+        self.completed += 1
+        try:
+            self.on_done(entry[1], result)
+        except Exception as exc:
+            print("Worker completion hook failed:", exc)
+        self._loop.create_task(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def drain(self) -> None:
+        """Wait until every submitted email has been reported back."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._inflight)
+
+    async def stop(self) -> None:
+        for inbox in self._inboxes:
+            inbox.put(None)
+        self._closing.set()
+        # The reader keeps recording results while the shards drain.
+        await asyncio.gather(
+            *(asyncio.to_thread(process.join, self.stop_timeout) for process in self._processes)
+        )
+        for process in self._processes:
+            if process.is_alive():
+                print(f"{process.name} still running after {self.stop_timeout:g}s; terminating")
+                process.terminate()
+        self._stopping.set()
+        if self._reader is not None:
+            await asyncio.to_thread(self._reader.join)
+        self._processes = []
+
+    def metrics(self) -> dict:
+        snapshots = [self._snapshots[shard] for shard in sorted(self._snapshots)]
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+
+        def _max(field: str) -> float | None:
+            values = [s[field] for s in snapshots if s.get(field) is not None]
+            return max(values) if values else None
+
+        return {
+            "processes": self.process_count,
+            "workers": self.process_count * self.worker_count,
+            "queue_depth": self.depth(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "throughput_per_s": round(self.completed / elapsed, 3),
+            "restarts": self.restarts,
+            "busy_workers": sum(s.get("busy_workers", 0) for s in snapshots),
+            "utilization": (
+                round(sum(s["utilization"] for s in snapshots) / len(snapshots), 3) if snapshots else None
+            ),
+            # Percentiles do not add up across shards; the worst shard is shown.
+            "latency_p50_s": _max("latency_p50_s"),
+            "latency_p95_s": _max("latency_p95_s"),
+            "shards": {shard: self._snapshots[shard] for shard in sorted(self._snapshots)},
+        }
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable
+
+from src.utils.llm_client import track_token_usage
+
+_stats: dict[str, dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def _bump(stage: str, **deltas: float) -> None:
+    with _stats_lock:
+        stats = _stats.setdefault(stage, {
+            "launched": 0, "used": 0, "discarded": 0,
+            "latency_saved_s": 0.0, "wasted_tokens": 0,
+        })
+        for field, delta in deltas.items():
+            stats[field] += delta
+
+
+def speculation_stats() -> dict[str, dict[str, float]]:
+    with _stats_lock:
+        return {
+            stage: {**stats, "latency_saved_s": round(stats["latency_saved_s"], 3)}
+            for stage, stats in _stats.items()
+        }
+
+
+class Speculation:
+    """
+    A blocking stage started in a worker thread before we know whether its
+    result will be needed.
+
+    `result()` awaits it. The latency saved is the part of its run that
+    overlapped other work, i.e. from launch until the result was asked for
+    (or until it finished, if sooner). `discard()` drops the result; the
+    thread cannot be interrupted, so the call runs to completion and its
+    tokens are booked as wasted.
+    """
+
+    def __init__(self, stage: str, func: Callable[..., Any], *args: Any):
+        self.stage = stage
+        self.tokens: dict[str, int] = {}
+        self.started_at = time.monotonic()
+        self.finished_at: float | None = None
+        self._task = asyncio.create_task(self._run(func, *args), name=f"speculative-{stage}")
+        _bump(stage, launched=1)
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        try:
+            with track_token_usage() as usage:
+                self.tokens = usage
+                return await asyncio.to_thread(func, *args)
+        finally:
+            self.finished_at = time.monotonic()
+
+    async def result(self) -> Any:
+        awaited_at = time.monotonic()
+        try:
+            return await self._task
+        finally:
+            overlap = min(self.finished_at or awaited_at, awaited_at) - self.started_at
+            _bump(self.stage, used=1, latency_saved_s=max(overlap, 0.0))
+
+    def discard(self, reason: str = "") -> None:
+        _bump(self.stage, discarded=1)
+
+        def _book_waste(task: asyncio.Task) -> None:
+            if not task.cancelled():
+                task.exception()  # a failed speculation is not worth surfacing
+            wasted = self.tokens.get("total_tokens", 0)
+            _bump(self.stage, wasted_tokens=wasted)
+            print(f"Speculative {self.stage} discarded{f' ({reason})' if reason else ''}: "
+                  f"{wasted} tokens wasted")
+
+        self._task.add_done_callback(_book_waste)
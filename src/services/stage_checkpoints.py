@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import json
+from datetime import datetime, timezone
+
+import redis
+
+CHECKPOINT_KEY_PREFIX = "checkpoint:"
+# Safety net for emails that never get committed; committed ones are cleared.
+CHECKPOINT_TTL_SECONDS = 3 * 24 * 60 * 60
+
+
+class StageCheckpoints:
+    """
+    Per-email record of finished pipeline stages, one Redis hash per email:
+    field = stage name, value = {"output": ..., "at": ISO timestamp}.
+
+    A worker that dies mid-email leaves its finished stages behind, so the
+    next attempt resumes at the first incomplete stage instead of paying for
+    every LLM call again. Without a Redis client (memory/SQLite STM) every
+    method is a no-op and emails simply restart from scratch.
+    """
+
+    def __init__(self, client: redis.Redis | None, ttl_seconds: int = CHECKPOINT_TTL_SECONDS):
+        self.redis = client
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def _key(email_id: str) -> str:
+        return f"{CHECKPOINT_KEY_PREFIX}{email_id}"
+
+    def load(self, email_id: str) -> dict[str, dict]:
+        if self.redis is None or not email_id:
+            return {}
+        raw = self.redis.hgetall(self._key(email_id))
+        return {stage: json.loads(value) for stage, value in raw.items()}
+
+    def save(self, email_id: str, stage: str, output) -> None:
+        if self.redis is None or not email_id:
+            return
+        record = {"output": output, "at": datetime.now(timezone.utc).isoformat()}
+        key = self._key(email_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, stage, json.dumps(record, default=str))
+        pipe.expire(key, self.ttl_seconds)
+        pipe.execute()
+
+    def clear(self, *email_ids: str) -> None:
+        if self.redis is None or not email_ids:
+            return
+        self.redis.delete(*(self._key(email_id) for email_id in email_ids))
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import uuid
+
+import redis
+
+STREAM_KEY = "emails:stream"
+CONSUMER_GROUP = "email-workers"
+ENQUEUED_SET_KEY = "emails:enqueued"
+POLLER_LEASE_KEY = "emails:poller_lease"
+STREAM_MAXLEN = 100_000
+
+# Enqueue at most once per email_id across every poller and every poll.
+_ENQUEUE_SCRIPT = """
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'email_id', ARGV[1], 'payload', ARGV[2])
+end
+return false
+"""
+
+# Extend or release the lease only while we still hold it.
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def default_consumer_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkStream:
+    """
+    Durable email queue on a Redis Stream with one consumer group.
+
+    Any number of processes on any node can consume: XREADGROUP hands each
+    entry to exactly one consumer, entries stay pending until XACKed, and
+    entries left pending by a dead consumer are taken over with XAUTOCLAIM.
+    A live consumer must `touch` the entries it still holds more often than
+    the reclaim idle time, or they are taken over while it works on them.
+    An email_id stays in ENQUEUED_SET_KEY only until its entry is acked.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        stream: str = STREAM_KEY,
+        group: str = CONSUMER_GROUP,
+        consumer: str | None = None,
+    ):
+        self.redis = client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or default_consumer_name()
+        self._enqueue = client.register_script(_ENQUEUE_SCRIPT)
+        self._claim_cursor = "0-0"
+
+    def ensure_group(self) -> None:
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    def publish(self, email: dict) -> str | None:
+        """XADD the email unless it was enqueued before; returns the entry ID or None."""
+        return self._enqueue(
+            keys=[self.stream, ENQUEUED_SET_KEY],
+            args=[email["email_id"], json.dumps(email), STREAM_MAXLEN],
+        )
+
+    def read(self, count: int, block_ms: int = 5000) -> list[tuple[str, dict]]:
+        response = self.redis.xreadgroup(
+            self.group, self.consumer, {self.stream: ">"}, count=count, block=block_ms
+        )
+        return [
+            (entry_id, json.loads(fields["payload"]))
+            for _stream, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    def ack(self, entry_id: str, email_id: str | None = None) -> None:
+        pipe = self.redis.pipeline()
+        pipe.xack(self.stream, self.group, entry_id)
+        if email_id is not None:
+            # Once acked the processed set guards against re-enqueueing.
+            pipe.srem(ENQUEUED_SET_KEY, email_id)
+        pipe.execute()
+
+    def touch(self, entry_ids: list[str], chunk: int = 100) -> None:
+        """Reset the idle time of entries this consumer still holds, so `reclaim` leaves them alone."""
+        for start in range(0, len(entry_ids), chunk):
+            self.redis.xclaim(
+                self.stream,
+                self.group,
+                self.consumer,
+                min_idle_time=0,
+                message_ids=entry_ids[start:start + chunk],
+                justid=True,
+            )
+
+    def reclaim(self, min_idle_ms: int, count: int = 50) -> list[tuple[str, dict]]:
+        """Take over entries another consumer has held for longer than `min_idle_ms`."""
+        response = self.redis.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=min_idle_ms,
+            start_id=self._claim_cursor,
+            count=count,
+        )
+        self._claim_cursor, entries = response[0], response[1]
+        claimed = []
+        for entry_id, fields in entries:
+            if not fields:
+                # Trimmed from the stream while pending; nothing left to run.
+                self.ack(entry_id)
+                continue
+            claimed.append((entry_id, json.loads(fields["payload"])))
+        return claimed
+
+    def pending_count(self) -> int:
+        summary = self.redis.xpending(self.stream, self.group)
+        return int(summary.get("pending", 0)) if summary else 0
+
+
+class PollerLease:
+    """
+    Redis lease electing the single process that polls the mailbox. The
+    holder renews it well inside `ttl_ms`; if it dies, the key expires and
+    another process takes over on its next attempt.
+    """
+
+    def __init__(self, client: redis.Redis, key: str = POLLER_LEASE_KEY, ttl_ms: int = 30_000):
+        self.redis = client
+        self.key = key
+        self.ttl_ms = ttl_ms
+        self.token = uuid.uuid4().hex
+        self._renew = client.register_script(_RENEW_SCRIPT)
+        self._release = client.register_script(_RELEASE_SCRIPT)
+        self.held = False
+
+    def acquire_or_renew(self) -> bool:
+        if self.held and self._renew(keys=[self.key], args=[self.token, self.ttl_ms]):
+            return True
+        self.held = bool(self.redis.set(self.key, self.token, nx=True, px=self.ttl_ms))
+        return self.held
+
+    def release(self) -> None:
+        if self.held:
+            self._release(keys=[self.key], args=[self.token])
+            self.held = False
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import asyncio
+import statistics
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+LATENCY_WINDOW = 500
+
+
+class EmailWorkerPool:
+    """
+    Bounded work queue feeding a fixed set of long-lived workers.
+
+    The producer awaits `submit`, which blocks while `max_queue` emails are
+    waiting, so polling naturally slows to the pace of processing
+    (backpressure). A slow email only occupies one worker; the others keep
+    draining the queue.
+
+    Emails submitted with the same `key` (a conversation thread) run one at
+    a time in submission order; different keys run in parallel. Ready keys
+    are handed out round-robin across `group`s (suppliers), so a supplier
+    with fifty queued threads cannot starve one with a single email.
+    Without a key every email is independent.
+
+    Each email carries a `priority` (lower runs first). Workers take the
+    ready key whose head email is most urgent, falling back to the group
+    round-robin on ties. Waiting emails age by one priority level every
+    `aging_seconds`, so low-priority mail is delayed but never starved.
+
+    `on_done(email, result)` is called for every email, with the exception
+    as `result` when the handler raised.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Awaitable[Any]],
+        on_done: Callable[[dict, Any], None],
+        workers: int = 4,
+        max_queue: int = 100,
+        aging_seconds: float = 60.0,
+    ):
+        self.handler = handler
+        self.on_done = on_done
+        self.worker_count = workers
+        self.max_queue = max_queue
+        self.aging_seconds = aging_seconds
+        self._cond = asyncio.Condition()
+        self._pending: dict[Any, deque[tuple[float, int, dict]]] = {}
+        self._key_group: dict[Any, Any] = {}
+        self._active: set[Any] = set()
+        self._ready: dict[Any, deque[Any]] = {}
+        self._groups: deque[Any] = deque()
+        self._size = 0
+        self._unfinished = 0
+        self._tasks: list[asyncio.Task] = []
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._started_at = 0.0
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._service_times: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        self._started_at = time.monotonic()
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"email-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+
+    def _mark_ready(self, key: Any) -> None:
+        group = self._key_group[key]
+        if group not in self._ready:
+            self._ready[group] = deque()
+            self._groups.append(group)
+        self._ready[group].append(key)
+
+    async def submit(self, email: dict, key: Any = None, group: Any = None, priority: int = 0) -> None:
+        if key is None:
+            key = ("email", email.get("email_id"), time.monotonic_ns())
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._size < self.max_queue)
+            queue = self._pending.setdefault(key, deque())
+            queue.append((time.monotonic(), priority, email))
+            self._key_group[key] = group
+            if len(queue) == 1 and key not in self._active:
+                self._mark_ready(key)
+            self._size += 1
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        return self._size
+
+    def _effective_priority(self, key: Any, now: float) -> int:
+        enqueued_at, priority, _ = self._pending[key][0]
+        return priority - int((now - enqueued_at) // self.aging_seconds)
+
+    def _pick(self) -> Any:
+        """Pop the most urgent ready key; the earliest group in the rotation wins ties."""
+        now = time.monotonic()
+        best = None
+        for index, group in enumerate(self._groups):
+            for key in self._ready[group]:
+                score = self._effective_priority(key, now)
+                if best is None or score < best[0]:
+                    best = (score, index, group, key)
+        _, index, group, key = best
+        del self._groups[index]
+        keys = self._ready[group]
+        keys.remove(key)
+        if keys:
+            self._groups.append(group)
+        else:
+            del self._ready[group]
+        return key
+
+    async def _take(self) -> tuple[Any, float, dict]:
+        async with self._cond:
+            await self._cond.wait_for(lambda: bool(self._groups))
+            key = self._pick()
+            enqueued_at, _, email = self._pending[key].popleft()
+            self._active.add(key)
+            self._size -= 1
+            self._cond.notify_all()
+            return key, enqueued_at, email
+
+    async def _release(self, key: Any) -> None:
+        async with self._cond:
+            self._active.discard(key)
+            if self._pending.get(key):
+                self._mark_ready(key)
+            else:
+                self._pending.pop(key, None)
+                self._key_group.pop(key, None)
+            self._unfinished -= 1
+            self._cond.notify_all()
+
+    async def _worker(self) -> None:
+        while True:
+            key, enqueued_at, email = await self._take()
+            started = time.monotonic()
+            self._busy += 1
+            try:
+                result = await self.handler(email)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                result = exc
+                self.failed += 1
+            finally:
+                finished = time.monotonic()
+                self._busy -= 1
+                self._busy_seconds += finished - started
+                self._service_times.append(finished - started)
+                self._latencies.append(finished - enqueued_at)
+            self.completed += 1
+            try:
+                self.on_done(email, result)
+            except Exception as exc:
+                print("Worker completion hook failed:", exc)
+            await self._release(key)
+
+    async def drain(self) -> None:
+        """Wait until every submitted email has been processed."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._unfinished == 0)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def metrics(self) -> dict:
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        latencies = sorted(self._latencies)
+
+        def _pct(values: list[float], q: float) -> float | None:
+            if not values:
+                return None
+            return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+        waiting_by_priority: dict[int, int] = {}
+        for queue in self._pending.values():
+            for _, priority, _ in queue:
+                waiting_by_priority[priority] = waiting_by_priority.get(priority, 0) + 1
+
+        return {
+            "queue_depth": self.depth(),
+            "waiting_by_priority": dict(sorted(waiting_by_priority.items())),
+            "queue_capacity": self.max_queue,
+            "active_threads": len(self._active),
+            "waiting_groups": len(self._groups),
+            "workers": self.worker_count,
+            "busy_workers": self._busy,
+            "utilization": round(self._busy_seconds / (elapsed * self.worker_count), 3),
+            "completed": self.completed,
+            "failed": self.failed,
+            "latency_p50_s": _pct(latencies, 0.50),
+            "latency_p95_s": _pct(latencies, 0.95),
+            "service_mean_s": round(statistics.fmean(self._service_times), 3) if self._service_times else None,
+        }
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# name -> breaker, for metrics and check_breakers
+_breakers: dict[str, "CircuitBreaker"] = {}
+
+
+class CircuitOpen(RuntimeError):
+    """A dependency's breaker is open; the call was not attempted."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(name, retry_after)
+        self.name = name
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return f"{self.name} circuit open; retry in {self.retry_after:.0f}s"
+
+
+class CircuitBreaker:
+    """
+    Fails calls to an external dependency fast while it is down.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    every call raises CircuitOpen without being attempted. Once
+    `reset_seconds` have passed it is half-open: `half_open_probes` calls
+    go through, and the first success closes it again while a failure
+    reopens it for another `reset_seconds`.
+
+    `is_failure(exc)` decides which exceptions mean the dependency is
+    unhealthy (connection errors, timeouts, 5xx); anything else the call
+    raises, such as a bad request, leaves the breaker as it was. Breakers
+    live in one process: each worker process trips its own.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        is_failure: Callable[[BaseException], bool] = lambda exc: isinstance(exc, Exception),
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_seconds: float = BREAKER_RESET_SECONDS,
+        half_open_probes: int = 1,
+    ):
+        self.name = name
+        self.is_failure = is_failure
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+        _breakers[name] = self
+
+    def _retry_after(self, now: float) -> float:
+        return max(self._opened_at + self.reset_seconds - now, 0.0)
+
+    def check(self) -> None:
+        """Raise CircuitOpen while calls would be rejected, without taking a half-open probe."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and self._retry_after(now) > 0:
+                raise CircuitOpen(self.name, self._retry_after(now))
+
+    def allow(self) -> None:
+        """Admit one call or raise CircuitOpen; an admitted call must be settled with `record`."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if self._retry_after(now) > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self._retry_after(now))
+                self.state = HALF_OPEN
+                self._probes = 0
+                print(f"Circuit {self.name} half-open; probing")
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self.reset_seconds)
+                self._probes += 1
+
+    def record(self, error: BaseException | None = None) -> None:
+        with self._lock:
+            probe = self.state == HALF_OPEN
+            if probe:
+                self._probes = max(self._probes - 1, 0)
+            if error is None:
+                self._failures = 0
+                if probe:
+                    self.state = CLOSED
+                    print(f"Circuit {self.name} closed")
+                return
+            if not self.is_failure(error):
+                return
+            self._failures += 1
+            if probe or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                print(f"Circuit {self.name} open for {self.reset_seconds:g}s after:", error)
+
+    @contextmanager
+    def guard(self):
+        self.allow()
+        try:
+            yield
+        except BaseException as exc:
+            self.record(exc)
+            raise
+        self.record()
+
+    def metrics(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+def check_breakers(*names: str) -> None:
+    """Raise CircuitOpen for the first of the named breakers that is open."""
+    for name in names:
+        breaker = _breakers.get(name)
+        if breaker is not None:
+            breaker.check()
+
+
+def breaker_metrics() -> dict:
+    return {name: breaker.metrics() for name, breaker in sorted(_breakers.items())}
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Monotonic time by which the current email must be done. Like the token
+# counters in llm_client, asyncio.to_thread copies it into worker threads,
+# so blocking client calls see the deadline of the task that made them.
+_deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The current deadline passed before a call could start."""
+
+
+@contextmanager
+def deadline_scope(deadline: float | None):
+    """Run the block under `deadline` (time.monotonic()); an outer, earlier deadline wins."""
+    outer = _deadline.get()
+    if deadline is None or (outer is not None and outer <= deadline):
+        yield outer
+        return
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def without_deadline():
+    """Run the block with no deadline, for work done on behalf of several callers."""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_seconds() -> float | None:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def bounded_timeout(default: float | None) -> float | None:
+    """
+    Timeout for one blocking call: `default`, cut to the time left before
+    the current deadline. Raises DeadlineExceeded once that has passed, so
+    a stage abandoned by its engine stops issuing new requests.
+    """
+    left = remaining_seconds()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("deadline passed before the call started")
+    return left if default is None else min(default, left)
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import os
+import re
+from html.parser import HTMLParser
+
+MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", "20000"))
+HTML_FEED_CHUNK = 8192
+
+_SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template", "svg"}
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "header", "footer", "table", "tr",
+    "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "hr",
+}
+
+# A reply chain starts at the first of these lines; everything after it is
+# quoted history the original email already carried.
+_REPLY_MARKERS = [
+    re.compile(r"^\s*On .{0,200}wrote:\s*$", re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*Original Message\s*-{2,}", re.IGNORECASE),
+]
+# Outlook's rule above the quoted header block. Invoice tables use the same
+# underline, so it only counts when a From:/Sent: header line follows.
+_OUTLOOK_RULE = re.compile(r"^\s*_{10,}\s*$")
+_QUOTED_HEADER = re.compile(r"^\s*(?:From|Sent):\s", re.IGNORECASE)
+_SIGNATURE_MARKERS = [
+    re.compile(r"^\s*Sent from my \w+", re.IGNORECASE),
+    re.compile(r"^\s*Get Outlook for \w+", re.IGNORECASE),
+]
+# RFC 3676 signature delimiter. A bare "--" also shows up inside tables, so
+# it only counts when what follows is short enough to be a signature.
+_SIGNATURE_DELIMITER = re.compile(r"^--\s*$")
+SIGNATURE_MAX_LINES = 10
+
+
+class _TextExtractor(HTMLParser):
+    """Incremental HTML-to-text; stops collecting once `limit` chars are out."""
+
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts: list[str] = []
+        self.size = 0
+        self._skip_depth = 0
+
+    @property
+    def full(self) -> bool:
+        return self.size >= self.limit
+
+    def _emit(self, text: str) -> None:
+        if self.full:
+            return
+        text = text[: self.limit - self.size]
+        self.parts.append(text)
+        self.size += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "br" or tag in _BLOCK_TAGS:
+            self._emit("\n")
+        elif tag == "li":
+            self._emit("\n- ")
+        elif tag in {"td", "th"}:
+            self._emit("\t")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._emit("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._emit(re.sub(r"\s+", " ", data))
+
+    def text(self) -> str:
+        lines = (line.strip() for line in "".join(self.parts).splitlines())
+        return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def html_to_text(html: str, limit: int = MAX_BODY_CHARS) -> str:
+    """
+    Deterministic HTML-to-text. The markup is fed in chunks and parsing stops
+    as soon as `limit` characters of text exist, so huge newsletters cost no
+    more than small ones.
+    """
+    parser = _TextExtractor(limit)
+    for start in range(0, len(html), HTML_FEED_CHUNK):
+        parser.feed(html[start:start + HTML_FEED_CHUNK])
+        if parser.full:
+            break
+    parser.close()
+    return parser.text()
+
+
+def _is_outlook_rule(lines: list[str], index: int) -> bool:
+    if not _OUTLOOK_RULE.match(lines[index]):
+        return False
+    following = [line for line in lines[index + 1:index + 4] if line.strip()]
+    return bool(following) and bool(_QUOTED_HEADER.match(following[0]))
+
+
+def _is_signature_delimiter(lines: list[str], index: int) -> bool:
+    if not _SIGNATURE_DELIMITER.match(lines[index]):
+        return False
+    signature = 0
+    for line in lines[index + 1:]:
+        if any(p.match(line) for p in _REPLY_MARKERS):
+            break
+        if line.strip():
+            signature += 1
+    return signature <= SIGNATURE_MAX_LINES
+
+
+def strip_reply_chain(text: str) -> str:
+    """Drop quoted history (">" lines, "On ... wrote:", Outlook separators) and the signature block."""
+    lines = text.splitlines()
+    kept: list[str] = []
+    for index, line in enumerate(lines):
+        if kept and (any(p.match(line) for p in _REPLY_MARKERS) or _is_outlook_rule(lines, index)):
+            break
+        if any(p.match(line) for p in _SIGNATURE_MARKERS) or _is_signature_delimiter(lines, index):
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        kept.append(line)
+    return "\n".join(kept).strip()
+
+
+def clean_body(text: str, is_html: bool = False, limit: int = MAX_BODY_CHARS) -> str:
+    """Plain text for the LLM: HTML converted, reply chain/signature removed, capped at `limit`."""
+    if is_html:
+        text = html_to_text(text, limit=limit * 2)
+    cleaned = strip_reply_chain(text)
+    # A body that is nothing but a quote is better passed through than emptied.
+    if not cleaned:
+        cleaned = text.strip()
+    return cleaned[:limit]
@@ -1,22 +1,70 @@
 from __future__ import annotations
 
 import os
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import lru_cache
 
+import openai
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from src.utils.circuit_breaker import CircuitBreaker
+from src.utils.deadlines import bounded_timeout
+
 load_dotenv()
 
+# Per-request ceiling; a hung request otherwise holds its worker thread for good.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+
+def _is_openai_outage(exc: BaseException) -> bool:
+    # Throttling and server-side trouble; a 4xx for a bad prompt is our problem.
+    return isinstance(exc, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+
+# Wrap every OpenAI request: `with openai_breaker.guard(): client...create(...)`.
+openai_breaker = CircuitBreaker("openai", is_failure=_is_openai_outage)
+
 
 @lru_cache(maxsize=1)
 def get_openai_client() -> OpenAI:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY is required")
-    return OpenAI(api_key=api_key)
+    return OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=OPENAI_MAX_RETRIES)
+
+
+def llm_timeout() -> float | None:
+    """Timeout for the next OpenAI request: the client default, cut to the email's remaining budget."""
+    return bounded_timeout(OPENAI_TIMEOUT_SECONDS)
 
 
 def get_default_model() -> str:
     return os.getenv("OPENAI_MODEL", "gpt-5.2")
 
+
+# Token counters for whatever code is running inside `track_token_usage`.
+# asyncio.to_thread copies the context, so calls made from worker threads
+# are attributed to the task that started them.
+_usage_sink: ContextVar[dict | None] = ContextVar("llm_usage_sink", default=None)
+
+
+@contextmanager
+def track_token_usage():
+    sink = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    token = _usage_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _usage_sink.reset(token)
+
+
+def record_usage(response) -> None:
+    sink = _usage_sink.get()
+    usage = getattr(response, "usage", None)
+    if sink is None or usage is None:
+        return
+    for field in sink:
+        sink[field] += getattr(usage, field, 0) or 0
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable
+
+from src.utils.deadlines import DeadlineExceeded, bounded_timeout, without_deadline
+
+# name -> group, for metrics
+_groups: dict[str, "SingleFlight"] = {}
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls into one. The first caller for a
+    key runs the call; callers arriving while it is in flight wait for its
+    result (or exception) instead of repeating it. Nothing is kept once the
+    call finishes, so this dedupes overlap, not repeats; put a cache in
+    front for that.
+
+    One group per call type, since keys only mean something within a type.
+    The shared call runs without the leader's deadline (clients fall back
+    to their default timeouts), so a leader about to time out cannot fail
+    waiters that have budget left. A waiter stops waiting at its own
+    deadline; the leader's stage timeout still abandons it as before.
+    Groups are per process.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+        _groups[name] = self
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        # A caller already out of time neither starts nor joins a call.
+        bounded_timeout(None)
+        with self._lock:
+            self.calls += 1
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            try:
+                return future.result(timeout=bounded_timeout(None))
+            except TimeoutError as exc:
+                if future.done():
+                    raise
+                raise DeadlineExceeded(f"deadline passed waiting for {self.name} call in flight") from exc
+
+        try:
+            with without_deadline():
+                result = func(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def metrics(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._inflight)}
+
+
+def single_flight_metrics() -> dict:
+    return {name: group.metrics() for name, group in sorted(_groups.items())}
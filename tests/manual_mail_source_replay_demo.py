@@ -0,0 +1,34 @@
+"""
+Manual harness for the local mail sources.
+
+Usage:
+    python tests/manual_mail_source_replay_demo.py path/to/maildir-or-mbox-or.jsonl [speed]
+
+No Gmail credentials or external services are needed; the script prints
+each replayed email as the pipeline would receive it.
+"""
+
+from __future__ import annotations
+
+import json
+import sys
+
+from src.agents.mail_sources import get_mail_source
+
+
+def main() -> None:
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__)
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    source = get_mail_source(sys.argv[1], speed=speed)
+
+    while True:
+        emails, more_pending, backlog = source.fetch_batch(limit=10)
+        for email in emails:
+            print(json.dumps(email, indent=2))
+        if not emails and not more_pending and not backlog:
+            break
+
+
+if __name__ == "__main__":
+    main()